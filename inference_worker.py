@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+"""
+常駐推論 worker
+
+只載入一次 pipeline，之後持續接收推論工作，每個工作的延遲不包含載入模型的時間。
+工作為一行 JSON：
+    {"id": "a1", "person": "00001_00.jpg", "cloth": "01234_00.jpg",
+     "steps": 28, "seed": 0, "output": "outputs/worker/00001_00.jpg"}
+每個工作完成後回寫一行狀態紀錄：
+    {"id": "a1", "status": "done", "output": "...", "latency": 3.2}
+    {"id": "a2", "status": "error", "error": "...", "latency": 0.1}
+
+工作來源：
+- --socket：本機 Unix socket，每行一個工作，逐行回覆狀態紀錄（submit 命令為對應的用戶端）；
+  沒有 id 的工作依 worker 收到的順序編為 auto-1、auto-2…，不同連線不會重複；
+  已有 worker 監聽同一個 socket 時拒絕啟動，結束時（含 SIGTERM）移除 socket 檔案
+- --jobs：持續讀取 JSON Lines 檔案新增的工作，狀態寫入 --status；沒有 id 的工作以行號為 id，
+  重新啟動時略過已完成的 id
+兩種來源只能擇一。
+
+pipeline 以 --pipeline module:factory 指定（module 也可以是 .py 檔案路徑），
+factory(**options) 回傳 callable(person, cloth, steps, seed)，回傳 PIL 圖片。
+
+本專案目前只提供測試用的 tools/stub_inference.py:create_stub_pipeline。
+PromptDresser 的程式碼由 kaggle_setup.py 在執行時 clone，不在本專案中，
+其推論只有 PromptDresser/inference.py 這個命令列腳本，沒有可匯入的 pipeline 介面，
+因此實際的工廠函式需自行依該腳本撰寫，並做到：
+- 在工廠函式中依 --config_p 的設定載入一次 SDXL inpainting 模型、VAE 與
+  PromptDresser 的權重並移到 GPU（這是每個工作省下的時間）；
+- callable 以 person/cloth 檔名從資料集讀取人物圖片、衣服、agnostic-mask 與
+  densepose，依 steps 與 seed 執行一次去噪，回傳輸出的 PIL 圖片；
+- 相同的 seed 產生相同的結果（每次呼叫重新建立 torch.Generator）。
+同一個 worker 的工作依序執行（見 InferenceWorker），callable 不需要是執行緒安全的。
+"""
+
+import os
+import sys
+import argparse
+import importlib
+import importlib.util
+import itertools
+import json
+import signal
+import socket
+import socketserver
+import stat
+import threading
+import time
+from pathlib import Path
+
+# 預設 socket、工作檔與狀態檔
+DEFAULT_SOCKET = '/tmp/vto-inference.sock'
+DEFAULT_JOBS_FILE = 'outputs/worker/requests.jsonl'
+DEFAULT_STATUS_FILE = 'outputs/worker/status.jsonl'
+
+# 工作欄位的預設值（與 kaggle_inference.py 相同的擴散步數）
+DEFAULT_STEPS = 28
+DEFAULT_SEED = 0
+
+# 讀取工作檔的輪詢間隔（秒）
+POLL_INTERVAL = 0.5
+
+def load_pipeline(spec, options):
+    """以 module:factory 建立 pipeline，module 可為模組名稱或 .py 檔案路徑
+
+    工廠函式需實作的介面見模組說明；本專案只提供測試用的 create_stub_pipeline。
+    """
+    module_name, _, factory_name = spec.partition(':')
+    if not factory_name:
+        raise ValueError(f"--pipeline 格式應為 module:factory：{spec}")
+    if module_name.endswith('.py'):
+        module_spec = importlib.util.spec_from_file_location(Path(module_name).stem, module_name)
+        module = importlib.util.module_from_spec(module_spec)
+        module_spec.loader.exec_module(module)
+    else:
+        module = importlib.import_module(module_name)
+    return getattr(module, factory_name)(**options)
+
+def parse_option(value):
+    """解析 --pipeline_option key=value"""
+    key, sep, option = value.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError(f"格式應為 key=value：{value}")
+    return key, option
+
+def save_image(image, output):
+    """先寫入同目錄的隱藏暫存檔再改名，監看輸出目錄的程式不會讀到不完整的圖片"""
+    from PIL import Image
+
+    directory, name = os.path.split(os.path.abspath(output))
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = os.path.join(directory, f".{name}.{os.getpid()}.tmp")
+    image.save(tmp_path, format=Image.registered_extensions().get(os.path.splitext(name)[1].lower()))
+    os.replace(tmp_path, output)
+
+class InferenceWorker:
+    """持有已載入的 pipeline；多個連線同時送來的工作依序執行"""
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.lock = threading.Lock()
+
+    def run_job(self, job):
+        """執行一個工作並回傳狀態紀錄；輸出先寫暫存檔再改名，不會留下不完整的圖片"""
+        start = time.perf_counter()
+        record = {'id': job.get('id')}
+        try:
+            output = job['output']
+            with self.lock:
+                image = self.pipeline(job['person'], job['cloth'],
+                                      int(job.get('steps', DEFAULT_STEPS)),
+                                      int(job.get('seed', DEFAULT_SEED)))
+            save_image(image, output)
+            record.update(status='done', output=output)
+        except KeyError as e:
+            record.update(status='error', error=f"工作缺少欄位 {e}")
+        except Exception as e:
+            record.update(status='error', error=str(e))
+        record['latency'] = round(time.perf_counter() - start, 4)
+        return record
+
+def print_record(record):
+    print(f"{'✅' if record['status'] == 'done' else '❌'} {record['id']}："
+          f"{record.get('output', record.get('error'))}（{record['latency']:.2f} 秒）", flush=True)
+
+# 工作必要的欄位
+REQUIRED_FIELDS = ('person', 'cloth', 'output')
+
+def parse_job(line, default_id):
+    """解析並驗證一行工作，格式錯誤時拋出 ValueError
+
+    沒有 id 時使用 default_id；id 只接受字串或整數，一律轉為字串，
+    狀態檔與續跑比對時 1 與 "1" 視為同一個工作。
+    """
+    job = json.loads(line)
+    if not isinstance(job, dict):
+        raise ValueError("工作必須是 JSON 物件")
+    job_id = job.get('id', default_id)
+    if isinstance(job_id, bool) or not isinstance(job_id, (str, int)):
+        raise ValueError(f"id 必須是字串或整數：{job_id!r}")
+    job['id'] = str(job_id)
+    missing = [field for field in REQUIRED_FIELDS if not isinstance(job.get(field), str)]
+    if missing:
+        raise ValueError(f"缺少欄位或不是字串：{', '.join(missing)}")
+    return job
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """每行一個工作，逐行回覆狀態紀錄；沒有 id 的工作由 server 的計數器編號，各連線之間不重複"""
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            default_id = f"auto-{next(self.server.job_numbers)}"
+            try:
+                record = self.server.worker.run_job(parse_job(line, default_id))
+            except ValueError as e:
+                record = {'id': default_id, 'status': 'error', 'error': f"無法解析工作：{e}", 'latency': 0.0}
+            self.wfile.write((json.dumps(record, ensure_ascii=False) + '\n').encode())
+            self.wfile.flush()
+            print_record(record)
+
+def remove_stale_socket(socket_path):
+    """移除上次未正常結束留下的 socket 檔案
+    
+    仍有 worker 在監聽，或路徑不是 socket 時拋出 RuntimeError，不會取代執行中的 worker。
+    """
+    try:
+        mode = os.stat(socket_path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise RuntimeError(f"{socket_path} 已存在且不是 socket")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(socket_path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            pass
+        else:
+            raise RuntimeError(f"已有 worker 在 {socket_path} 監聽")
+    os.remove(socket_path)
+
+def serve_socket(worker, socket_path):
+    """在 Unix socket 上接收工作，直到 Ctrl+C 或 SIGTERM；結束時移除 socket 檔案"""
+    remove_stale_socket(socket_path)
+    server = socketserver.ThreadingUnixStreamServer(socket_path, JobHandler)
+    server.daemon_threads = True
+    server.worker = worker
+    server.job_numbers = itertools.count(1)
+    
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    
+    previous = signal.signal(signal.SIGTERM, stop)
+    print(f"✅ 在 {socket_path} 等待工作", flush=True)
+    try:
+        server.serve_forever()
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+        server.server_close()
+        try:
+            os.remove(socket_path)
+        except FileNotFoundError:
+            pass
+
+def completed_ids(status_file):
+    """讀取狀態檔中已完成的工作 id"""
+    done = set()
+    if os.path.exists(status_file):
+        with open(status_file, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # 上次中斷時寫到一半的紀錄
+                if isinstance(record, dict) and record.get('status') == 'done' and 'id' in record:
+                    done.add(str(record['id']))
+    return done
+
+def tail_jobs(worker, jobs_file, status_file, poll_interval=POLL_INTERVAL, idle_timeout=None):
+    """持續讀取 jobs_file 新增的工作並把狀態寫入 status_file
+
+    只處理完整的行（以換行結尾）；已在狀態檔中完成的 id 不會重跑。
+    格式錯誤的工作（見 parse_job）寫入 error 狀態後略過，不會中斷 worker。
+    idle_timeout 秒內沒有新工作時結束，None 表示持續等待。回傳處理的工作數。
+    """
+    done = completed_ids(status_file)
+    os.makedirs(os.path.dirname(os.path.abspath(status_file)), exist_ok=True)
+    Path(jobs_file).parent.mkdir(parents=True, exist_ok=True)
+    Path(jobs_file).touch()
+    print(f"✅ 讀取 {jobs_file} 的工作，狀態寫入 {status_file}（已完成 {len(done)} 個）", flush=True)
+
+    offset = 0
+    number = 0
+    processed = 0
+    last_job = time.monotonic()
+    with open(jobs_file, 'rb') as jobs, open(status_file, 'a') as status:
+        while True:
+            jobs.seek(offset)
+            lines = []
+            for line in jobs:
+                if not line.endswith(b'\n'):
+                    break  # 寫到一半的行，下次再讀
+                offset += len(line)
+                lines.append(line)
+
+            for line in lines:
+                number += 1
+                if not line.strip():
+                    continue
+                try:
+                    job = parse_job(line, number)
+                except ValueError as e:
+                    record = {'id': str(number), 'status': 'error', 'error': f"無法解析工作：{e}",
+                              'latency': 0.0}
+                else:
+                    if job['id'] in done:
+                        continue
+                    record = worker.run_job(job)
+                    if record['status'] == 'done':
+                        done.add(job['id'])
+                status.write(json.dumps(record, ensure_ascii=False) + '\n')
+                status.flush()
+                processed += 1
+                print_record(record)
+
+            if lines:
+                last_job = time.monotonic()
+            elif idle_timeout is not None and time.monotonic() - last_job >= idle_timeout:
+                return processed
+            else:
+                time.sleep(poll_interval)
+
+def submit(socket_path, lines):
+    """將工作送到 worker 的 Unix socket，回傳狀態紀錄列表"""
+    records = []
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        reader = client.makefile('r')
+        for line in lines:
+            if not line.strip():
+                continue
+            client.sendall((line.strip() + '\n').encode())
+            record = json.loads(reader.readline())
+            print(json.dumps(record, ensure_ascii=False), flush=True)
+            records.append(record)
+    return records
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='常駐推論 worker：只載入一次 pipeline，持續處理推論工作',
+        epilog='範例：python inference_worker.py serve --pipeline tools/stub_inference.py:create_stub_pipeline '
+               '--jobs outputs/worker/requests.jsonl'
+    )
+    parser.add_argument('command', choices=['serve', 'submit'],
+                       help='serve：啟動 worker；submit：將工作送到執行中的 worker')
+    parser.add_argument('--pipeline', help='pipeline 工廠函式（module:factory 或 檔案.py:factory）')
+    parser.add_argument('--pipeline_option', type=parse_option, action='append', default=[],
+                       help='傳給工廠函式的參數 key=value（可重複）')
+    parser.add_argument('--socket', default=None,
+                       help=f'Unix socket 路徑（serve 未指定 --jobs 或 submit 時預設 {DEFAULT_SOCKET}；'
+                            f'serve 不能與 --jobs 同時使用）')
+    parser.add_argument('--jobs', default=None,
+                       help=f'serve：持續讀取的工作檔（例如 {DEFAULT_JOBS_FILE}）；'
+                            f'submit：要送出的工作檔（預設讀取標準輸入）')
+    parser.add_argument('--status', default=DEFAULT_STATUS_FILE, help='--jobs 模式的狀態紀錄檔')
+    parser.add_argument('--poll_interval', type=float, default=POLL_INTERVAL, help='讀取工作檔的輪詢間隔（秒）')
+    parser.add_argument('--idle_timeout', type=float, default=None,
+                       help='--jobs 模式超過這個秒數沒有新工作時結束（預設持續等待）')
+
+    args = parser.parse_args()
+
+    if args.command == 'submit':
+        if args.jobs:
+            with open(args.jobs, 'r') as f:
+                records = submit(args.socket or DEFAULT_SOCKET, f.readlines())
+        else:
+            records = submit(args.socket or DEFAULT_SOCKET, sys.stdin)
+        if any(record['status'] != 'done' for record in records):
+            sys.exit(1)
+        return
+
+    if not args.pipeline:
+        parser.error('serve 需要 --pipeline')
+    if args.jobs and args.socket:
+        parser.error('serve 的 --jobs 與 --socket 只能擇一')
+    use_socket = not args.jobs
+    if use_socket:
+        # 載入 pipeline 可能需要數分鐘，先確認沒有其他 worker 使用同一個 socket
+        try:
+            remove_stale_socket(args.socket or DEFAULT_SOCKET)
+        except RuntimeError as e:
+            print(f"❌ {e}")
+            sys.exit(1)
+
+    print("🚀 載入 pipeline...", flush=True)
+    start = time.perf_counter()
+    worker = InferenceWorker(load_pipeline(args.pipeline, dict(args.pipeline_option)))
+    print(f"✅ pipeline 載入完成（{time.perf_counter() - start:.1f} 秒）", flush=True)
+
+    try:
+        if use_socket:
+            serve_socket(worker, args.socket or DEFAULT_SOCKET)
+        else:
+            tail_jobs(worker, args.jobs, args.status, args.poll_interval, args.idle_timeout)
+    except RuntimeError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+    except KeyboardInterrupt:
+        print("\n⏹️  worker 已停止")
+
+if __name__ == "__main__":
+    main()
@@ -2,55 +2,313 @@
 """
 Kaggle 環境推論腳本
 適用於 Kaggle Notebooks 的 GPU 環境
+
+--s_idx/--e_idx 的範圍會切成多個區段，由 --workers 個 worker 從共用佇列取出執行；
+每個 worker 以 CUDA_VISIBLE_DEVICES 綁定一張 GPU，並限制 CPU 執行緒數。
 """
 
 import os
 import sys
+import argparse
+import math
+import shutil
 import subprocess
+import threading
+import time
+from collections import deque
 from pathlib import Path
 
-def run_inference():
-    """執行推論"""
+# 預設推論腳本、配置檔與配對檔
+INFERENCE_SCRIPT = 'PromptDresser/inference.py'
+CONFIG_FILE = 'PromptDresser/configs/VITONHD_noprompt.yaml'
+PAIRS_FILE = 'data/zalando-hd-resized/test_pairs.txt'
+
+# 推論輸出的命名方式（與 tools/eval.py 的 GEN_NAME_PATTERNS 相同）與副檔名
+OUTPUT_NAME_PATTERNS = ('{person}', '{person}_{cloth}', '{person}__{cloth}')
+OUTPUT_EXTS = ('.jpg', '.png')
+
+# 續跑時驗證既有輸出的執行緒數
+VALIDATE_WORKERS = 8
+
+# guided self-scheduling：每次取出 剩餘數量 / (GUIDED_FACTOR × worker 數) 個圖片對，
+# 區段越來越小，較慢的 worker 不會在最後拖住一大段
+GUIDED_FACTOR = 2
+
+# 每個區段都是一個新的推論子程序，要重新載入模型（SDXL 需要數分鐘），區段不能太小。
+# 預設下限為 max(MIN_CHUNK, ceil(圖片對數 / (worker 數 × CHUNKS_PER_WORKER)))：
+# 每個 worker 最多約 CHUNKS_PER_WORKER 次載入，代價是最後一段的負載平衡較粗
+MIN_CHUNK = 32
+CHUNKS_PER_WORKER = 4
+
+# --resume：缺少的索引之間相隔不超過 RESUME_MERGE_GAP 組已完成的圖片對時合併為同一區間，
+# 重新推論中間已完成的圖片對，避免零散的缺漏各自載入一次模型
+RESUME_MERGE_GAP = 16
+
+def read_pairs(pairs_file):
+    """讀取配對檔，回傳 (人物主幹, 衣服主幹) 列表（忽略空白行）"""
+    pairs = []
+    with open(pairs_file, 'r') as f:
+        for line in f:
+            parts = line.split()
+            if parts:
+                person = os.path.splitext(parts[0])[0]
+                cloth = os.path.splitext(parts[1])[0] if len(parts) > 1 else ''
+                pairs.append((person, cloth))
+    return pairs
+
+def default_output_dir(save_name, pairs_file):
+    """推論輸出目錄：test_unpairs.txt 對應 unpaired/，其他配對檔對應 paired/"""
+    subdir = 'unpaired' if 'unpair' in Path(pairs_file).name else 'paired'
+    return os.path.join('outputs', save_name, subdir)
+
+def is_valid_image(path):
+    """完整解碼圖片，截斷或損壞時回傳 False"""
+    from PIL import Image
+    
+    try:
+        with Image.open(path) as img:
+            img.load()
+        return True
+    except Exception:
+        return False
+
+def find_missing(pairs, start, end, output_dir):
+    """回傳 [start, end) 中沒有可解碼輸出的索引，以及 (已完成數, 損壞的檔案)
+    
+    輸出檔名依 OUTPUT_NAME_PATTERNS 比對；同一個索引有多個候選檔案時任一個可解碼即視為完成。
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    
+    existing = {}
+    if os.path.isdir(output_dir):
+        with os.scandir(output_dir) as entries:
+            for entry in entries:
+                stem, ext = os.path.splitext(entry.name)
+                if ext.lower() in OUTPUT_EXTS and entry.is_file():
+                    existing.setdefault(stem, []).append(entry.path)
+    
+    candidates = {}
+    for idx in range(start, end):
+        person, cloth = pairs[idx]
+        names = {pattern.format(person=person, cloth=cloth) for pattern in OUTPUT_NAME_PATTERNS}
+        candidates[idx] = [path for name in names for path in existing.get(name, [])]
+    
+    files = sorted({path for paths in candidates.values() for path in paths})
+    with ThreadPoolExecutor(max_workers=VALIDATE_WORKERS) as executor:
+        valid = dict(zip(files, executor.map(is_valid_image, files)))
+    
+    missing = [idx for idx, paths in candidates.items() if not any(valid[path] for path in paths)]
+    corrupt = [path for path in files if not valid[path]]
+    return missing, len(candidates) - len(missing), corrupt
+
+def coalesce(indices, max_gap=0):
+    """將已排序的索引合併為 [s_idx, e_idx) 區間，相隔不超過 max_gap 個索引的區間也會合併"""
+    spans = []
+    for idx in indices:
+        if spans and idx - spans[-1][1] <= max_gap:
+            spans[-1][1] = idx + 1
+        else:
+            spans.append([idx, idx + 1])
+    return [tuple(span) for span in spans]
+
+def detect_devices():
+    """回傳可用的 GPU 編號；沒有 GPU 時回傳空列表（以 CPU 執行）"""
+    visible = os.environ.get('CUDA_VISIBLE_DEVICES')
+    if visible is not None:
+        return [device for device in visible.split(',') if device.strip()]
+    if shutil.which('nvidia-smi') is None:
+        return []
+    result = subprocess.run(['nvidia-smi', '-L'], capture_output=True, text=True)
+    if result.returncode != 0:
+        return []
+    return [str(i) for i, line in enumerate(result.stdout.splitlines()) if line.startswith('GPU')]
+
+class ChunkQueue:
+    """以 guided self-scheduling 切分多個 [s_idx, e_idx) 區間的共用佇列，可由多個執行緒同時取用
+    
+    區段不會跨越區間邊界。只有一個 worker 時不切分，每個區間整段交給同一個子程序；
+    多個 worker 時區段不小於 min_chunk（預設見 MIN_CHUNK）。
+    失敗的區段以 retry 放回佇列，優先交給下一個閒置的 worker。
+    """
+    
+    def __init__(self, spans, workers, min_chunk=None, max_chunk=None):
+        self.spans = deque(list(span) for span in spans)
+        self.remaining = sum(end - start for start, end in spans)
+        self.workers = workers
+        if min_chunk is None:
+            min_chunk = max(MIN_CHUNK, math.ceil(self.remaining / (workers * CHUNKS_PER_WORKER)))
+        self.min_chunk = min_chunk
+        self.max_chunk = max_chunk
+        self.retries = deque()
+        self.lock = threading.Lock()
+    
+    def get(self):
+        """取出下一個區段 (s_idx, e_idx, 嘗試次數)，沒有剩餘工作時回傳 None"""
+        with self.lock:
+            if self.retries:
+                return self.retries.popleft()
+            if not self.spans:
+                return None
+            span = self.spans[0]
+            length = span[1] - span[0]
+            if self.workers == 1:
+                size = length
+            else:
+                size = max(self.min_chunk, math.ceil(self.remaining / (GUIDED_FACTOR * self.workers)))
+            if self.max_chunk:
+                size = min(size, self.max_chunk)
+            size = min(size, length)
+            chunk = (span[0], span[0] + size, 1)
+            span[0] += size
+            self.remaining -= size
+            if span[0] == span[1]:
+                self.spans.popleft()
+            return chunk
+    
+    def retry(self, s_idx, e_idx, attempt):
+        with self.lock:
+            self.retries.append((s_idx, e_idx, attempt + 1))
+
+def worker_env(device, threads):
+    """worker 子程序的環境變數：綁定 GPU（device 為 None 時隱藏 GPU）並限制執行緒數"""
+    return dict(os.environ,
+                CUDA_VISIBLE_DEVICES='' if device is None else device,
+                OMP_NUM_THREADS=str(threads),
+                MKL_NUM_THREADS=str(threads),
+                OPENBLAS_NUM_THREADS=str(threads))
+
+def run_worker(worker, queue, command, env, log_dir, max_attempts, results):
+    """不斷從佇列取出區段並執行推論子程序，結果記錄在 results
+    
+    results 的元素為 (s_idx, e_idx, 失敗原因, 記錄檔)，成功時失敗原因為 None。
+    啟動子程序或寫入記錄檔時的例外視為該區段失敗（同樣會重試），worker 繼續取用下一段。
+    """
+    while True:
+        chunk = queue.get()
+        if chunk is None:
+            return
+        s_idx, e_idx, attempt = chunk
+        log_path = Path(log_dir) / f"chunk_{s_idx:05d}_{e_idx:05d}.log"
+        start = time.perf_counter()
+        try:
+            with open(log_path, 'a') as log:
+                returncode = subprocess.run(
+                    command + ['--s_idx', str(s_idx), '--e_idx', str(e_idx)],
+                    env=env, stdout=log, stderr=subprocess.STDOUT
+                ).returncode
+            error = None if returncode == 0 else f"結束碼 {returncode}"
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        elapsed = time.perf_counter() - start
+        
+        status = '✅' if error is None else '❌'
+        print(f"{status} worker {worker}：[{s_idx}, {e_idx}) 第 {attempt} 次，"
+              f"{elapsed:.1f} 秒（{error or '結束碼 0'}）", flush=True)
+        if error is not None and attempt < max_attempts:
+            queue.retry(s_idx, e_idx, attempt)
+            continue
+        results.append((s_idx, e_idx, error, log_path))
+
+def run_inference(args, extra_args=()):
+    """執行推論：切分 [s_idx, e_idx) 並由多個 worker 子程序平行處理
+    
+    回傳是否所有區段都成功。失敗的區段列出範圍與記錄檔，可再以 --s_idx/--e_idx 重跑。
+    """
     print("🎯 開始執行推論...")
     
-    # 檢查 PromptDresser 是否存在
-    if not os.path.exists('PromptDresser'):
-        print("❌ PromptDresser 專案不存在，請先執行 python kaggle_setup.py")
+    # 檢查推論腳本是否存在
+    if not os.path.exists(args.inference_script):
+        print(f"❌ 推論腳本不存在：{args.inference_script}")
+        if args.inference_script == INFERENCE_SCRIPT:
+            print("請先執行 python kaggle_setup.py")
         return False
     
     # 檢查配置檔案
-    config_file = 'PromptDresser/configs/VITONHD_noprompt.yaml'
-    if not os.path.exists(config_file):
+    if not os.path.exists(args.config_p):
         print("❌ 配置檔案不存在，請先執行 python scripts/patch_config.py")
         return False
     
     # 檢查資料集
-    data_dir = 'data/zalando-hd-resized'
-    if not os.path.exists(data_dir):
-        print("❌ 資料集目錄不存在")
+    if not os.path.exists(args.pairs_file):
+        print(f"❌ 配對檔不存在：{args.pairs_file}")
         return False
     
-    # 執行推論
-    cmd = [
-        'python', 'PromptDresser/inference.py',
-        '--config_p', config_file,
-        '--save_name', 'kaggle-demo',
-        '--num_inference_steps', '28',
-        '--s_idx', '0',
-        '--e_idx', '3'
+    pairs = read_pairs(args.pairs_file)
+    end = len(pairs) if args.e_idx is None else min(args.e_idx, len(pairs))
+    if args.s_idx >= end:
+        print(f"❌ 沒有要處理的圖片對（配對檔共 {len(pairs)} 組，範圍 [{args.s_idx}, {end})）")
+        return False
+    
+    spans = [(args.s_idx, end)]
+    if args.resume:
+        output_dir = args.output_dir or default_output_dir(args.save_name, args.pairs_file)
+        missing, done, corrupt = find_missing(pairs, args.s_idx, end, output_dir)
+        print(f"續跑：{output_dir} 中已有 {done} 組完成，{len(missing)} 組需要推論")
+        for path in corrupt:
+            print(f"  ⚠️  無法解碼，將重新推論：{path}")
+        if not missing:
+            print("✅ 所有輸出都已存在")
+            return True
+        spans = coalesce(missing, args.resume_merge_gap)
+        rerun = sum(e - s for s, e in spans) - len(missing)
+        print(f"  缺少的索引合併為 {len(spans)} 個區間"
+              f"{f'（含 {rerun} 組重新推論的已完成圖片對）' if rerun else ''}："
+              f"{', '.join(f'[{s}, {e})' for s, e in spans[:10])}{' …' if len(spans) > 10 else ''}")
+    
+    if args.devices is None:
+        devices = detect_devices()
+    else:
+        devices = [device for device in args.devices.split(',') if device and device != 'cpu']
+    workers = args.workers or max(1, len(devices))
+    threads = args.threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+    
+    log_dir = Path(args.log_dir or os.path.join('outputs', args.save_name, 'logs'))
+    log_dir.mkdir(parents=True, exist_ok=True)
+    
+    command = [
+        sys.executable, args.inference_script,
+        '--config_p', args.config_p,
+        '--save_name', args.save_name,
+        '--num_inference_steps', str(args.num_inference_steps),
+        *extra_args
     ]
+    # 非預設的配對檔傳給推論腳本，子程序的索引才會對應到同一份配對檔；
+    # 預設值不傳遞，推論腳本不需要支援 --pairs_file
+    if args.pairs_file != PAIRS_FILE:
+        command += ['--pairs_file', args.pairs_file]
+    print(f"執行命令: {' '.join(command)} --s_idx <s> --e_idx <e>")
+    print(f"範圍 [{args.s_idx}, {end}) 中 {sum(e - s for s, e in spans)} 組圖片對，{workers} 個 worker，"
+          f"裝置 {', '.join(devices) if devices else 'CPU'}，每個 worker {threads} 個執行緒")
     
-    print(f"執行命令: {' '.join(cmd)}")
+    queue = ChunkQueue(spans, workers, args.min_chunk, args.max_chunk)
+    results = []
+    threads_list = []
+    start = time.perf_counter()
+    for worker in range(workers):
+        device = devices[worker % len(devices)] if devices else None
+        thread = threading.Thread(
+            target=run_worker,
+            args=(worker, queue, command, worker_env(device, threads), log_dir,
+                  args.retries + 1, results)
+        )
+        thread.start()
+        threads_list.append(thread)
+    for thread in threads_list:
+        thread.join()
     
-    try:
-        result = subprocess.run(cmd, check=True, capture_output=True, text=True)
-        print("✅ 推論執行成功！")
-        print("輸出結果在: outputs/kaggle-demo/")
-        return True
-    except subprocess.CalledProcessError as e:
-        print(f"❌ 推論執行失敗: {e}")
-        print(f"錯誤輸出: {e.stderr}")
+    failed = sorted((s_idx, e_idx, error, log_path)
+                    for s_idx, e_idx, error, log_path in results if error is not None)
+    print(f"\n完成 {len(results)} 個區段，耗時 {time.perf_counter() - start:.1f} 秒")
+    if failed:
+        print(f"❌ {len(failed)} 個區段失敗：")
+        for s_idx, e_idx, error, log_path in failed:
+            print(f"  [{s_idx}, {e_idx})：{error}，記錄檔 {log_path}")
+        print("可加上 --resume 重新執行，只推論缺少的圖片對")
         return False
+    
+    print("✅ 推論執行成功！")
+    print(f"輸出結果在: outputs/{args.save_name}/")
+    return True
 
 def check_models():
     """檢查模型是否已下載"""
@@ -77,19 +335,65 @@ def check_models():
     return True
 
 def main():
+    parser = argparse.ArgumentParser(
+        description='Kaggle 推論腳本（多 worker 分段推論）',
+        allow_abbrev=False,
+        epilog='未知的參數會原樣傳給推論腳本，例如：'
+               'python kaggle_inference.py --full --workers 2 --inference_script tools/stub_inference.py '
+               '--skip_model_check --delay 0.1'
+    )
+    parser.add_argument('--inference_script', default=INFERENCE_SCRIPT, help='推論腳本')
+    parser.add_argument('--config_p', default=CONFIG_FILE, help='推論配置檔')
+    parser.add_argument('--save_name', default='kaggle-demo', help='輸出名稱（outputs/<save_name>/）')
+    parser.add_argument('--num_inference_steps', type=int, default=28, help='擴散步數')
+    parser.add_argument('--pairs_file', default=PAIRS_FILE, help='配對檔：決定圖片對數量與 --resume 的輸出檔名；'
+                            '非預設值會以 --pairs_file 傳給推論腳本（推論腳本需支援此參數）')
+    parser.add_argument('--s_idx', type=int, default=0, help='起始配對索引')
+    parser.add_argument('--e_idx', type=int, default=3, help='結束配對索引（不含），超過配對數時截斷')
+    parser.add_argument('--full', action='store_true', help='處理到配對檔結尾（忽略 --e_idx）')
+    parser.add_argument('--workers', type=int, default=None,
+                       help='同時執行的推論子程序數（預設為 GPU 數，沒有 GPU 時為 1）')
+    parser.add_argument('--devices', default=None,
+                       help='worker 依序輪流綁定的 GPU，例如 0,1（cpu 表示不使用 GPU；預設自動偵測）')
+    parser.add_argument('--threads_per_worker', type=int, default=None,
+                       help='每個 worker 的 OMP/MKL 執行緒數（預設平分 CPU 核心）')
+    parser.add_argument('--resume', action='store_true',
+                       help='只推論輸出不存在或無法解碼的圖片對（缺少的索引合併為區間）')
+    parser.add_argument('--resume_merge_gap', type=int, default=RESUME_MERGE_GAP,
+                       help=f'--resume 時相隔不超過此數量已完成圖片對的缺漏合併為同一區間'
+                            f'（預設 {RESUME_MERGE_GAP}，0 表示只合併相鄰的索引）。'
+                            f'重新推論中間的圖片對，換取較少的模型載入次數')
+    parser.add_argument('--output_dir', default=None,
+                       help='--resume 檢查的輸出目錄（預設 outputs/<save_name>/paired，'
+                            'test_unpairs.txt 為 unpaired）')
+    parser.add_argument('--min_chunk', type=int, default=None,
+                       help=f'多個 worker 時每個區段最少的圖片對數（預設 max({MIN_CHUNK}, '
+                            f'ceil(圖片對數 / (worker 數 × {CHUNKS_PER_WORKER})))）。'
+                            f'每個區段都要重新載入模型，調小可改善結尾的負載平衡但增加載入次數')
+    parser.add_argument('--max_chunk', type=int, default=None,
+                       help='每個區段最多的圖片對數（只有一個 worker 時也會切分）')
+    parser.add_argument('--retries', type=int, default=1, help='失敗區段的重試次數')
+    parser.add_argument('--log_dir', default=None, help='各區段的記錄檔目錄（預設 outputs/<save_name>/logs）')
+    parser.add_argument('--skip_model_check', action='store_true', help='不檢查預訓練模型（例如使用測試用推論腳本時）')
+    
+    args, extra_args = parser.parse_known_args()
+    if args.full:
+        args.e_idx = None
+    
     print("🚀 Kaggle 推論腳本")
     print("=" * 50)
     
     # 檢查模型
-    if not check_models():
-        return
+    if not args.skip_model_check and not check_models():
+        sys.exit(1)
     
     # 執行推論
-    if run_inference():
+    if run_inference(args, extra_args):
         print("\n🎉 推論完成！")
-        print("📁 結果位置: outputs/kaggle-demo/")
+        print(f"📁 結果位置: outputs/{args.save_name}/")
     else:
         print("\n❌ 推論失敗")
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
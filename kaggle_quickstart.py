@@ -7,9 +7,17 @@ Kaggle 快速開始腳本
 import os
 import sys
 import subprocess
+import threading
+import time
 import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
+# 解壓資料集的執行緒數（zlib 解壓縮時會釋放 GIL）
+EXTRACT_WORKERS = 8
+EXTRACT_CHUNK_SIZE = 1 << 20
+
 def print_step(step_num, description):
     """打印步驟資訊"""
     print(f"\n{'='*60}")
@@ -93,6 +101,101 @@ def patch_config():
     
     return True
 
+def member_mtime(info):
+    """zip 成員的修改時間（本地時間）"""
+    return time.mktime(info.date_time + (0, 0, -1))
+
+def file_crc32(path):
+    """計算檔案的 CRC-32"""
+    crc = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(EXTRACT_CHUNK_SIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+def is_extracted(info, target):
+    """判斷成員是否已完整解壓：大小與修改時間相符時直接信任，否則比對 CRC"""
+    try:
+        stat = target.stat()
+    except FileNotFoundError:
+        return False
+    if stat.st_size != info.file_size:
+        return False
+    if int(stat.st_mtime) == int(member_mtime(info)):
+        return True
+    if file_crc32(target) != info.CRC:
+        return False
+    # 內容相符，補上修改時間，下次不必再計算 CRC
+    os.utime(target, (member_mtime(info), member_mtime(info)))
+    return True
+
+def extract_zip(zip_file, dest_dir, workers=EXTRACT_WORKERS):
+    """以多個執行緒平行解壓 zip，可中斷後續傳
+    
+    已存在且大小與 CRC 相符的成員會略過。每個執行緒使用獨立的 ZipFile 檔案控制代碼；
+    成員先寫入 .part 暫存檔，完成後才改名並設定修改時間，中斷時不會留下不完整的檔案。
+    寫入失敗時刪除該成員的 .part；程序被強制結束而殘留的 .part 在下次執行時清除。
+    回傳 (解壓數, 略過數)。
+    """
+    dest = Path(dest_dir).resolve()
+    with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+        members = [info for info in zip_ref.infolist() if not info.is_dir()]
+    
+    pending = []
+    for info in members:
+        target = (dest / info.filename).resolve()
+        if dest not in target.parents:
+            raise ValueError(f"zip 成員路徑不合法：{info.filename}")
+        if not is_extracted(info, target):
+            pending.append((info, target))
+    skipped = len(members) - len(pending)
+    
+    # 清除上次被強制結束（例如 Kaggle session 中斷）時殘留的暫存檔
+    for _, target in pending:
+        target.with_name(target.name + '.part').unlink(missing_ok=True)
+    if not pending:
+        return 0, skipped
+    
+    local = threading.local()
+    handles = []
+    lock = threading.Lock()
+    
+    def extract_member(info, target):
+        if not hasattr(local, 'zip_ref'):
+            local.zip_ref = zipfile.ZipFile(zip_file, 'r')
+            with lock:
+                handles.append(local.zip_ref)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        part = target.with_name(target.name + '.part')
+        try:
+            with local.zip_ref.open(info) as src, open(part, 'wb') as dst:
+                for chunk in iter(lambda: src.read(EXTRACT_CHUNK_SIZE), b''):
+                    dst.write(chunk)
+            os.utime(part, (member_mtime(info), member_mtime(info)))
+            os.replace(part, target)
+        except BaseException:
+            part.unlink(missing_ok=True)
+            raise
+        return info.file_size
+    
+    total_bytes = sum(info.file_size for info, _ in pending)
+    done_bytes = 0
+    last_percent = -1
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(extract_member, info, target) for info, target in pending]
+            for count, future in enumerate(as_completed(futures), 1):
+                done_bytes += future.result()
+                percent = int(done_bytes * 100 / total_bytes) if total_bytes else 100
+                if percent != last_percent or count == len(futures):
+                    last_percent = percent
+                    print(f"\r解壓進度：{count}/{len(futures)} 個檔案，{percent}%", end='', flush=True)
+        print()
+    finally:
+        for handle in handles:
+            handle.close()
+    return len(pending), skipped
+
 def prepare_dataset():
     """準備資料集"""
     print_step(6, "準備資料集")
@@ -112,9 +215,8 @@ def prepare_dataset():
                     print(f"解壓資料集: {zip_file}")
                     
                     try:
-                        with zipfile.ZipFile(zip_file, 'r') as zip_ref:
-                            zip_ref.extractall('data/zalando-hd-resized/')
-                        print("✅ 資料集解壓成功")
+                        extracted, skipped = extract_zip(zip_file, 'data/zalando-hd-resized/')
+                        print(f"✅ 資料集解壓成功（解壓 {extracted} 個檔案，略過已存在的 {skipped} 個）")
                         return True
                     except Exception as e:
                         print(f"❌ 資料集解壓失敗: {e}")
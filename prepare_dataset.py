@@ -5,9 +5,19 @@ VITON-HD 資料集準備腳本
 
 import os
 import sys
+import argparse
+import errno
 import shutil
+import stat
 from pathlib import Path
 
+# ioctl FICLONE（Linux btrfs/XFS 等支援 reflink 的檔案系統）
+FICLONE = 0x40049409
+
+# 無法建立連結時改為複製的錯誤：跨檔案系統或檔案系統不支援
+LINK_FALLBACK_ERRNOS = {errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.ENOTTY,
+                        errno.EINVAL, errno.EMLINK}
+
 def create_test_structure():
     """建立測試資料結構"""
     print("📁 建立 VITON-HD 測試資料結構...")
@@ -43,8 +53,108 @@ def create_test_structure():
     print(f"  {base_dir}/")
     print("\n如果沒有 test_coarse/ 資料，可以複製 test/ 為 test_fine/ 和 test_coarse/")
 
-def copy_test_to_fine_coarse():
-    """將 test/ 複製為 test_fine/ 和 test_coarse/"""
+def reflink_file(src, dst):
+    """以 FICLONE 建立共用資料區塊的複本，並保留修改時間"""
+    import fcntl
+    
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        try:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        except OSError:
+            dst_file.close()
+            os.unlink(dst)
+            raise
+    shutil.copystat(src, dst)
+
+def place_file(src, dst, mode):
+    """依 mode 建立 dst，無法連結時改為複製，回傳實際使用的方式"""
+    try:
+        if mode == 'hardlink':
+            os.link(src, dst)
+        elif mode == 'reflink':
+            reflink_file(src, dst)
+        elif mode == 'symlink':
+            os.symlink(os.path.abspath(src), dst)
+        else:
+            shutil.copy2(src, dst)
+        return mode
+    except OSError as e:
+        if mode == 'copy' or e.errno not in LINK_FALLBACK_ERRNOS:
+            raise
+    shutil.copy2(src, dst)
+    return 'copy'
+
+def is_up_to_date(src_stat, dst, src, mode):
+    """判斷 dst 是否已是 src 的最新副本或連結"""
+    try:
+        dst_stat = os.lstat(dst)
+    except FileNotFoundError:
+        return False
+    
+    if stat.S_ISLNK(dst_stat.st_mode):
+        return mode == 'symlink' and os.readlink(dst) == os.path.abspath(src)
+    if mode == 'symlink':
+        return False
+    if (dst_stat.st_dev, dst_stat.st_ino) == (src_stat.st_dev, src_stat.st_ino):
+        # 硬連結只在 hardlink 模式下沿用，其他模式改為獨立的檔案
+        return mode == 'hardlink'
+    if mode == 'hardlink' and dst_stat.st_dev == src_stat.st_dev:
+        # 同一檔案系統上的複本改為硬連結以節省空間
+        return False
+    return dst_stat.st_size == src_stat.st_size and dst_stat.st_mtime_ns == src_stat.st_mtime_ns
+
+def sync_tree(src_dir, dst_dir, mode='copy'):
+    """增量同步 src_dir 到 dst_dir，只處理新增或改變的檔案
+    
+    mode 為 copy、hardlink、reflink 或 symlink；跨檔案系統或不支援連結時改為複製。
+    dst_dir 中 src_dir 沒有的檔案會被刪除。回傳各種處理方式的檔案數。
+    """
+    counts = {'unchanged': 0, 'copy': 0, 'hardlink': 0, 'reflink': 0, 'symlink': 0, 'removed': 0}
+    stack = ['']
+    while stack:
+        rel_dir = stack.pop()
+        src_path = os.path.join(src_dir, rel_dir)
+        dst_path = os.path.join(dst_dir, rel_dir)
+        os.makedirs(dst_path, exist_ok=True)
+        
+        names = set()
+        with os.scandir(src_path) as entries:
+            for entry in entries:
+                names.add(entry.name)
+                dst = os.path.join(dst_path, entry.name)
+                if entry.is_dir():
+                    if os.path.islink(dst) or os.path.isfile(dst):
+                        os.unlink(dst)
+                    stack.append(os.path.join(rel_dir, entry.name))
+                    continue
+                if is_up_to_date(entry.stat(), dst, entry.path, mode):
+                    counts['unchanged'] += 1
+                    continue
+                if os.path.lexists(dst):
+                    if os.path.isdir(dst) and not os.path.islink(dst):
+                        shutil.rmtree(dst)
+                    else:
+                        os.unlink(dst)
+                counts[place_file(entry.path, dst, mode)] += 1
+        
+        # 刪除來源已不存在的檔案
+        with os.scandir(dst_path) as entries:
+            for entry in entries:
+                if entry.name not in names:
+                    if entry.is_dir(follow_symlinks=False):
+                        shutil.rmtree(entry.path)
+                    else:
+                        os.unlink(entry.path)
+                    counts['removed'] += 1
+    return counts
+
+def copy_test_to_fine_coarse(mode='copy', clean=False):
+    """將 test/ 同步為 test_fine/ 和 test_coarse/
+    
+    mode 為 copy 以外時以硬連結、reflink 或符號連結建立檔案，不會佔用額外的磁碟空間；
+    硬連結與符號連結與 test/ 共用內容，請勿直接修改 test_fine/ 或 test_coarse/ 中的檔案。
+    預設只更新有變動的檔案，clean 為 True 時先刪除目標目錄。
+    """
     base_dir = Path('data/zalando-hd-resized')
     test_dir = base_dir / 'test'
     
@@ -53,27 +163,30 @@ def copy_test_to_fine_coarse():
         print("請先將 VITON-HD 測試資料放入 data/zalando-hd-resized/test/")
         return False
     
-    print("🔄 複製 test/ 為 test_fine/ 和 test_coarse/...")
-    
-    # 複製為 test_fine
-    fine_dir = base_dir / 'test_fine'
-    if fine_dir.exists():
-        shutil.rmtree(fine_dir)
-    shutil.copytree(test_dir, fine_dir)
-    print(f"✅ 複製到 {fine_dir}")
+    print(f"🔄 同步 test/ 為 test_fine/ 和 test_coarse/（{mode}）...")
     
-    # 複製為 test_coarse
-    coarse_dir = base_dir / 'test_coarse'
-    if coarse_dir.exists():
-        shutil.rmtree(coarse_dir)
-    shutil.copytree(test_dir, coarse_dir)
-    print(f"✅ 複製到 {coarse_dir}")
+    for split in ['test_fine', 'test_coarse']:
+        split_dir = base_dir / split
+        if clean and split_dir.exists():
+            shutil.rmtree(split_dir)
+        counts = sync_tree(test_dir, split_dir, mode)
+        summary = "、".join(f"{name} {count}" for name, count in counts.items() if count)
+        print(f"✅ 同步到 {split_dir}（{summary or '沒有檔案'}）")
     
     return True
 
 def main():
-    if len(sys.argv) > 1 and sys.argv[1] == 'copy':
-        copy_test_to_fine_coarse()
+    parser = argparse.ArgumentParser(description='VITON-HD 資料集準備腳本')
+    parser.add_argument('command', nargs='?', choices=['copy'],
+                       help='copy：將 test/ 同步為 test_fine/ 和 test_coarse/（省略時建立目錄結構）')
+    parser.add_argument('--link', choices=['copy', 'hardlink', 'reflink', 'symlink'], default='copy',
+                       help='建立檔案的方式；跨檔案系統或不支援時改為複製')
+    parser.add_argument('--clean', action='store_true', help='先刪除目標目錄再完整重建')
+    
+    args = parser.parse_args()
+    
+    if args.command == 'copy':
+        copy_test_to_fine_coarse(args.link, args.clean)
     else:
         create_test_structure()
         print("\n💡 提示：如果已有 test/ 目錄，可以執行：")
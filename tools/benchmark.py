@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+tools/ 與資料集腳本的效能基準測試
+
+以固定亂數種子產生 VITON-HD 結構的合成資料集（圖片、遮罩、densepose、配對檔），
+對 prepare_dataset.py、tools/check_dataset.py 與 tools/eval.py 各執行數次，
+量測吞吐量、延遲（最小值、中位數、最大值）與最大常駐記憶體（peak RSS），
+並可與 JSON 基準比較，退步超過門檻時以非零狀態結束。只需要 CPU。
+"""
+
+import os
+import sys
+import argparse
+import json
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+DATASET_SUBDIRS = ('image', 'image-densepose', 'agnostic-mask', 'cloth')
+
+# 基準比較時允許的退步比例（吞吐量下降或 peak RSS 增加）
+DEFAULT_THRESHOLD = 0.10
+
+def smooth_image(rng, height, width):
+    """產生平滑漸層加雜訊的 RGB 圖片，JPEG 壓縮後的大小接近真實照片"""
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, None, None]
+    x = np.linspace(0, 1, width, dtype=np.float32)[None, :, None]
+    colors = rng.random((2, 3), dtype=np.float32) * 255
+    image = colors[0] * (1 - y) * (1 - x) + colors[1] * y * x
+    image = image + rng.normal(0, 12, (height, width, 3)).astype(np.float32)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+def generate_dataset(root, num_images=32, width=768, height=1024, seed=0):
+    """產生 VITON-HD 結構的合成資料集
+
+    <root>/data/zalando-hd-resized/test/ 下有 image、image-densepose、agnostic-mask、cloth
+    與 test_pairs.txt / test_unpairs.txt；<root>/outputs/paired 為模擬的生成結果
+    （真實圖片在遮罩區域加上雜訊）。相同參數產生的檔案完全相同。
+    """
+    rng = np.random.default_rng(seed)
+    data_root = Path(root) / 'data' / 'zalando-hd-resized'
+    test_dir = data_root / 'test'
+    gen_dir = Path(root) / 'outputs' / 'paired'
+    for subdir in DATASET_SUBDIRS:
+        (test_dir / subdir).mkdir(parents=True, exist_ok=True)
+    gen_dir.mkdir(parents=True, exist_ok=True)
+
+    stems = [f"{index:05d}_00" for index in range(num_images)]
+    for stem in stems:
+        image = smooth_image(rng, height, width)
+        Image.fromarray(image).save(test_dir / 'image' / f"{stem}.jpg", quality=95)
+        Image.fromarray(smooth_image(rng, height, width)).save(
+            test_dir / 'cloth' / f"{stem}.jpg", quality=95)
+
+        # 上半身矩形遮罩
+        mask = np.zeros((height, width), dtype=np.uint8)
+        top = int(rng.integers(height // 8, height // 4))
+        left = int(rng.integers(width // 8, width // 4))
+        mask[top:top + height // 2, left:width - left] = 255
+        Image.fromarray(mask).save(test_dir / 'agnostic-mask' / f"{stem}_mask.png")
+
+        # densepose：以色塊表示身體部位
+        densepose = np.zeros((height, width, 3), dtype=np.uint8)
+        for _ in range(6):
+            y0, x0 = int(rng.integers(0, height // 2)), int(rng.integers(0, width // 2))
+            densepose[y0:y0 + height // 3, x0:x0 + width // 3] = rng.integers(0, 255, 3)
+        Image.fromarray(densepose).save(test_dir / 'image-densepose' / f"{stem}.jpg", quality=95)
+
+        generated = image.astype(np.int16)
+        region = mask > 127
+        generated[region] += rng.integers(-20, 20, (int(region.sum()), 3), dtype=np.int16)
+        Image.fromarray(np.clip(generated, 0, 255).astype(np.uint8)).save(
+            gen_dir / f"{stem}.jpg", quality=95)
+
+    with open(data_root / 'test_pairs.txt', 'w') as f:
+        for stem in stems:
+            f.write(f"{stem}.jpg {stem}.jpg\n")
+    with open(data_root / 'test_unpairs.txt', 'w') as f:
+        for index, stem in enumerate(stems):
+            f.write(f"{stem}.jpg {stems[(index + 1) % len(stems)]}.jpg\n")
+    return data_root
+
+def run_command(command, cwd):
+    """執行子程序，回傳 (耗時秒數, peak RSS MB)；失敗時拋出 RuntimeError"""
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.stdout.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError(f"{' '.join(map(str, command))} 執行失敗：\n"
+                           f"{output.decode(errors='replace')[-2000:]}")
+    # Linux 的 ru_maxrss 單位為 KB
+    return elapsed, usage.ru_maxrss / 1024
+
+def benchmark_commands(workdir, num_images, device):
+    """回傳 {名稱: (命令, 每次執行處理的項目數)}"""
+    data_root = Path(workdir) / 'data' / 'zalando-hd-resized'
+    fine = data_root / 'test_fine'
+    gen_dir = Path(workdir) / 'outputs' / 'paired'
+    eval_args = [
+        '--gen_dir', str(gen_dir), '--real_dir', str(fine / 'image'),
+        '--mask_dir', str(fine / 'agnostic-mask'), '--pairs_file', str(data_root / 'test_pairs.txt'),
+        '--device', device, '--batch_size', '8', '--kid_subset_size', str(min(num_images, 1000)),
+        '--feature_cache_dir', str(Path(workdir) / 'cache'),
+        # 縮放快取會在暖身執行時填滿，停用後每次都量測完整的解碼；
+        # 參考集特徵快取則刻意保持暖快取，只量測生成圖片的處理
+        '--no_resize_cache'
+    ]
+    # test/ 的檔案複製為 test_fine/ 與 test_coarse/
+    num_files = num_images * len(DATASET_SUBDIRS) * 2
+    python = sys.executable
+    return {
+        'prepare_dataset': (
+            [python, str(REPO_ROOT / 'prepare_dataset.py'), 'copy', '--clean'], num_files
+        ),
+        'check_dataset': (
+            [python, str(REPO_ROOT / 'tools' / 'check_dataset.py'), str(data_root)], num_files
+        ),
+        'eval_masked_lpips': (
+            [python, str(REPO_ROOT / 'tools' / 'eval.py'), '--mode', 'masked_lpips', *eval_args],
+            num_images
+        ),
+        'eval_all': (
+            [python, str(REPO_ROOT / 'tools' / 'eval.py'), '--mode', 'all', *eval_args],
+            num_images
+        )
+    }
+
+def summarize_runs(runs, items):
+    """由各次執行的耗時與 peak RSS 計算統計量
+
+    每次執行是一個完整程序，次數不多，只報告最小值、中位數、平均與最大值。
+    """
+    latencies = np.array([elapsed for elapsed, _ in runs])
+    return {
+        'items': items,
+        'runs': len(runs),
+        'latency_min': float(latencies.min()),
+        'latency_median': float(np.median(latencies)),
+        'latency_mean': float(latencies.mean()),
+        'latency_max': float(latencies.max()),
+        'throughput': float(items / np.median(latencies)),
+        'peak_rss_mb': float(max(rss for _, rss in runs))
+    }
+
+def run_benchmarks(workdir, names, num_images, device, repeat=3, warmup=1):
+    """依序執行基準測試，回傳 {名稱: 統計量}
+
+    prepare_dataset 必須先執行，check_dataset 與 eval 使用它建立的 test_fine/。
+    暖身執行（模型下載、參考集特徵快取建立）不計入統計；eval 停用縮放快取，
+    每次執行都重新解碼圖片。
+    """
+    commands = benchmark_commands(workdir, num_images, device)
+    results = {}
+    for name in commands:
+        if name not in names and name != 'prepare_dataset':
+            continue
+        command, items = commands[name]
+        for _ in range(warmup):
+            run_command(command, workdir)
+        runs = [run_command(command, workdir) for _ in range(repeat)]
+        if name in names:
+            results[name] = summarize_runs(runs, items)
+            print(f"{name:20s} {results[name]['throughput']:9.2f} 項/秒  "
+                  f"min {results[name]['latency_min']:7.3f}s  "
+                  f"median {results[name]['latency_median']:7.3f}s  "
+                  f"max {results[name]['latency_max']:7.3f}s  "
+                  f"peak RSS {results[name]['peak_rss_mb']:8.1f} MB")
+    return results
+
+def compare_with_baseline(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """與基準比較，回傳退步項目的說明列表（空列表表示通過）"""
+    regressions = []
+    for name, current in results.items():
+        reference = baseline.get('benchmarks', {}).get(name)
+        if reference is None:
+            print(f"⚠️  基準中沒有 {name}，略過比較")
+            continue
+        throughput_ratio = current['throughput'] / reference['throughput']
+        rss_ratio = current['peak_rss_mb'] / reference['peak_rss_mb']
+        print(f"{name:20s} 吞吐量 {throughput_ratio:6.1%}  peak RSS {rss_ratio:6.1%}（相對基準）")
+        if throughput_ratio < 1 - threshold:
+            regressions.append(f"{name} 吞吐量下降 {1 - throughput_ratio:.1%}")
+        if rss_ratio > 1 + threshold:
+            regressions.append(f"{name} peak RSS 增加 {rss_ratio - 1:.1%}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='tools/ 與資料集腳本的效能基準測試')
+    parser.add_argument('--benchmarks', nargs='+',
+                       default=['prepare_dataset', 'check_dataset', 'eval_masked_lpips', 'eval_all'],
+                       choices=['prepare_dataset', 'check_dataset', 'eval_masked_lpips', 'eval_all'],
+                       help='要執行的基準測試')
+    parser.add_argument('--num_images', type=int, default=32, help='合成資料集的圖片數量')
+    parser.add_argument('--width', type=int, default=768, help='合成圖片寬度')
+    parser.add_argument('--height', type=int, default=1024, help='合成圖片高度')
+    parser.add_argument('--seed', type=int, default=0, help='合成資料集的亂數種子')
+    parser.add_argument('--repeat', type=int, default=3, help='每個基準測試的執行次數')
+    parser.add_argument('--warmup', type=int, default=1, help='不計入統計的暖身執行次數')
+    parser.add_argument('--device', default='cpu', help='tools/eval.py 的計算裝置')
+    parser.add_argument('--workdir', help='合成資料集目錄（預設使用暫存目錄，結束後刪除）')
+    parser.add_argument('--output', help='將本次結果寫入 JSON 檔')
+    parser.add_argument('--baseline', help='與 JSON 基準比較，退步超過門檻時以狀態 1 結束')
+    parser.add_argument('--save_baseline', help='將本次結果寫為新的 JSON 基準')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                       help='允許的退步比例（預設 0.10）')
+
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='vto-bench-')
+    config = {
+        'num_images': args.num_images, 'width': args.width, 'height': args.height,
+        'seed': args.seed, 'repeat': args.repeat, 'device': args.device
+    }
+
+    try:
+        print(f"產生合成資料集（{args.num_images} 張 {args.width}×{args.height}）：{workdir}")
+        generate_dataset(workdir, args.num_images, args.width, args.height, args.seed)
+        results = run_benchmarks(workdir, args.benchmarks, args.num_images, args.device,
+                                 args.repeat, args.warmup)
+    except RuntimeError as e:
+        print(f"基準測試失敗：{e}")
+        sys.exit(1)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'config': config,
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count()
+        },
+        'benchmarks': results
+    }
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
+            print(f"結果已寫入 {path}")
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline.get('config') != config:
+            print("⚠️  基準的資料集設定與本次不同，比較結果僅供參考")
+        regressions = compare_with_baseline(results, baseline, args.threshold)
+        if regressions:
+            print("\n❌ 效能退步：")
+            for item in regressions:
+                print(f"  {item}")
+            sys.exit(1)
+        print("\n✅ 沒有超過門檻的效能退步")
+
+if __name__ == "__main__":
+    main()
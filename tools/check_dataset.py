@@ -5,55 +5,108 @@
 
 import os
 import sys
+import argparse
+import hashlib
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from pathlib import Path
 
-def check_directory_structure(data_root):
+import dataset_io
+
+TEST_DIRS = ('test_fine', 'test_coarse')
+REQUIRED_SUBDIRS = ('image', 'image-densepose', 'agnostic-mask', 'cloth')
+PAIR_FILES = ('test_pairs.txt', 'test_unpairs.txt')
+
+# 配對檔中每個欄位需要的檔案：(子目錄, 使用人物或衣服主幹, 檔名後綴)
+PAIR_REQUIREMENTS = (
+    ('image', 'person', ''),
+    ('image-densepose', 'person', ''),
+    ('agnostic-mask', 'person', '_mask'),
+    ('cloth', 'cloth', '')
+)
+
+# 資料集內容清單（manifest）預設檔名，位於資料集根目錄
+MANIFEST_NAME = '.manifest.json'
+MANIFEST_VERSION = 1
+HASH_CHUNK_SIZE = 1 << 20
+
+# --verify-images：VITON-HD (zalando-hd-resized) 的預期解析度與各子目錄允許的通道數
+DEFAULT_IMAGE_SIZE = (768, 1024)
+EXPECTED_CHANNELS = {
+    'image': (3,),
+    'image-densepose': (3,),
+    'agnostic-mask': (1, 3),
+    'cloth': (3,)
+}
+VERIFY_CACHE_NAME = '.verify_cache.json'
+
+def scan_directory(directory):
+    """以單次目錄掃描建立 {檔名主幹: 檔名}，目錄不存在時回傳 None（directory 可為 zip 內的目錄）"""
+    try:
+        return {os.path.splitext(name)[0]: name for name, _ in dataset_io.list_files(directory)}
+    except FileNotFoundError:
+        return None
+
+def scan_dataset(data_root, max_workers=8):
+    """並行掃描所有 split 的子目錄，回傳 {(split, 子目錄): {主幹: 檔名} 或 None}"""
+    data_path = Path(data_root)
+    keys = [(test_dir, subdir) for test_dir in TEST_DIRS for subdir in REQUIRED_SUBDIRS]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(lambda key: scan_directory(data_path / key[0] / key[1]), keys)
+        return dict(zip(keys, results))
+
+def read_pairs(pair_path):
+    """讀取配對檔，回傳 (人物主幹, 衣服主幹) 列表"""
+    pairs = []
+    for line in dataset_io.read_bytes(pair_path).decode().splitlines():
+        parts = line.split()
+        if len(parts) >= 2:
+            pairs.append((os.path.splitext(parts[0])[0], os.path.splitext(parts[1])[0]))
+    return pairs
+
+def check_directory_structure(data_root, scan=None):
     """檢查目錄結構"""
     data_path = Path(data_root)
     
-    if not data_path.exists():
+    if not dataset_io.exists(data_path):
         print(f"錯誤：資料集根目錄不存在 {data_root}")
         return False
     
     print(f"檢查資料集：{data_root}")
     print("=" * 50)
     
-    # 檢查主要測試目錄
-    test_dirs = ['test_fine', 'test_coarse']
-    required_subdirs = ['image', 'image-densepose', 'agnostic-mask', 'cloth']
+    if scan is None:
+        scan = scan_dataset(data_root)
     
     missing_items = []
     existing_items = []
     
-    for test_dir in test_dirs:
+    for test_dir in TEST_DIRS:
         test_path = data_path / test_dir
-        if not test_path.exists():
+        if not dataset_io.isdir(test_path):
             missing_items.append(f"目錄：{test_dir}/")
             continue
         
         existing_items.append(f"✓ 目錄：{test_dir}/")
         
         # 檢查子目錄
-        for subdir in required_subdirs:
-            subdir_path = test_path / subdir
-            if not subdir_path.exists():
+        for subdir in REQUIRED_SUBDIRS:
+            files = scan[(test_dir, subdir)]
+            if files is None:
                 missing_items.append(f"  - {test_dir}/{subdir}/")
             else:
-                # 計算檔案數量
-                file_count = len(list(subdir_path.glob('*')))
-                existing_items.append(f"  ✓ {test_dir}/{subdir}/ ({file_count} 檔案)")
+                existing_items.append(f"  ✓ {test_dir}/{subdir}/ ({len(files)} 檔案)")
     
     # 檢查配對檔案
-    pair_files = ['test_pairs.txt', 'test_unpairs.txt']
-    for pair_file in pair_files:
+    for pair_file in PAIR_FILES:
         pair_path = data_path / pair_file
-        if not pair_path.exists():
+        if not dataset_io.exists(pair_path):
             missing_items.append(f"檔案：{pair_file}")
         else:
             # 計算行數
             try:
-                with open(pair_path, 'r') as f:
-                    line_count = sum(1 for _ in f)
+                line_count = len(dataset_io.read_bytes(pair_path).decode().splitlines())
                 existing_items.append(f"✓ 檔案：{pair_file} ({line_count} 行)")
             except Exception as e:
                 existing_items.append(f"✓ 檔案：{pair_file} (無法讀取行數)")
@@ -72,30 +125,362 @@ def check_directory_structure(data_root):
         print("\n🎉 資料集結構完整！")
         return True
 
+def check_pairs(data_root, scan, limit=5):
+    """以配對檔交叉驗證每個 split 的圖片、衣服、遮罩與 densepose
+    
+    每筆配對以集合查詢檢查所需檔案是否存在；沒有被任何配對檔引用的檔案列為孤立檔案。
+    有缺失檔案時回傳 False，孤立檔案只提出警告。
+    """
+    data_path = Path(data_root)
+    pairs = []
+    for pair_file in PAIR_FILES:
+        pair_path = data_path / pair_file
+        if dataset_io.exists(pair_path):
+            pairs.extend((pair_file, person, cloth) for person, cloth in read_pairs(pair_path))
+    if not pairs:
+        return True
+    
+    referenced = {
+        'person': {person for _, person, _ in pairs},
+        'cloth': {cloth for _, _, cloth in pairs}
+    }
+    
+    def examples(items):
+        items = sorted(items)
+        suffix = f" …（共 {len(items)} 個）" if len(items) > limit else ""
+        return ", ".join(items[:limit]) + suffix
+    
+    print("\n配對檔交叉驗證：")
+    success = True
+    for test_dir in TEST_DIRS:
+        for subdir, field, suffix in PAIR_REQUIREMENTS:
+            files = scan[(test_dir, subdir)]
+            if files is None:
+                continue
+            
+            missing = {}
+            for pair_file, person, cloth in pairs:
+                stem = (person if field == 'person' else cloth) + suffix
+                if stem not in files:
+                    missing.setdefault(pair_file, set()).add(stem)
+            
+            expected = {stem + suffix for stem in referenced[field]}
+            orphans = [files[stem] for stem in files.keys() - expected]
+            
+            if missing:
+                success = False
+                for pair_file, stems in missing.items():
+                    print(f"  ❌ {test_dir}/{subdir}/ 缺少 {pair_file} 需要的 {len(stems)} 個檔案："
+                          f"{examples(stems)}")
+            if orphans:
+                print(f"  ⚠️  {test_dir}/{subdir}/ 有 {len(orphans)} 個未被配對檔引用的檔案："
+                      f"{examples(orphans)}")
+            if not missing and not orphans:
+                print(f"  ✓ {test_dir}/{subdir}/")
+    
+    return success
+
+def walk_files(root, exclude=()):
+    """遞迴列出 root 下所有檔案，回傳 {相對路徑: (大小, 修改時間 ns)}"""
+    files = {}
+    stack = [str(root)]
+    while stack:
+        directory = stack.pop()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file():
+                    rel_path = os.path.relpath(entry.path, root).replace(os.sep, '/')
+                    if rel_path not in exclude:
+                        stat = entry.stat()
+                        files[rel_path] = (stat.st_size, stat.st_mtime_ns)
+    return files
+
+def hash_file(path):
+    """以 SHA-1 計算檔案內容雜湊"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def hash_files(root, rel_paths, workers=None):
+    """以程序池計算多個檔案的雜湊，回傳 {相對路徑: 雜湊}"""
+    paths = [os.path.join(root, rel_path) for rel_path in rel_paths]
+    if len(paths) <= 1 or workers == 1:
+        return dict(zip(rel_paths, map(hash_file, paths)))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(rel_paths, executor.map(hash_file, paths, chunksize=16)))
+
+def save_manifest(manifest_path, files):
+    """寫出 manifest（先寫入暫存檔再取代，避免中斷時留下不完整的檔案）
+    
+    無法寫入（例如唯讀的資料集目錄）時顯示警告並回傳 False。
+    """
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'algorithm': 'sha1',
+        'files': {rel_path: list(entry) for rel_path, entry in sorted(files.items())}
+    }
+    tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, manifest_path)
+    except OSError as e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        print(f"  ⚠️  無法寫入內容清單 {manifest_path}：{e}")
+        print(f"     請以 --manifest <可寫入的路徑> 指定內容清單位置（例如 /kaggle/working/manifest.json）")
+        return False
+    return True
+
+def check_manifest(data_root, manifest_path=None, update=False, workers=None):
+    """以內容清單增量驗證資料集
+    
+    manifest 記錄每個檔案的 (大小, 修改時間, SHA-1)。不存在時雜湊所有檔案並建立；
+    存在時只重新雜湊大小或修改時間改變的檔案與新檔案，其餘直接信任。
+    內容改變或遺失的檔案視為失敗；update 為 True 時改為接受目前的內容並更新 manifest。
+    """
+    root = Path(data_root)
+    manifest_path = Path(manifest_path) if manifest_path else root / MANIFEST_NAME
+    # 解碼驗證快取每次執行都會改變，不列入清單
+    exclude = {VERIFY_CACHE_NAME}
+    if manifest_path.resolve().parent == root.resolve():
+        exclude.add(manifest_path.name)
+    
+    current = walk_files(root, exclude)
+    print(f"\n內容清單驗證：{manifest_path}")
+    
+    if not manifest_path.exists():
+        hashes = hash_files(root, list(current), workers)
+        if save_manifest(manifest_path, {rel_path: (*stat, hashes[rel_path])
+                                         for rel_path, stat in current.items()}):
+            print(f"  ✓ 已建立內容清單（{len(current)} 個檔案）")
+        return True
+    
+    with open(manifest_path, 'r') as f:
+        recorded = {rel_path: tuple(entry) for rel_path, entry in json.load(f)['files'].items()}
+    
+    changed = [rel_path for rel_path, stat in current.items()
+               if rel_path in recorded and recorded[rel_path][:2] != stat]
+    added = [rel_path for rel_path in current if rel_path not in recorded]
+    removed = [rel_path for rel_path in recorded if rel_path not in current]
+    hashes = hash_files(root, changed + added, workers)
+    modified = [rel_path for rel_path in changed if hashes[rel_path] != recorded[rel_path][2]]
+    
+    print(f"  大小與修改時間未變而直接信任 {len(current) - len(changed) - len(added)} 個檔案，"
+          f"重新雜湊 {len(changed) + len(added)} 個")
+    for label, items in (('內容已改變', modified), ('已遺失', removed), ('新增', added)):
+        if items:
+            icon = '⚠️ ' if label == '新增' else '❌'
+            shown = ", ".join(sorted(items)[:5]) + (" …" if len(items) > 5 else "")
+            print(f"  {icon} {label} {len(items)} 個檔案：{shown}")
+    
+    # 只有修改時間改變、內容相同的檔案更新時間戳記，下次即可直接信任
+    entries = dict(recorded)
+    for rel_path in changed:
+        if update or rel_path not in modified:
+            entries[rel_path] = (*current[rel_path], hashes[rel_path])
+    if update:
+        for rel_path in added:
+            entries[rel_path] = (*current[rel_path], hashes[rel_path])
+        for rel_path in removed:
+            del entries[rel_path]
+    if entries != recorded:
+        if save_manifest(manifest_path, entries):
+            if update:
+                print("  ✓ 已更新內容清單")
+        elif update:
+            return False
+    
+    if update or not (modified or removed):
+        print("  ✓ 內容與清單一致")
+        return True
+    return False
+
+def check_zip_crc(data_root, limit=5):
+    """zip 資料集以封存檔內建的 CRC-32 代替內容清單，驗證 data_root 下所有成員"""
+    print(f"\n內容驗證：{data_root}（zip 內建 CRC-32）")
+    checked, failures = dataset_io.verify_crc(data_root)
+    for inner, error in failures[:limit]:
+        print(f"  ❌ {inner}：{error}")
+    if len(failures) > limit:
+        print(f"     …（共 {len(failures)} 個）")
+    if not failures:
+        print(f"  ✓ {checked} 個成員的 CRC-32 皆正確")
+    return not failures
+
+def verify_image(task):
+    """完整解碼一張圖片並檢查解析度與通道數，回傳錯誤訊息（通過時為 None）"""
+    path, expected_size, channels = task
+    try:
+        with dataset_io.open_image(path) as img:
+            img.load()
+            if expected_size and img.size != tuple(expected_size):
+                return f"解析度 {img.size[0]}×{img.size[1]}，預期 {expected_size[0]}×{expected_size[1]}"
+            if len(img.getbands()) not in channels:
+                return f"通道數 {len(img.getbands())}，預期 {'/'.join(map(str, channels))}"
+    except Exception as e:
+        return f"無法解碼：{e}"
+    return None
+
+def verify_images(data_root, scan, expected_size=DEFAULT_IMAGE_SIZE, workers=None, limit=5,
+                  cache_path=None):
+    """以程序池完整解碼所有 split 的圖片、遮罩與 densepose，檢查解析度與通道數
+    
+    結果以 (大小, 修改時間) 為指紋快取於 cache_path（預設為 <data_root>/.verify_cache.json），
+    重新執行時略過指紋未變的檔案；檢查條件改變時快取失效。cache_path 為空字串時停用快取；
+    zip 資料集未指定 cache_path 時無法寫入快取，每次完整解碼。快取寫入失敗（例如唯讀的資料集目錄）只顯示警告。
+    """
+    root = Path(data_root)
+    if cache_path is None:
+        use_cache = dataset_io.split_zip_path(root) is None
+        cache_path = root / VERIFY_CACHE_NAME
+    else:
+        use_cache = cache_path != ''
+        cache_path = Path(cache_path)
+    checks = {'size': list(expected_size) if expected_size else None,
+              'channels': {subdir: list(channels) for subdir, channels in EXPECTED_CHANNELS.items()}}
+    cache = {}
+    if use_cache and cache_path.exists():
+        with open(cache_path, 'r') as f:
+            cached = json.load(f)
+        if cached.get('checks') == checks:
+            cache = cached['files']
+    
+    files = {}
+    tasks = []
+    for (test_dir, subdir), names in scan.items():
+        if names is None:
+            continue
+        for name in names.values():
+            rel_path = f"{test_dir}/{subdir}/{name}"
+            files[rel_path] = list(dataset_io.file_stat(root / rel_path))
+            entry = cache.get(rel_path)
+            if entry is None or entry[:2] != files[rel_path]:
+                tasks.append((rel_path, (str(root / rel_path), expected_size, EXPECTED_CHANNELS[subdir])))
+    
+    print(f"\n圖片解碼驗證：{len(files)} 個檔案，{len(files) - len(tasks)} 個已在快取中驗證過")
+    if tasks:
+        task_args = [task for _, task in tasks]
+        if workers == 1 or len(tasks) == 1:
+            results = map(verify_image, task_args)
+            for (rel_path, _), error in zip(tasks, results):
+                cache[rel_path] = [*files[rel_path], error]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = executor.map(verify_image, task_args, chunksize=32)
+                for (rel_path, _), error in zip(tasks, results):
+                    cache[rel_path] = [*files[rel_path], error]
+    
+    cache = {rel_path: cache[rel_path] for rel_path in files}
+    if use_cache:
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'checks': checks, 'files': cache}, f)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            print(f"  ⚠️  無法寫入解碼驗證快取 {cache_path}：{e}（可用 --verify-cache 指定可寫入的路徑）")
+    
+    failures = {}
+    for rel_path, (_, _, error) in sorted(cache.items()):
+        if error is not None:
+            failures.setdefault(rel_path.rsplit('/', 1)[0], []).append((rel_path, error))
+    for directory, items in failures.items():
+        print(f"  ❌ {directory}/ 有 {len(items)} 個檔案未通過：")
+        for rel_path, error in items[:limit]:
+            print(f"     {rel_path.rsplit('/', 1)[1]}：{error}")
+        if len(items) > limit:
+            print(f"     …")
+    if not failures:
+        print("  ✓ 所有圖片皆可完整解碼，解析度與通道數正確")
+    return not failures
+
+def parse_size(value):
+    """解析 --expected-size 參數（寬x高，any 表示不檢查解析度）"""
+    if value == 'any':
+        return None
+    try:
+        width, height = (int(part) for part in value.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"解析度格式應為 寬x高：{value}")
+    return width, height
+
+def print_expected_structure():
+    print("\n請確保資料集包含以下結構：")
+    print("zalando-hd-resized/")
+    print("├── test_fine/")
+    print("│   ├── image/")
+    print("│   ├── image-densepose/")
+    print("│   ├── agnostic-mask/")
+    print("│   └── cloth/")
+    print("├── test_coarse/")
+    print("│   ├── image/")
+    print("│   ├── image-densepose/")
+    print("│   ├── agnostic-mask/")
+    print("│   └── cloth/")
+    print("├── test_pairs.txt")
+    print("└── test_unpairs.txt")
+
 def main():
-    if len(sys.argv) != 2:
-        print("使用方法：python check_dataset.py <DATA/zalando-hd-resized路徑>")
-        print("範例：python check_dataset.py data/zalando-hd-resized")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(
+        description='檢查 VITON-HD 資料集完整性',
+        epilog='範例：python check_dataset.py data/zalando-hd-resized'
+    )
+    parser.add_argument('data_root', help='DATA/zalando-hd-resized 路徑（也可以是 zip 檔或 zip 內的目錄）')
+    parser.add_argument('--workers', type=int, default=8, help='並行掃描目錄的執行緒數')
+    parser.add_argument('--manifest', nargs='?', const='', default=None,
+                       help=f'以內容清單增量驗證檔案內容（預設為 <data_root>/{MANIFEST_NAME}，'
+                            f'不存在時建立）')
+    parser.add_argument('--update-manifest', action='store_true',
+                       help='接受目前的檔案內容並更新內容清單')
+    parser.add_argument('--hash-workers', type=int, default=None,
+                       help='計算雜湊的程序數（預設為 CPU 核心數）')
+    parser.add_argument('--verify-images', action='store_true',
+                       help='以程序池完整解碼所有圖片，檢查截斷檔案、解析度與通道數')
+    parser.add_argument('--expected-size', type=parse_size, default=DEFAULT_IMAGE_SIZE,
+                       help='--verify-images 的預期解析度（寬x高，預設 768x1024；any 表示不檢查）')
+    parser.add_argument('--decode-workers', type=int, default=None,
+                       help='解碼驗證的程序數（預設為 CPU 核心數）')
+    parser.add_argument('--verify-cache', default=None,
+                       help=f'--verify-images 的快取路徑（預設為 <data_root>/{VERIFY_CACHE_NAME}；'
+                            f'資料集目錄唯讀時請指定可寫入的路徑，空字串表示停用快取）')
+    
+    args = parser.parse_args()
+    
+    start = time.perf_counter()
+    scan = scan_dataset(args.data_root, args.workers) if dataset_io.exists(args.data_root) else None
+    structure_ok = check_directory_structure(args.data_root, scan)
+    pairs_ok = True
+    if scan is not None:
+        pairs_ok = check_pairs(args.data_root, scan)
+        print(f"\n掃描與驗證耗時 {time.perf_counter() - start:.3f} 秒")
+    
+    manifest_ok = True
+    if scan is not None and (args.manifest is not None or args.update_manifest):
+        start = time.perf_counter()
+        if dataset_io.split_zip_path(args.data_root) is None:
+            manifest_ok = check_manifest(args.data_root, args.manifest or None,
+                                         args.update_manifest, args.hash_workers)
+        else:
+            manifest_ok = check_zip_crc(args.data_root)
+        print(f"  內容清單驗證耗時 {time.perf_counter() - start:.3f} 秒")
+    
+    images_ok = True
+    if scan is not None and args.verify_images:
+        start = time.perf_counter()
+        images_ok = verify_images(args.data_root, scan, args.expected_size, args.decode_workers,
+                                  cache_path=args.verify_cache)
+        print(f"  解碼驗證耗時 {time.perf_counter() - start:.3f} 秒")
     
-    data_root = sys.argv[1]
-    success = check_directory_structure(data_root)
-    
-    if not success:
-        print("\n請確保資料集包含以下結構：")
-        print("zalando-hd-resized/")
-        print("├── test_fine/")
-        print("│   ├── image/")
-        print("│   ├── image-densepose/")
-        print("│   ├── agnostic-mask/")
-        print("│   └── cloth/")
-        print("├── test_coarse/")
-        print("│   ├── image/")
-        print("│   ├── image-densepose/")
-        print("│   ├── agnostic-mask/")
-        print("│   └── cloth/")
-        print("├── test_pairs.txt")
-        print("└── test_unpairs.txt")
+    if not structure_ok:
+        print_expected_structure()
+    if not (structure_ok and pairs_ok and manifest_ok and images_ok):
         sys.exit(1)
 
 if __name__ == "__main__":
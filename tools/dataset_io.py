@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+資料集存取層：一般目錄或 zip 封存檔
+
+路徑可以是目錄、zip 檔，或 zip 內的子目錄（例如 viton_hd_test.zip/test/image）。
+zip 以中央目錄建立一次索引，成員直接自封存檔讀取，不需要解壓。
+每個程序各自開啟 zip 檔案控制代碼，可用於 DataLoader 多程序 worker。
+以 tools/packed_store.py 打包的目錄（<名稱>.pack）也視為目錄，成員以記憶體映射的陣列讀取。
+numpy 與 OpenCV 只在讀取陣列與解碼圖片時才匯入，只檢查檔案的腳本不需要安裝。
+"""
+
+import io
+import os
+import time
+import zipfile
+import zlib
+from functools import lru_cache
+
+import packed_store
+
+ZIP_SUFFIX = '.zip'
+
+@lru_cache(maxsize=None)
+def is_archive(path):
+    return os.path.isfile(path) and zipfile.is_zipfile(path)
+
+def split_zip_path(path):
+    """將路徑拆成 (zip 檔, zip 內路徑)；不在 zip 內時回傳 None"""
+    path = os.fspath(path)
+    lower = path.lower()
+    start = 0
+    while True:
+        index = lower.find(ZIP_SUFFIX, start)
+        if index < 0:
+            return None
+        end = index + len(ZIP_SUFFIX)
+        if end == len(path) or path[end] in ('/', os.sep):
+            archive = path[:end]
+            if is_archive(archive):
+                return archive, path[end + 1:].replace(os.sep, '/').strip('/')
+        start = end
+
+class ZipIndex:
+    """zip 中央目錄索引：{目錄: {名稱: ZipInfo}}，目錄以 '/' 分隔，根目錄為 ''"""
+
+    def __init__(self, archive):
+        self.archive = archive
+        self.handle = zipfile.ZipFile(archive, 'r')
+        self.files = {}
+        self.dirs = {''}
+        for info in self.handle.infolist():
+            name = info.filename.rstrip('/')
+            parent, _, base = name.rpartition('/')
+            parts = name.split('/')
+            for depth in range(1, len(parts)):
+                self.dirs.add('/'.join(parts[:depth]))
+            if info.is_dir():
+                self.dirs.add(name)
+            else:
+                self.files.setdefault(parent, {})[base] = info
+
+    def info(self, inner):
+        parent, _, base = inner.rpartition('/')
+        return self.files.get(parent, {}).get(base)
+
+    def read(self, inner):
+        info = self.info(inner)
+        if info is None:
+            raise FileNotFoundError(f"{self.archive} 中沒有 {inner}")
+        return self.handle.read(info)
+
+@lru_cache(maxsize=None)
+def _zip_index(archive, pid):
+    return ZipIndex(archive)
+
+def zip_index(archive):
+    """取得目前程序的 zip 索引（fork 後的 worker 會重新開啟檔案）"""
+    return _zip_index(archive, os.getpid())
+
+def load_array(path):
+    """打包目錄的成員回傳 uint8 陣列（rgb 與 gray 為記憶體映射的視圖），其他路徑回傳 None"""
+    location = packed_store.split_pack_path(path)
+    if location is None or not location[1]:
+        return None
+    root, name = location
+    return packed_store.open_store(root).array(name)
+
+def exists(path):
+    """路徑（目錄、檔案、zip 成員或打包成員）是否存在"""
+    pack = packed_store.split_pack_path(path)
+    if pack is not None:
+        return not pack[1] or pack[1] in packed_store.open_store(pack[0])
+    location = split_zip_path(path)
+    if location is None:
+        return os.path.exists(path)
+    archive, inner = location
+    index = zip_index(archive)
+    return inner in index.dirs or index.info(inner) is not None
+
+def isdir(path):
+    """路徑是否為目錄（zip 檔本身、zip 內的目錄與打包目錄也視為目錄）"""
+    pack = packed_store.split_pack_path(path)
+    if pack is not None:
+        return not pack[1]
+    location = split_zip_path(path)
+    if location is None:
+        return os.path.isdir(path)
+    archive, inner = location
+    return inner in zip_index(archive).dirs
+
+def list_files(directory):
+    """列出目錄中的檔案，回傳 [(檔名, 路徑)]；目錄不存在時拋出 FileNotFoundError"""
+    if packed_store.is_pack(directory):
+        return [(name, os.path.join(os.fspath(directory), name))
+                for name in packed_store.open_store(os.fspath(directory)).names]
+    location = split_zip_path(directory)
+    if location is None:
+        with os.scandir(directory) as entries:
+            return [(entry.name, entry.path) for entry in entries if entry.is_file()]
+    archive, inner = location
+    index = zip_index(archive)
+    if inner not in index.dirs:
+        raise FileNotFoundError(f"{archive} 中沒有目錄 {inner}")
+    return [(name, os.path.join(os.fspath(directory), name))
+            for name in index.files.get(inner, {})]
+
+def file_stat(path):
+    """回傳 (大小, 修改時間 ns)；zip 成員使用中央目錄記錄的大小與時間，打包成員使用陣列大小與打包時間"""
+    pack = packed_store.split_pack_path(path)
+    if pack is not None:
+        store = packed_store.open_store(pack[0])
+        return store.raw(pack[1]).nbytes, store.mtime_ns
+    location = split_zip_path(path)
+    if location is None:
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns
+    archive, inner = location
+    info = zip_index(archive).info(inner)
+    if info is None:
+        raise FileNotFoundError(f"{archive} 中沒有 {inner}")
+    return info.file_size, int(time.mktime(info.date_time + (0, 0, -1))) * 1_000_000_000
+
+def read_bytes(path):
+    """讀取整個檔案（打包成員為陣列的原始位元組）"""
+    array = load_array(path)
+    if array is not None:
+        return array.tobytes()
+    location = split_zip_path(path)
+    if location is None:
+        with open(path, 'rb') as f:
+            return f.read()
+    return zip_index(location[0]).read(location[1])
+
+def open_file(path):
+    """以二進位模式開啟檔案；zip 與打包成員回傳記憶體中的檔案物件"""
+    array = load_array(path)
+    if array is not None:
+        return io.BytesIO(array.tobytes())
+    location = split_zip_path(path)
+    if location is None:
+        return open(path, 'rb')
+    return io.BytesIO(zip_index(location[0]).read(location[1]))
+
+def open_image(path):
+    """以 PIL 開啟圖片"""
+    from PIL import Image, UnidentifiedImageError
+
+    array = load_array(path)
+    if array is not None:
+        return Image.fromarray(array)
+    location = split_zip_path(path)
+    if location is None:
+        return Image.open(path)
+    try:
+        return Image.open(io.BytesIO(zip_index(location[0]).read(location[1])))
+    except UnidentifiedImageError:
+        raise UnidentifiedImageError(f"cannot identify image file {os.fspath(path)!r}") from None
+
+def imread(path, flags):
+    """以 OpenCV 讀取圖片，讀取失敗時回傳 None（與 cv2.imread 相同）
+
+    打包成員不經過解碼，IMREAD_REDUCED_* 旗標以原始解析度回傳。
+    """
+    import cv2
+    import numpy as np
+
+    if packed_store.split_pack_path(path) is not None:
+        try:
+            array = load_array(path)
+        except FileNotFoundError:
+            return None
+        grayscale = flags in (cv2.IMREAD_GRAYSCALE, cv2.IMREAD_REDUCED_GRAYSCALE_2,
+                              cv2.IMREAD_REDUCED_GRAYSCALE_4, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+        if array.ndim == 2:
+            return array if grayscale else cv2.cvtColor(array, cv2.COLOR_GRAY2BGR)
+        return cv2.cvtColor(array, cv2.COLOR_RGB2GRAY if grayscale else cv2.COLOR_RGB2BGR)
+    location = split_zip_path(path)
+    if location is None:
+        return cv2.imread(os.fspath(path), flags)
+    try:
+        data = zip_index(location[0]).read(location[1])
+    except (FileNotFoundError, zipfile.BadZipFile, zlib.error):
+        return None
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+
+def verify_crc(path):
+    """讀取 zip 內 path 底下的所有成員並比對 CRC-32，回傳 (成員數, [(成員, 錯誤)])"""
+    archive, inner = split_zip_path(path)
+    index = zip_index(archive)
+    prefix = f"{inner}/" if inner else ''
+    checked = 0
+    failures = []
+    for info in index.handle.infolist():
+        if info.is_dir() or not info.filename.startswith(prefix):
+            continue
+        checked += 1
+        try:
+            with index.handle.open(info) as f:
+                while f.read(1 << 20):
+                    pass
+        except (zipfile.BadZipFile, zlib.error, EOFError) as e:
+            failures.append((info.filename, str(e)))
+    return checked, failures
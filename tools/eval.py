@@ -6,152 +6,2223 @@
 
 import os
 import sys
+import copy
 import argparse
+import hashlib
+import inspect
+import json
+import csv
+import heapq
+import struct
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import torch
 import torch.nn.functional as F
 from pathlib import Path
 from PIL import Image
+from torch.utils.data import Dataset, DataLoader
 import lpips
-from torch_fidelity import calculate_metrics
+import torch_fidelity
+from torch_fidelity.datasets import ImagesPathDataset
+from torch_fidelity.feature_extractor_inceptionv3 import FeatureExtractorInceptionV3
+from torch_fidelity.metric_fid import fid_features_to_statistics, fid_statistics_to_metric
+from torch_fidelity.metric_kid import kid_features_to_metric
 import cv2
+from skimage.metrics import peak_signal_noise_ratio, structural_similarity
+
+import dataset_io
+from resize_cache import DEFAULT_MAX_BYTES, ResizeCache
+
+# LPIPS 輸入解析度
+LPIPS_SIZE = 256
+
+# 參考集特徵與 ONNX 模型快取目錄
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'vto-eval')
+
+def image_to_lpips_tensor(img):
+    """將 PIL RGB 圖片轉為 3×256×256 的 CPU 張量"""
+    img = img.resize((LPIPS_SIZE, LPIPS_SIZE))  # 調整大小
+    img = torch.from_numpy(np.array(img)).float() / 255.0
+    return img.permute(2, 0, 1)
+
+def mask_to_lpips_tensor(mask):
+    """將灰階遮罩陣列轉為 1×256×256 的 CPU 張量"""
+    mask = cv2.resize(mask, (LPIPS_SIZE, LPIPS_SIZE))
+    mask = torch.from_numpy(mask).float() / 255.0
+    return mask.unsqueeze(0)
+
+# OpenCV 縮小解碼旗標（縮小倍率由大到小）
+REDUCED_MASK_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+    (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    (2, cv2.IMREAD_REDUCED_GRAYSCALE_2)
+)
+
+# 縮放快取的鍵（目標尺寸與縮放方式），縮放方式改變時需要更新
+IMAGE_RESIZE_TAG = f'{LPIPS_SIZE}x{LPIPS_SIZE}:pil-bicubic'
+MASK_RESIZE_TAG = f'{LPIPS_SIZE}x{LPIPS_SIZE}:cv2-linear'
+
+def resize_image(file_path, reduced_decode=False):
+    """讀取圖片並縮放為 256×256×3 的 uint8 陣列"""
+    img = dataset_io.open_image(file_path)
+    if reduced_decode:
+        img.draft('RGB', (LPIPS_SIZE, LPIPS_SIZE))
+    return np.array(img.convert('RGB').resize((LPIPS_SIZE, LPIPS_SIZE)))
+
+def read_image(file_path, reduced_decode=False, resize_cache=None):
+    """讀取圖片並轉為 3×256×256 的 CPU 張量
+    
+    reduced_decode 為 True 時，JPEG 以不小於 256×256 的 1/2、1/4 或 1/8 比例直接解碼。
+    提供 resize_cache 時，縮放後的圖片由快取讀取，未命中時才解碼並寫入快取。
+    """
+    if resize_cache is None:
+        array = resize_image(file_path, reduced_decode)
+    else:
+        tag = IMAGE_RESIZE_TAG + (':reduced' if reduced_decode else '')
+        array = resize_cache.get(file_path, tag, lambda: resize_image(file_path, reduced_decode))
+    return torch.from_numpy(array).float().div(255.0).permute(2, 0, 1)
+
+def read_rgb(file_path):
+    """讀取 RGB 圖片，回傳 (PIL 圖片, H×W×3 uint8 陣列)
+    
+    打包目錄（tools/packed_store.py）的成員不需解碼，陣列為記憶體映射的視圖。
+    """
+    array = dataset_io.load_array(file_path)
+    if array is not None and array.ndim == 3:
+        return Image.fromarray(array), array
+    img = dataset_io.open_image(file_path).convert('RGB')
+    return img, np.array(img)
+
+def resize_mask(file_path, reduced_decode=False):
+    """讀取遮罩並縮放為 256×256 的 uint8 陣列"""
+    flag = cv2.IMREAD_GRAYSCALE
+    if reduced_decode and dataset_io.load_array(file_path) is None:
+        with dataset_io.open_image(file_path) as img:
+            width, height = img.size  # 只讀取檔頭
+        for factor, reduced_flag in REDUCED_MASK_FLAGS:
+            if min(width, height) // factor >= LPIPS_SIZE:
+                flag = reduced_flag
+                break
+    mask = dataset_io.imread(file_path, flag)
+    if mask is None:
+        raise ValueError(f"無法讀取遮罩 {file_path}")
+    return cv2.resize(mask, (LPIPS_SIZE, LPIPS_SIZE))
+
+def read_mask(file_path, reduced_decode=False, resize_cache=None):
+    """讀取遮罩並轉為 1×256×256 的 CPU 張量
+    
+    reduced_decode 為 True 時，以不小於 256×256 的 OpenCV IMREAD_REDUCED_* 旗標解碼。
+    resize_cache 的用法與 read_image 相同。
+    """
+    if resize_cache is None:
+        mask = resize_mask(file_path, reduced_decode)
+    else:
+        tag = MASK_RESIZE_TAG + (':reduced' if reduced_decode else '')
+        mask = resize_cache.get(file_path, tag, lambda: resize_mask(file_path, reduced_decode))
+    return torch.from_numpy(mask).float().div(255.0).unsqueeze(0)
+
+# 裁切模式：裁切區域的長邊縮放至 LPIPS_SIZE，短邊取 CROP_BUCKET_STEP 的倍數作為分桶尺寸
+CROP_BUCKET_STEP = 32
+CROP_MIN_SIZE = 64
+
+def mask_bbox(mask, padding):
+    """計算遮罩的邊界框（含 padding），以相對座標 (left, top, right, bottom) 表示"""
+    ys, xs = np.nonzero(mask)
+    if len(xs) == 0:
+        raise ValueError("遮罩為空")
+    height, width = mask.shape
+    left = max(int(xs.min()) - padding, 0)
+    top = max(int(ys.min()) - padding, 0)
+    right = min(int(xs.max()) + 1 + padding, width)
+    bottom = min(int(ys.max()) + 1 + padding, height)
+    return left / width, top / height, right / width, bottom / height
+
+def crop_bucket_size(box_width, box_height):
+    """依裁切區域的長寬比決定縮放後的分桶尺寸 (寬, 高)"""
+    scale = LPIPS_SIZE / max(box_width, box_height)
+    
+    def bucket(length):
+        length = int(np.ceil(length * scale / CROP_BUCKET_STEP)) * CROP_BUCKET_STEP
+        return min(max(length, CROP_MIN_SIZE), LPIPS_SIZE)
+    
+    return bucket(box_width), bucket(box_height)
+
+def scale_box(box, width, height):
+    """將相對座標邊界框換算為指定尺寸圖片上的像素座標"""
+    left, top, right, bottom = box
+    return (int(round(left * width)), int(round(top * height)),
+            int(round(right * width)), int(round(bottom * height)))
+
+def crop_geometry(mask, padding):
+    """回傳遮罩的相對座標邊界框、遮罩上的像素邊界框與分桶尺寸"""
+    box = mask_bbox(mask, padding)
+    mask_box = scale_box(box, mask.shape[1], mask.shape[0])
+    return box, mask_box, crop_bucket_size(mask_box[2] - mask_box[0], mask_box[3] - mask_box[1])
+
+def read_crop_bucket(mask_file, padding):
+    """只讀取遮罩計算裁切模式的分桶尺寸，無法讀取或遮罩為空時回傳 None（錯誤留給解碼時回報）"""
+    try:
+        mask = dataset_io.imread(mask_file, cv2.IMREAD_GRAYSCALE)
+        return None if mask is None else crop_geometry(mask, padding)[2]
+    except Exception:
+        return None
+
+def bucket_batches(buckets, batch_size):
+    """將索引依分桶尺寸分組後再切成批次，讓每個批次只有一種尺寸、只需一次前向運算
+    
+    buckets 為每個索引的分桶尺寸（None 表示未知，另成一組）；批次依最小索引排序，大致維持原本的順序。
+    """
+    groups = {}
+    for idx, size in enumerate(buckets):
+        groups.setdefault(size, []).append(idx)
+    batches = [indices[i:i + batch_size] for indices in groups.values()
+               for i in range(0, len(indices), batch_size)]
+    return sorted(batches, key=lambda batch: batch[0])
+
+def read_cropped_pair(gen_file, real_file, mask_file, padding):
+    """依遮罩邊界框裁切生成圖片、真實圖片與遮罩，只縮放裁切區域
+    
+    回傳已套用遮罩的 (生成圖片, 真實圖片, 遮罩面積比例)，圖片尺寸為分桶尺寸。
+    """
+    mask = dataset_io.imread(mask_file, cv2.IMREAD_GRAYSCALE)
+    if mask is None:
+        raise ValueError(f"無法讀取遮罩 {mask_file}")
+    mask_area = float(mask.mean()) / 255.0
+    box, mask_box, size = crop_geometry(mask, padding)
+    
+    mask = mask[mask_box[1]:mask_box[3], mask_box[0]:mask_box[2]]
+    mask = cv2.resize(mask, size)
+    mask = torch.from_numpy(mask).float().div(255.0).unsqueeze(0)
+    
+    outputs = []
+    for file_path in (gen_file, real_file):
+        img = dataset_io.open_image(file_path).convert('RGB')
+        img = img.crop(scale_box(box, img.width, img.height)).resize(size)
+        img = torch.from_numpy(np.array(img)).float() / 255.0
+        outputs.append(img.permute(2, 0, 1) * mask)
+    return outputs[0], outputs[1], mask_area
+
+# 圖片副檔名
+IMAGE_EXTS = ('.png', '.jpg')
+
+# 依配對檔建立索引時，生成圖片可能的命名方式
+GEN_NAME_PATTERNS = ('{person}', '{person}_{cloth}', '{person}__{cloth}')
+
+# 遮罩檔名可能帶有的後綴（VITON-HD 的 agnostic-mask 為 <stem>_mask.png）
+MASK_SUFFIXES = ('', '_mask')
+
+def scan_image_stems(directory):
+    """以單次目錄掃描建立 {檔名主幹: 路徑} 索引（directory 可為 zip 內的目錄）"""
+    index = {}
+    for name, path in dataset_io.list_files(directory):
+        stem, ext = os.path.splitext(name)
+        if ext in IMAGE_EXTS:
+            index.setdefault(stem, Path(path))
+    return index
+
+def read_pairs_file(pairs_file):
+    """讀取 test_pairs.txt / test_unpairs.txt，回傳 (人物主幹, 衣服主幹) 列表"""
+    pairs = []
+    for line in dataset_io.read_bytes(pairs_file).decode().splitlines():
+        parts = line.split()
+        if len(parts) < 2:
+            continue
+        pairs.append((os.path.splitext(parts[0])[0], os.path.splitext(parts[1])[0]))
+    return pairs
+
+def lookup_stem(index, candidates):
+    """依序嘗試候選主幹，回傳 (主幹, 路徑)，找不到時回傳 (None, None)"""
+    for stem in candidates:
+        if stem in index:
+            return stem, index[stem]
+    return None, None
+
+def build_pair_index(gen_dir, real_dir, mask_dir, pairs_file=None):
+    """以檔名主幹配對生成圖片、真實圖片與遮罩
+    
+    回傳 (配對列表, 未配對報告)。配對列表元素為 (主幹, 生成圖片, 真實圖片, 遮罩)。
+    提供 pairs_file 時依配對檔順序配對，否則依生成圖片的主幹排序配對。
+    """
+    gen_index = scan_image_stems(gen_dir)
+    real_index = scan_image_stems(real_dir)
+    mask_index = scan_image_stems(mask_dir)
+    
+    if pairs_file:
+        keys = [
+            (person, [pattern.format(person=person, cloth=cloth) for pattern in GEN_NAME_PATTERNS])
+            for person, cloth in read_pairs_file(pairs_file)
+        ]
+    else:
+        keys = [(stem, [stem]) for stem in sorted(gen_index)]
+    
+    pairs = []
+    report = {'missing_gen': [], 'missing_real': [], 'missing_mask': [], 'unused_gen': []}
+    used_gen = set()
+    
+    for person, gen_candidates in keys:
+        gen_stem, gen_file = lookup_stem(gen_index, gen_candidates)
+        real_file = real_index.get(person)
+        _, mask_file = lookup_stem(mask_index, [person + suffix for suffix in MASK_SUFFIXES])
+        
+        if gen_file is None:
+            report['missing_gen'].append(person)
+            continue
+        used_gen.add(gen_stem)
+        if real_file is None:
+            report['missing_real'].append(person)
+        elif mask_file is None:
+            report['missing_mask'].append(person)
+        else:
+            pairs.append((person, gen_file, real_file, mask_file))
+    
+    report['unused_gen'] = sorted(set(gen_index) - used_gen)
+    return pairs, report
+
+def print_pairing_report(report, limit=5):
+    """輸出未配對檔案的摘要"""
+    labels = {
+        'missing_gen': '缺少生成圖片',
+        'missing_real': '缺少真實圖片',
+        'missing_mask': '缺少遮罩',
+        'unused_gen': '未配對的生成圖片'
+    }
+    for key, label in labels.items():
+        stems = report[key]
+        if stems:
+            preview = ', '.join(stems[:limit])
+            more = ' ...' if len(stems) > limit else ''
+            print(f"⚠️  {label}：{len(stems)} 個（{preview}{more}）")
+
+class MaskedPairDataset(Dataset):
+    """在 DataLoader worker 中解碼圖片並套用遮罩
+    
+    crop_padding 不為 None 時改用遮罩邊界框裁切模式，各樣本尺寸依分桶而不同。
+    resize_cache 只用於整張圖片模式（裁切區域依遮罩而不同，不快取）。
+    """
+    
+    def __init__(self, pairs, crop_padding=None, reduced_decode=False, resize_cache=None):
+        self.pairs = pairs
+        self.crop_padding = crop_padding
+        self.reduced_decode = reduced_decode
+        self.resize_cache = resize_cache
+    
+    def __len__(self):
+        return len(self.pairs)
+    
+    def __getitem__(self, idx):
+        stem, gen_file, real_file, mask_file = self.pairs[idx]
+        try:
+            if self.crop_padding is not None:
+                gen_masked, real_masked, mask_area = read_cropped_pair(
+                    gen_file, real_file, mask_file, self.crop_padding
+                )
+            else:
+                mask = read_mask(mask_file, self.reduced_decode, self.resize_cache)
+                mask_area = float(mask.mean())
+                gen_masked = read_image(gen_file, self.reduced_decode, self.resize_cache) * mask
+                real_masked = read_image(real_file, self.reduced_decode, self.resize_cache) * mask
+            return stem, gen_masked, real_masked, mask_area, None
+        except Exception as e:
+            # 錯誤交由主程序回報，避免單一壞檔中斷整個 DataLoader
+            return stem, None, None, None, str(e)
+
+def collate_masked_pairs(samples):
+    """將有效的圖片對依尺寸分組堆疊成批次，並分離出失敗的樣本
+    
+    裁切模式的批次通常已由 bucket_batches 依分桶尺寸分好；分組是分桶未知時的備援。
+    
+    回傳 (批次列表, 失敗列表)，批次列表元素為
+    (主幹列表, 生成圖片批次, 真實圖片批次, 遮罩面積列表)。
+    """
+    groups = {}
+    failures = []
+    for stem, gen_masked, real_masked, mask_area, error in samples:
+        if error is not None:
+            failures.append((stem, error))
+            continue
+        names, gens, reals, areas = groups.setdefault(tuple(gen_masked.shape), ([], [], [], []))
+        names.append(stem)
+        gens.append(gen_masked)
+        reals.append(real_masked)
+        areas.append(mask_area)
+    batches = [(names, torch.stack(gens), torch.stack(reals), areas)
+               for names, gens, reals, areas in groups.values()]
+    return batches, failures
+
+# 逐張指標輸出欄位
+PER_IMAGE_FIELDS = ('stem', 'lpips', 'mask_area', 'error')
+ALL_PER_IMAGE_FIELDS = ('stem', 'lpips', 'psnr', 'ssim', 'mask_area', 'error')
+
+class PerImageWriter:
+    """逐筆串流寫出每張圖片的指標，副檔名為 .parquet 時寫成 Parquet，否則為 CSV
+    
+    CSV 每筆直接寫入檔案；Parquet 只暫存一個 row group 的資料。
+    """
+    
+    def __init__(self, path, fields, row_group_size=1024):
+        self.path = str(path)
+        self.fields = fields
+        self.row_group_size = row_group_size
+        self.rows = []
+        if self.path.endswith('.parquet'):
+            try:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+            except ImportError:
+                raise ImportError("輸出 Parquet 需要 pyarrow，請執行 pip install pyarrow")
+            self.pa = pa
+            self.schema = pa.schema([
+                (field, pa.string() if field in ('stem', 'error') else pa.float64())
+                for field in fields
+            ])
+            self.parquet = pq.ParquetWriter(self.path, self.schema)
+            self.file = None
+        else:
+            self.parquet = None
+            self.file = open(self.path, 'w', newline='')
+            self.csv = csv.DictWriter(self.file, fieldnames=fields)
+            self.csv.writeheader()
+    
+    def write(self, record):
+        """寫入一筆紀錄，缺少的欄位留空"""
+        if self.parquet is None:
+            self.csv.writerow({field: record.get(field) for field in self.fields})
+            return
+        self.rows.append(record)
+        if len(self.rows) >= self.row_group_size:
+            self.flush()
+    
+    def flush(self):
+        """將暫存的資料寫成一個 Parquet row group"""
+        if self.parquet is not None and self.rows:
+            columns = {field: [row.get(field) for row in self.rows] for field in self.fields}
+            self.parquet.write_table(self.pa.Table.from_pydict(columns, schema=self.schema))
+            self.rows = []
+    
+    def close(self):
+        if self.parquet is not None:
+            self.flush()
+            self.parquet.close()
+        else:
+            self.file.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+
+def pairing_report_records(report):
+    """將未配對報告轉為逐張輸出的失敗紀錄"""
+    reasons = {
+        'missing_gen': '缺少生成圖片',
+        'missing_real': '缺少真實圖片',
+        'missing_mask': '缺少遮罩',
+        'unused_gen': '未配對的生成圖片'
+    }
+    for key, reason in reasons.items():
+        for stem in report[key]:
+            yield {'stem': stem, 'error': reason}
+
+def push_worst(heap, k, score, stem):
+    """以大小為 k 的最小堆積保留分數最高（最差）的 k 張圖片"""
+    if k <= 0:
+        return
+    if len(heap) < k:
+        heapq.heappush(heap, (score, stem))
+    elif score > heap[0][0]:
+        heapq.heapreplace(heap, (score, stem))
+
+def print_worst(heap, label='LPIPS'):
+    """輸出最差的 k 張圖片"""
+    if not heap:
+        return
+    print(f"\n{label} 最差的 {len(heap)} 張：")
+    for rank, (score, stem) in enumerate(sorted(heap, reverse=True), 1):
+        print(f"  {rank:3d}. {stem}  {score:.4f}")
+
+class ThreadedLoader:
+    """以執行緒池解碼樣本的批次迭代器
+    
+    PIL 與 OpenCV 解碼、縮放時會釋放 GIL，可取代 DataLoader 的多程序 worker，
+    省去程序啟動與張量跨程序傳遞的成本。預先提交 prefetch 個批次。
+    batches 指定時依其中的索引列表組成批次（與 DataLoader 的 batch_sampler 相同）。
+    """
+    
+    def __init__(self, dataset, batch_size, num_threads, collate_fn, prefetch=2, batches=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.num_threads = num_threads
+        self.collate_fn = collate_fn
+        self.prefetch = prefetch
+        if batches is None:
+            batches = [range(start, min(start + batch_size, len(dataset)))
+                       for start in range(0, len(dataset), batch_size)]
+        self.batches = batches
+    
+    def __len__(self):
+        return len(self.batches)
+    
+    def __iter__(self):
+        batches = iter(self.batches)
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            pending = deque()
+            
+            def submit_next():
+                batch = next(batches, None)
+                if batch is not None:
+                    pending.append([executor.submit(self.dataset.__getitem__, i) for i in batch])
+            
+            for _ in range(self.prefetch + 1):
+                submit_next()
+            while pending:
+                futures = pending.popleft()
+                submit_next()
+                yield self.collate_fn([future.result() for future in futures])
+
+def make_loader(dataset, batch_size, num_workers, collate_fn, device, loader='process',
+                batches=None):
+    """建立批次迭代器：process 使用 DataLoader 多程序 worker，thread 使用執行緒池
+    
+    batches 指定時以其中的索引列表組成批次，取代依序切分的 batch_size。
+    """
+    if loader == 'thread':
+        return ThreadedLoader(dataset, batch_size, max(num_workers, 1), collate_fn, batches=batches)
+    if batches is not None:
+        return DataLoader(
+            dataset,
+            batch_sampler=batches,
+            num_workers=num_workers,
+            collate_fn=collate_fn,
+            pin_memory=str(device).startswith('cuda')
+        )
+    return DataLoader(
+        dataset,
+        batch_size=batch_size,
+        num_workers=num_workers,
+        collate_fn=collate_fn,
+        pin_memory=str(device).startswith('cuda')
+    )
+
+# ONNX 匯出設定；parity 容許誤差為 LPIPS 分數的最大絕對差
+ONNX_OPSET = 17
+ONNX_PARITY_TOLERANCE = 1e-4
+
+class LPIPSExportWrapper(torch.nn.Module):
+    """以 (生成, 真實) 兩個位置參數呼叫 LPIPS，供 ONNX 匯出"""
+    
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+    
+    def forward(self, gen, real):
+        return self.model(gen, real)
+
+def lpips_model_fingerprint(model):
+    """以 LPIPS 權重、opset 與 torch 版本計算 ONNX 快取鍵"""
+    digest = hashlib.sha1(f"{ONNX_OPSET}:{torch.__version__}".encode())
+    for name, tensor in sorted(model.state_dict().items()):
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()
+
+def export_lpips_onnx(model, cache_dir=DEFAULT_CACHE_DIR):
+    """將 LPIPS AlexNet 與線性層匯出為 ONNX，已匯出時直接回傳快取路徑
+    
+    批次大小與影像長寬皆為動態維度，遮罩邊界框裁切的各種尺寸可共用同一個模型。
+    """
+    model = model.cpu().eval()
+    onnx_file = Path(cache_dir) / f"lpips-alex-{lpips_model_fingerprint(model)}.onnx"
+    if onnx_file.exists():
+        print(f"使用 ONNX 模型快取：{onnx_file}")
+        return onnx_file
+    
+    print("匯出 LPIPS ONNX 模型...")
+    onnx_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = onnx_file.with_name(onnx_file.name + f'.{os.getpid()}.tmp')
+    dummy = torch.zeros(2, 3, 64, 64)
+    dynamic = {0: 'batch', 2: 'height', 3: 'width'}
+    # 較新的 torch 預設改用 dynamo 匯出器；torch 2.1（requirements_kaggle.txt）沒有這個參數
+    options = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    torch.onnx.export(
+        LPIPSExportWrapper(model), (dummy, dummy), str(tmp_file),
+        input_names=['gen', 'real'], output_names=['score'],
+        dynamic_axes={'gen': dynamic, 'real': dynamic, 'score': {0: 'batch'}},
+        opset_version=ONNX_OPSET, **options
+    )
+    os.replace(tmp_file, onnx_file)
+    print(f"已寫入 ONNX 模型快取：{onnx_file}")
+    return onnx_file
+
+class OnnxLPIPS:
+    """以 onnxruntime 執行的 LPIPS，呼叫方式與 lpips.LPIPS 相同
+    
+    輸入為 N×3×H×W 張量，回傳 N×1×1×1 的 CPU 張量。CPU 執行緒數沿用
+    torch.get_num_threads()，因此 --num_threads 對兩種後端都有效。
+    """
+    
+    def __init__(self, model, device='cpu', cache_dir=DEFAULT_CACHE_DIR):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError("ONNX 後端需要 onnxruntime，請執行 pip install onnxruntime")
+        
+        onnx_file = export_lpips_onnx(model, cache_dir or DEFAULT_CACHE_DIR)
+        providers = ['CPUExecutionProvider']
+        if str(device).startswith('cuda') and 'CUDAExecutionProvider' in ort.get_available_providers():
+            providers.insert(0, 'CUDAExecutionProvider')
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = torch.get_num_threads()
+        self.session = ort.InferenceSession(str(onnx_file), options, providers=providers)
+        self.providers = self.session.get_providers()
+    
+    def __call__(self, gen, real):
+        outputs = self.session.run(None, {
+            'gen': gen.detach().cpu().float().contiguous().numpy(),
+            'real': real.detach().cpu().float().contiguous().numpy()
+        })
+        return torch.from_numpy(outputs[0])
+
+def create_lpips_fn(device='cuda', backend='torch', cache_dir=DEFAULT_CACHE_DIR):
+    """建立 LPIPS 計算函式：torch 為 lpips.LPIPS，onnx 為 OnnxLPIPS"""
+    model = lpips.LPIPS(net='alex')
+    if backend == 'onnx':
+        return OnnxLPIPS(model, device, cache_dir)
+    return model.to(device)
+
+def check_lpips_backend(device='cpu', backend='onnx', batch_size=8, num_batches=10,
+                        cache_dir=DEFAULT_CACHE_DIR, seed=0):
+    """以隨機輸入比對後端與 torch 後端的 LPIPS 分數，並量測吞吐量
+    
+    回傳 {'max_abs_diff', 'mean_abs_diff', 'torch_pairs_per_sec', '<backend>_pairs_per_sec'}；
+    最大絕對差超過 ONNX_PARITY_TOLERANCE 時拋出 RuntimeError。
+    """
+    generator = torch.Generator().manual_seed(seed)
+    batches = [(torch.rand(batch_size, 3, LPIPS_SIZE, LPIPS_SIZE, generator=generator),
+                torch.rand(batch_size, 3, LPIPS_SIZE, LPIPS_SIZE, generator=generator))
+               for _ in range(num_batches)]
+    
+    def run(fn):
+        with torch.no_grad():
+            fn(batches[0][0].to(device), batches[0][1].to(device))  # 預熱
+            start = time.perf_counter()
+            scores = [fn(gen.to(device), real.to(device)).flatten().cpu() for gen, real in batches]
+            elapsed = time.perf_counter() - start
+        return torch.cat(scores), batch_size * num_batches / elapsed
+    
+    reference, torch_speed = run(create_lpips_fn(device, 'torch'))
+    scores, speed = run(create_lpips_fn(device, backend, cache_dir))
+    diff = (scores - reference).abs()
+    report = {
+        'max_abs_diff': float(diff.max()),
+        'mean_abs_diff': float(diff.mean()),
+        'torch_pairs_per_sec': torch_speed,
+        f'{backend}_pairs_per_sec': speed
+    }
+    if report['max_abs_diff'] > ONNX_PARITY_TOLERANCE:
+        raise RuntimeError(f"{backend} 後端與 torch 後端的 LPIPS 差異過大："
+                           f"{report['max_abs_diff']:.2e}")
+    return report
+
+# 量化 LPIPS 設定：以前 QUANT_CALIBRATION_SIZE 組圖片對校正，再以接下來的
+# QUANT_CALIBRATION_SIZE 組（未用於校正）比對，與 fp32 分數的平均絕對差超過
+# QUANT_TOLERANCE 時拒絕評估
+QUANT_CALIBRATION_SIZE = 32
+QUANT_TOLERANCE = 0.002
+
+class AutocastFeatures(torch.nn.Module):
+    """以 bfloat16 autocast 執行 LPIPS 特徵擷取網路，輸出轉回 float32"""
+    
+    def __init__(self, net):
+        super().__init__()
+        self.net = net
+    
+    def forward(self, x):
+        with torch.autocast('cpu', dtype=torch.bfloat16):
+            outputs = self.net(x)
+        return type(outputs)(*(output.float() for output in outputs))
+
+def quantize_lpips(model, precision, calibration_batches):
+    """回傳特徵擷取網路改以 bf16 或 int8 執行的 LPIPS 複本（線性層維持 fp32）
+    
+    int8 以 eager 模式靜態量化 AlexNet 的每個 slice（卷積與 ReLU 融合），
+    並以 calibration_batches 中的 (生成, 真實) 批次校正 activation 範圍。
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    
+    if precision == 'bf16':
+        if not torch.ops.mkldnn._is_mkldnn_bf16_supported():
+            raise RuntimeError("此 CPU 不支援 bf16 運算，請改用 int8 或 fp32")
+        model.net = AutocastFeatures(model.net)
+        return model
+    
+    from torch.ao import quantization
+    engines = torch.backends.quantized.supported_engines
+    engine = next((name for name in ('x86', 'fbgemm', 'qnnpack') if name in engines), None)
+    if engine is None:
+        raise RuntimeError("此 PyTorch 不支援 int8 量化運算")
+    torch.backends.quantized.engine = engine
+    
+    net = model.net
+    for index in range(1, net.N_slices + 1):
+        name = f'slice{index}'
+        block = getattr(net, name)
+        modules = list(block._modules.items())
+        fuse = [[first, second] for (first, a), (second, b) in zip(modules, modules[1:])
+                if isinstance(a, torch.nn.Conv2d) and isinstance(b, torch.nn.ReLU)]
+        quantization.fuse_modules(block, fuse, inplace=True)
+        wrapped = quantization.QuantWrapper(block)
+        wrapped.qconfig = quantization.get_default_qconfig(engine)
+        setattr(net, name, wrapped)
+    
+    quantization.prepare(net, inplace=True)
+    with torch.no_grad():
+        for gen, real in calibration_batches:
+            model(gen, real)
+    quantization.convert(net, inplace=True)
+    return model
 
 class MaskedLPIPS:
-    """Masked LPIPS 評估器"""
+    """Masked LPIPS 評估器
     
-    def __init__(self, device='cuda'):
+    precision 為 bf16 或 int8 時，特徵擷取網路在評估前以前 calibration_size 組
+    圖片對校正，並以接下來的 calibration_size 組與 fp32 比對（見 apply_precision），
+    只支援 torch 後端與 CPU。
+    resize_cache 為 ResizeCache 時，縮放至 256×256 的圖片與遮罩由磁碟快取讀取。
+    """
+    
+    def __init__(self, device='cuda', backend='torch', cache_dir=DEFAULT_CACHE_DIR,
+                 precision='fp32', quant_tolerance=QUANT_TOLERANCE,
+                 calibration_size=QUANT_CALIBRATION_SIZE, resize_cache=None):
+        if precision != 'fp32' and (backend != 'torch' or str(device) != 'cpu'):
+            raise ValueError(f"{precision} 模式只支援 torch 後端與 CPU")
         self.device = device
-        self.lpips_fn = lpips.LPIPS(net='alex').to(device)
+        self.lpips_fn = create_lpips_fn(device, backend, cache_dir)
+        self.precision = precision
+        self.quant_tolerance = quant_tolerance
+        self.calibration_size = calibration_size
+        self.resize_cache = resize_cache
+        self.precision_report = None
+        self.last_scores = []
+    
+    def apply_precision(self, pairs, crop_padding=None, reduced_decode=False, defer=False):
+        """以前 calibration_size 組圖片對校正量化模型，並以接下來的 calibration_size 組
+        （未參與校正的保留集）比對 fp32 分數
+        
+        平均絕對差超過 quant_tolerance 時拋出 RuntimeError，不以量化模型評估；
+        通過時改用量化模型並回傳比對報告。fp32 或已套用時不做任何事。
+        圖片對不足以同時提供校正集與保留集時改用 fp32；defer 為 True 時則
+        回傳 None 且不做決定，待之後以更多圖片對再次呼叫（watch 模式）。
+        """
+        if self.precision == 'fp32' or self.precision_report is not None:
+            return self.precision_report
+        
+        size = self.calibration_size
+        calibration = holdout = []
+        if len(pairs) >= 2 * size:
+            calibration = self.load_batches(pairs[:size], crop_padding, reduced_decode)
+            holdout = self.load_batches(pairs[size:2 * size], crop_padding, reduced_decode)
+        if not calibration or not holdout:
+            if defer:
+                return None
+            print(f"⚠️  有效圖片對不足 {2 * size} 組（校正與保留比對各 {size} 組），"
+                  f"不使用 {self.precision}，改以 fp32 評估")
+            self.precision = 'fp32'
+            return None
+        
+        print(f"以 {sum(len(gen) for gen, _ in calibration)} 組圖片對校正 {self.precision} LPIPS，"
+              f"以另外 {sum(len(gen) for gen, _ in holdout)} 組比對 fp32...")
+        model = quantize_lpips(self.lpips_fn, self.precision, calibration)
+        with torch.no_grad():
+            reference = torch.cat([self.lpips_fn(gen, real).flatten() for gen, real in holdout])
+            scores = torch.cat([model(gen, real).flatten() for gen, real in holdout])
+        deviation = (scores - reference).abs()
+        report = {
+            'precision': self.precision,
+            'num_pairs': len(deviation),
+            'mean_abs_diff': float(deviation.mean()),
+            'max_abs_diff': float(deviation.max())
+        }
+        print(f"{self.precision} 與 fp32 的 LPIPS 差異：平均 {report['mean_abs_diff']:.2e}，"
+              f"最大 {report['max_abs_diff']:.2e}（容許平均 {self.quant_tolerance:.2e}）")
+        if report['mean_abs_diff'] > self.quant_tolerance:
+            raise RuntimeError(f"{self.precision} LPIPS 與 fp32 的平均絕對差超過容許值，"
+                               f"請改用 fp32 或調整 --quant_tolerance")
+        
+        self.lpips_fn = model
+        self.precision_report = report
+        return report
+    
+    def load_batches(self, pairs, crop_padding=None, reduced_decode=False):
+        """解碼圖片對，回傳有效圖片對的 (生成, 真實) 批次列表"""
+        dataset = MaskedPairDataset(pairs, crop_padding=crop_padding,
+                                    reduced_decode=reduced_decode, resize_cache=self.resize_cache)
+        batches, _ = collate_masked_pairs([dataset[i] for i in range(len(dataset))])
+        return [(gen, real) for _, gen, real, _ in batches]
     
-    def calculate_masked_lpips(self, gen_dir, real_dir, mask_dir):
-        """計算 Masked LPIPS"""
+    def calculate_masked_lpips(self, gen_dir, real_dir, mask_dir, batch_size=1, num_workers=0,
+                               pairs_file=None, crop_padding=None, reduced_decode=False,
+                               loader='process', per_image_out=None, worst_k=0):
+        """計算 Masked LPIPS
+        
+        圖片以檔名主幹配對（可由 pairs_file 指定配對順序）。
+        batch_size 張圖片對為一批，由 num_workers 個背景 worker 預先解碼，
+        每批只執行一次 LPIPS 前向運算；平均值與逐張計算相同。
+        crop_padding 不為 None 時只評估遮罩邊界框（外擴 crop_padding 像素）內的區域，
+        先依遮罩計算分桶尺寸，同一分桶的裁切區域組成批次一起計算。
+        reduced_decode 為 True 時以縮小比例解碼（裁切模式不適用），loader 選擇
+        多程序（process）或執行緒池（thread）解碼。
+        per_image_out 指定時逐張寫出分數與失敗原因，worst_k 大於 0 時列出最差的圖片。
+        有效圖片的逐張分數保留在 self.last_scores，供信賴區間等後續計算使用。
+        """
         gen_path = Path(gen_dir)
         real_path = Path(real_dir)
         mask_path = Path(mask_dir)
         
-        if not all(p.exists() for p in [gen_path, real_path, mask_path]):
+        if not all(dataset_io.exists(p) for p in [gen_path, real_path, mask_path]):
             raise ValueError("一個或多個目錄不存在")
         
-        # 取得所有圖片檔案
-        gen_files = sorted(list(gen_path.glob('*.png')) + list(gen_path.glob('*.jpg')))
-        real_files = sorted(list(real_path.glob('*.png')) + list(real_path.glob('*.jpg')))
-        mask_files = sorted(list(mask_path.glob('*.png')) + list(mask_path.glob('*.jpg')))
+        # 以檔名主幹配對圖片
+        pairs, report = build_pair_index(gen_path, real_path, mask_path, pairs_file)
+        print_pairing_report(report)
         
-        if len(gen_files) != len(real_files) or len(gen_files) != len(mask_files):
-            raise ValueError("圖片數量不匹配")
+        if not pairs:
+            raise ValueError("找不到可配對的圖片")
         
+        self.apply_precision(pairs, crop_padding, reduced_decode)
+        writer = PerImageWriter(per_image_out, PER_IMAGE_FIELDS) if per_image_out else None
+        self.last_scores = []
         total_lpips = 0.0
         valid_count = 0
+        worst = []
         
-        for gen_file, real_file, mask_file in zip(gen_files, real_files, mask_files):
-            try:
-                # 載入圖片
-                gen_img = self.load_image(gen_file)
-                real_img = self.load_image(real_file)
-                mask = self.load_mask(mask_file)
-                
-                # 應用遮罩
-                gen_masked = gen_img * mask
-                real_masked = real_img * mask
-                
-                # 計算 LPIPS
-                with torch.no_grad():
-                    lpips_score = self.lpips_fn(gen_masked, real_masked).item()
+        try:
+            if writer:
+                for record in pairing_report_records(report):
+                    writer.write(record)
+            
+            for stem, lpips_score, mask_area, error in self.iter_masked_lpips(
+                    pairs, batch_size, num_workers, crop_padding, reduced_decode, loader):
+                if writer:
+                    writer.write({'stem': stem, 'lpips': lpips_score,
+                                  'mask_area': mask_area, 'error': error})
+                if error is not None:
+                    print(f"處理檔案時出錯 {stem}: {error}")
+                    continue
                 
+                # 依序累加，與逐張計算的結果一致
                 total_lpips += lpips_score
                 valid_count += 1
-                
-            except Exception as e:
-                print(f"處理檔案時出錯 {gen_file.name}: {e}")
-                continue
+                self.last_scores.append(lpips_score)
+                push_worst(worst, worst_k, lpips_score, stem)
+        finally:
+            if writer:
+                writer.close()
         
         if valid_count == 0:
             raise ValueError("沒有有效的圖片對")
         
+        if writer:
+            print(f"逐張分數已寫入 {per_image_out}")
+        print_worst(worst)
+        
         return total_lpips / valid_count
     
+    def iter_masked_lpips(self, pairs, batch_size=1, num_workers=0, crop_padding=None,
+                          reduced_decode=False, loader='process'):
+        """逐張產生 (主幹, LPIPS 分數, 遮罩面積, 錯誤訊息)，失敗的圖片分數為 None
+        
+        裁切模式且 batch_size 大於 1 時先讀取遮罩分桶，再以同一分桶的索引組成批次，
+        產生順序因此與 pairs 不同。
+        """
+        dataset = MaskedPairDataset(pairs, crop_padding=crop_padding, reduced_decode=reduced_decode,
+                                    resize_cache=self.resize_cache)
+        batches = None
+        if crop_padding is not None and batch_size > 1:
+            mask_files = [mask_file for _, _, _, mask_file in pairs]
+            with ThreadPoolExecutor(max_workers=max(num_workers, 1)) as executor:
+                buckets = list(executor.map(read_crop_bucket, mask_files,
+                                            [crop_padding] * len(mask_files)))
+            batches = bucket_batches(buckets, batch_size)
+        batch_iter = make_loader(dataset, batch_size, num_workers, collate_masked_pairs,
+                                 self.device, loader, batches)
+        
+        for batches, failures in batch_iter:
+            for stem, error in failures:
+                yield stem, None, None, error
+            
+            for names, gen_batch, real_batch, areas in batches:
+                try:
+                    # 計算 LPIPS（每批一次前向運算）
+                    with torch.no_grad():
+                        scores = self.lpips_fn(
+                            gen_batch.to(self.device, non_blocking=True),
+                            real_batch.to(self.device, non_blocking=True)
+                        )
+                    scores = scores.flatten().tolist()
+                except Exception as e:
+                    for stem, mask_area in zip(names, areas):
+                        yield stem, None, mask_area, str(e)
+                    continue
+                
+                for stem, lpips_score, mask_area in zip(names, scores, areas):
+                    yield stem, lpips_score, mask_area, None
+    
     def load_image(self, file_path):
         """載入並預處理圖片"""
-        img = Image.open(file_path).convert('RGB')
-        img = img.resize((256, 256))  # 調整大小
-        img = torch.from_numpy(np.array(img)).float() / 255.0
-        img = img.permute(2, 0, 1).unsqueeze(0).to(self.device)
-        return img
+        return read_image(file_path, resize_cache=self.resize_cache).unsqueeze(0).to(self.device)
     
     def load_mask(self, file_path):
         """載入並預處理遮罩"""
-        mask = cv2.imread(str(file_path), cv2.IMREAD_GRAYSCALE)
-        mask = cv2.resize(mask, (256, 256))
-        mask = torch.from_numpy(mask).float() / 255.0
-        mask = mask.unsqueeze(0).unsqueeze(0).to(self.device)
-        return mask
+        return read_mask(file_path, resize_cache=self.resize_cache).unsqueeze(0).to(self.device)
+
+# Inception 特徵設定（與 torch_fidelity 的 FID/KID 預設相同）
+FEATURE_EXTRACTOR = 'inception-v3-compat'
+FEATURE_LAYER = '2048'
+FEATURE_BATCH_SIZE = 64
+FID_EXTS = ('.png', '.jpg', '.jpeg')
+KID_SUBSET_SIZE = 1000
+
+def list_fid_files(directory):
+    """列出 torch_fidelity 會讀取的圖片（依實際路徑排序）"""
+    in_zip = dataset_io.split_zip_path(directory) is not None
+    files = []
+    for name, path in dataset_io.list_files(directory):
+        if os.path.splitext(name)[1].lower() in FID_EXTS:
+            files.append(path if in_zip else os.path.realpath(path))
+    return sorted(files)
+
+def directory_fingerprint(files):
+    """以 (檔名, 大小, 修改時間) 計算目錄指紋並納入特徵擷取器版本，不讀取檔案內容
+    
+    與 check_dataset 的內容清單、縮放快取相同，以大小與修改時間判斷檔案是否變動。
+    """
+    digest = hashlib.sha1()
+    digest.update(f'{feature_extractor_tag()}\n'.encode())
+    for file_path in files:
+        size, mtime_ns = dataset_io.file_stat(file_path)
+        digest.update(f'{os.path.basename(file_path)}\0{size}\0{mtime_ns}\n'.encode())
+    return digest.hexdigest()
+
+class FidImageDataset(ImagesPathDataset):
+    """torch_fidelity 的 ImagesPathDataset，改以 dataset_io 讀取以支援 zip 內的圖片
+    
+    打包目錄的成員直接以 torch.from_numpy 包裝記憶體映射的陣列，不經過 PIL。
+    """
+    
+    def __getitem__(self, i):
+        array = dataset_io.load_array(self.files[i])
+        if array is not None and array.ndim == 3:
+            return torch.from_numpy(array).permute(2, 0, 1)
+        with dataset_io.open_image(self.files[i]) as img:
+            return self.transforms(img.convert('RGB'))
+
+def create_inception(device):
+    """建立 Inception 特徵擷取器"""
+    extractor = FeatureExtractorInceptionV3(FEATURE_EXTRACTOR, [FEATURE_LAYER])
+    extractor.requires_grad_(False)
+    return extractor.eval().to(device)
+
+def extract_inception_features(files, device, extractor=None, num_workers=0):
+    """擷取圖片的 Inception 特徵，回傳 N×2048 的 CPU 張量"""
+    if extractor is None:
+        extractor = create_inception(device)
+    loader = DataLoader(
+        FidImageDataset(files),
+        batch_size=FEATURE_BATCH_SIZE,
+        num_workers=num_workers,
+        pin_memory=str(device).startswith('cuda')
+    )
+    features = []
+    with torch.no_grad():
+        for batch in loader:
+            features.append(extractor(batch.to(device, non_blocking=True))[0].cpu())
+    return torch.cat(features, dim=0)
+
+def load_reference_features(real_dir, device, cache_dir=DEFAULT_CACHE_DIR):
+    """取得參考集的 Inception 特徵與統計量，命中快取時不重新擷取
+    
+    快取以目錄指紋（檔名、大小、修改時間）與特徵擷取器版本為鍵，儲存為 <cache_dir>/reference-<指紋>.npz。
+    快取目錄唯讀或已滿時只提出警告，不影響 FID/KID 計算。
+    """
+    files = list_fid_files(real_dir)
+    if not files:
+        raise ValueError(f"參考目錄中沒有圖片：{real_dir}")
+    
+    cache_file = None
+    if cache_dir:
+        cache_file = Path(cache_dir) / f"reference-{directory_fingerprint(files)}.npz"
+        if cache_file.exists():
+            print(f"使用參考集特徵快取：{cache_file}")
+            cached = np.load(cache_file)
+            features = torch.from_numpy(cached['features'])
+            return features, {'mu': cached['mu'], 'sigma': cached['sigma']}
+    
+    print(f"擷取參考集特徵（{len(files)} 張）...")
+    features = extract_inception_features(files, device)
+    stats = fid_features_to_statistics(features)
+    
+    if cache_file is not None:
+        # 先寫暫存檔再改名，中斷時不會留下不完整的快取；寫入失敗時照常使用記憶體中的特徵
+        tmp_file = cache_file.with_name(cache_file.name + f'.{os.getpid()}.tmp')
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp_file, 'wb') as f:
+                np.savez(f, features=features.numpy(), mu=stats['mu'], sigma=stats['sigma'])
+            os.replace(tmp_file, cache_file)
+            print(f"已寫入參考集特徵快取：{cache_file}")
+        except OSError as e:
+            tmp_file.unlink(missing_ok=True)
+            print(f"⚠️  無法寫入參考集特徵快取（{e}），本次不使用快取")
+    
+    return features, stats
+
+# 自助法（bootstrap）信賴區間設定
+BOOTSTRAP_SEED = 2020
+
+# FID 每次重抽樣都要做一次特徵值分解（n=2000 時 CPU 上約 0.2–0.5 秒），
+# 未指定 --fid_bootstrap 時最多重抽樣這麼多次；KID 與 LPIPS 為矩陣運算，不受此限
+DEFAULT_FID_BOOTSTRAP = 100
+
+# FID 重抽樣預估超過這個秒數時輸出預估時間與進度
+BOOTSTRAP_SLOW_SECONDS = 10
+
+def resolve_fid_bootstrap(bootstrap, fid_bootstrap=None):
+    """FID 的重抽樣次數：未指定時為 min(bootstrap, DEFAULT_FID_BOOTSTRAP)"""
+    if fid_bootstrap is None:
+        return min(bootstrap, DEFAULT_FID_BOOTSTRAP)
+    return min(bootstrap, fid_bootstrap)
+
+def bootstrap_weights(n, num_samples, seed=BOOTSTRAP_SEED):
+    """產生 num_samples×n 的重抽樣次數矩陣（每列為一次有放回抽樣）"""
+    rng = np.random.default_rng(seed)
+    return rng.multinomial(n, np.full(n, 1.0 / n), size=num_samples).astype(np.float64)
+
+def percentile_interval(samples, ci):
+    """由自助法樣本取百分位數信賴區間"""
+    alpha = (100.0 - ci) / 2
+    low, high = np.percentile(samples, [alpha, 100.0 - alpha])
+    return [float(low), float(high)]
+
+def bootstrap_mean(values, weights):
+    """以重抽樣次數矩陣一次計算所有重抽樣的平均值"""
+    values = np.asarray(values, dtype=np.float64)
+    return weights @ values / len(values)
+
+def bootstrap_fid(gen_features, real_stats, weights):
+    """重抽樣生成圖片特徵（參考集固定）計算 FID
+    
+    平均值與共變異數的跡以矩陣運算一次完成；tr sqrt(Σr^½ Σg Σr^½) 改由
+    重抽樣支撐集上的 Gram 矩陣特徵值求得，避免每次對 2048×2048 矩陣開根號。
+    每次重抽樣仍需一次約 0.63n×0.63n 的特徵值分解；預估耗時較長時輸出進度與剩餘時間。
+    """
+    gen = np.asarray(gen_features, dtype=np.float64)
+    n = len(gen)
+    mu_real = real_stats['mu'].astype(np.float64)
+    sigma_real = real_stats['sigma'].astype(np.float64)
+    
+    eigval, eigvec = np.linalg.eigh(sigma_real)
+    sqrt_real = (eigvec * np.sqrt(np.clip(eigval, 0, None))) @ eigvec.T
+    projected = gen @ sqrt_real
+    gram = projected @ projected.T
+    
+    mu = weights @ gen / n
+    trace_gen = (weights @ np.einsum('ij,ij->i', gen, gen) - n * np.einsum('ij,ij->i', mu, mu)) / (n - 1)
+    diff = mu - mu_real
+    fid = np.einsum('ij,ij->i', diff, diff) + trace_gen + np.trace(sigma_real)
+    
+    # gram_mean[b] = Y·ν_b，gram_center[b] = ν_b·ν_b（ν_b 為重抽樣後投影特徵的平均）
+    gram_mean = weights @ gram / n
+    gram_center = np.einsum('ij,ij->i', gram_mean, weights) / n
+    num_samples = len(weights)
+    report_every = max(1, num_samples // 10)
+    verbose = False
+    start = time.perf_counter()
+    for b, counts in enumerate(weights):
+        support = np.nonzero(counts)[0]
+        row_mean = gram_mean[b, support]
+        centered = gram[np.ix_(support, support)] - row_mean[:, None] - row_mean[None, :] + gram_center[b]
+        root = np.sqrt(counts[support])
+        eig = np.linalg.eigvalsh(root[:, None] * centered * root[None, :]) / (n - 1)
+        fid[b] -= 2 * np.sqrt(np.clip(eig, 0, None)).sum()
+        done = b + 1
+        elapsed = time.perf_counter() - start
+        if done == 1 and elapsed * num_samples > BOOTSTRAP_SLOW_SECONDS:
+            verbose = True
+            print(f"  FID {num_samples} 次重抽樣預估需 {elapsed * num_samples:.0f} 秒"
+                  f"（可用 --fid_bootstrap 減少次數）")
+        if verbose and done < num_samples and done % report_every == 0:
+            print(f"  FID 重抽樣 {done}/{num_samples}"
+                  f"（已用 {elapsed:.1f} 秒，預估剩餘 {elapsed / done * (num_samples - done):.1f} 秒）")
+    return fid
+
+def polynomial_kernel(x, y):
+    """KID 使用的三次多項式核（與 torch_fidelity 預設相同）"""
+    return (x @ y.T / x.shape[1] + 1) ** 3
+
+def bootstrap_kid(gen_features, real_features, weights):
+    """重抽樣生成圖片特徵（參考集固定）計算完整樣本的無偏 MMD²
+    
+    與 KID 的子集平均估計量期望值相同，用於估計其抽樣變異。
+    """
+    gen = np.asarray(gen_features, dtype=np.float64)
+    real = np.asarray(real_features, dtype=np.float64)
+    n, m = len(gen), len(real)
+    
+    k_gen = polynomial_kernel(gen, gen)
+    k_cross = polynomial_kernel(gen, real)
+    k_real = polynomial_kernel(real, real)
+    
+    term_real = (k_real.sum() - np.trace(k_real)) / (m * (m - 1))
+    term_gen = (np.einsum('ij,ij->i', weights @ k_gen, weights) - weights @ np.diag(k_gen)) / (n * (n - 1))
+    term_cross = weights @ k_cross.sum(axis=1) / (n * m)
+    return term_gen + term_real - 2 * term_cross
+
+def bootstrap_fid_kid_intervals(gen_features, real_features, real_stats, num_samples, ci,
+                                fid_samples=None):
+    """以同一組重抽樣計算 FID 與 KID 的信賴區間（FID 只用前 fid_samples 組）"""
+    if fid_samples is None:
+        fid_samples = num_samples
+    weights = bootstrap_weights(len(gen_features), num_samples)
+    return {
+        'fid_ci': percentile_interval(bootstrap_fid(gen_features, real_stats, weights[:fid_samples]), ci),
+        'kid_ci': percentile_interval(bootstrap_kid(gen_features, real_features, weights), ci)
+    }
+
+def bootstrap_lpips_interval(scores, num_samples, ci):
+    """逐張 LPIPS 分數平均值的信賴區間"""
+    weights = bootstrap_weights(len(scores), num_samples)
+    return percentile_interval(bootstrap_mean(scores, weights), ci)
+
+def format_interval(results, key, ci):
+    """格式化信賴區間，未計算時回傳空字串"""
+    if key not in results:
+        return ''
+    low, high = results[key]
+    return f"  ({ci:g}% CI: {low:.4f} – {high:.4f})"
+
+def fid_kid_from_features(gen_features, real_features, gen_stats=None, real_stats=None,
+                          kid_subset_size=KID_SUBSET_SIZE, bootstrap=0, ci=95, fid_bootstrap=None):
+    """由 Inception 特徵計算 FID 和 KID，bootstrap 大於 0 時附上信賴區間
+    
+    FID 的重抽樣次數見 resolve_fid_bootstrap。
+    """
+    if gen_stats is None:
+        gen_stats = fid_features_to_statistics(gen_features)
+    if real_stats is None:
+        real_stats = fid_features_to_statistics(real_features)
+    fid = fid_statistics_to_metric(gen_stats, real_stats, verbose=False)
+    kid = kid_features_to_metric(gen_features, real_features,
+                                 kid_subset_size=kid_subset_size, verbose=False)
+    results = {
+        'fid': fid['frechet_inception_distance'],
+        'kid': kid['kernel_inception_distance_mean']
+    }
+    if bootstrap > 0:
+        fid_samples = resolve_fid_bootstrap(bootstrap, fid_bootstrap)
+        print(f"計算自助法重抽樣（KID {bootstrap} 次，FID {fid_samples} 次）...")
+        results.update(bootstrap_fid_kid_intervals(
+            gen_features.numpy(), real_features.numpy(), real_stats, bootstrap, ci,
+            fid_samples=fid_samples
+        ))
+    return results
+
+# 增量評估的狀態檔名（存放於生成圖片目錄中）
+FID_STATE_NAME = '.fid_kid_state.npz'
+
+def feature_extractor_tag():
+    """特徵擷取器識別字串，用於判斷快取與狀態檔是否可沿用"""
+    return f'{FEATURE_EXTRACTOR}:{FEATURE_LAYER}:{torch_fidelity.__version__}'
 
-def calculate_fid_kid(gen_dir, real_dir):
+def file_stamps(files):
+    """回傳 {檔名: (大小, 修改時間)}，用於判斷檔案是否變動"""
+    stamps = {}
+    for file_path in files:
+        stamps[os.path.basename(file_path)] = dataset_io.file_stat(file_path)
+    return stamps
+
+class FeatureAccumulator:
+    """累積 Inception 特徵的總和與外積和，支援逐批加入與移除圖片"""
+    
+    def __init__(self, dim=int(FEATURE_LAYER)):
+        self.tag = feature_extractor_tag()
+        self.names = []
+        self.stamps = []
+        self.count = 0
+        self.feature_sum = np.zeros(dim, dtype=np.float64)
+        self.outer_sum = np.zeros((dim, dim), dtype=np.float64)
+        self.features = np.zeros((0, dim), dtype=np.float32)
+    
+    @classmethod
+    def load(cls, state_file):
+        """讀取狀態檔；版本不符時回傳空的累加器"""
+        state = np.load(state_file)
+        acc = cls(dim=state['feature_sum'].shape[0])
+        if str(state['tag']) != acc.tag:
+            print("⚠️  狀態檔的特徵擷取器版本不同，重新累積")
+            return acc
+        acc.names = [str(name) for name in state['names']]
+        acc.stamps = [tuple(int(v) for v in stamp) for stamp in state['stamps']]
+        acc.count = int(state['count'])
+        acc.feature_sum = state['feature_sum']
+        acc.outer_sum = state['outer_sum']
+        acc.features = state['features']
+        return acc
+    
+    def save(self, state_file):
+        """以原子方式寫入狀態檔"""
+        state_file = Path(state_file)
+        tmp_file = state_file.with_name(state_file.name + f'.{os.getpid()}.tmp')
+        with open(tmp_file, 'wb') as f:
+            np.savez(
+                f,
+                tag=np.array(self.tag),
+                names=np.array(self.names, dtype=str),
+                stamps=np.array(self.stamps, dtype=np.int64).reshape(-1, 2),
+                count=np.array(self.count),
+                feature_sum=self.feature_sum,
+                outer_sum=self.outer_sum,
+                features=self.features
+            )
+        os.replace(tmp_file, state_file)
+    
+    def add(self, names, stamps, features):
+        """加入新圖片的特徵"""
+        features = np.asarray(features, dtype=np.float32)
+        features64 = features.astype(np.float64)
+        self.names.extend(names)
+        self.stamps.extend(stamps)
+        self.count += len(names)
+        self.feature_sum += features64.sum(axis=0)
+        self.outer_sum += features64.T @ features64
+        self.features = np.concatenate([self.features, features], axis=0)
+    
+    def remove(self, names):
+        """移除已刪除或已變動圖片的特徵"""
+        names = set(names)
+        keep = np.array([name not in names for name in self.names], dtype=bool)
+        removed = self.features[~keep].astype(np.float64)
+        self.feature_sum -= removed.sum(axis=0)
+        self.outer_sum -= removed.T @ removed
+        self.count -= len(removed)
+        self.names = [name for name, k in zip(self.names, keep) if k]
+        self.stamps = [stamp for stamp, k in zip(self.stamps, keep) if k]
+        self.features = self.features[keep]
+    
+    def statistics(self):
+        """由累積和計算平均值與共變異數矩陣"""
+        mu = self.feature_sum / self.count
+        sigma = (self.outer_sum - self.count * np.outer(mu, mu)) / (self.count - 1)
+        return {'mu': mu, 'sigma': sigma}
+    
+    def sorted_features(self):
+        """依檔名排序的特徵，與完整重算時的順序一致"""
+        order = np.argsort(np.array(self.names, dtype=str), kind='stable')
+        return torch.from_numpy(self.features[order])
+
+def update_feature_state(gen_dir, device, state_file=None):
+    """只擷取新增或變動圖片的特徵，並更新狀態檔"""
+    state_file = Path(state_file) if state_file else Path(gen_dir) / FID_STATE_NAME
+    files = list_fid_files(gen_dir)
+    stamps = file_stamps(files)
+    
+    acc = FeatureAccumulator.load(state_file) if state_file.exists() else FeatureAccumulator()
+    
+    # 移除已刪除或內容變動的圖片
+    stale = [name for name, stamp in zip(acc.names, acc.stamps) if stamps.get(name) != stamp]
+    if stale:
+        print(f"移除 {len(stale)} 張已刪除或已變動的圖片")
+        acc.remove(stale)
+    
+    seen = set(acc.names)
+    new_files = [f for f in files if os.path.basename(f) not in seen]
+    if new_files:
+        print(f"擷取新增圖片特徵（{len(new_files)} 張）...")
+        features = extract_inception_features(new_files, device)
+        names = [os.path.basename(f) for f in new_files]
+        acc.add(names, [stamps[name] for name in names], features.numpy())
+    if new_files or stale:
+        acc.save(state_file)
+    
+    print(f"累積圖片數：{acc.count}（新增 {len(new_files)} 張）")
+    return acc
+
+def calculate_fid_kid_incremental(gen_dir, real_dir, device='cuda', cache_dir=DEFAULT_CACHE_DIR,
+                                  kid_subset_size=KID_SUBSET_SIZE, state_file=None, bootstrap=0, ci=95,
+                                  fid_bootstrap=None):
+    """增量計算 FID 和 KID：只處理上次評估後新增的生成圖片"""
+    print(f"增量計算 FID/KID 分數...")
+    print(f"生成圖片目錄：{gen_dir}")
+    print(f"真實圖片目錄：{real_dir}")
+    
+    try:
+        real_features, real_stats = load_reference_features(real_dir, device, cache_dir)
+        acc = update_feature_state(gen_dir, device, state_file)
+        if acc.count < 2:
+            raise ValueError("生成圖片數量不足")
+        
+        # 累積統計量為 float64，參考集平均值需轉為相同型別
+        real_stats = {'mu': real_stats['mu'].astype(np.float64), 'sigma': real_stats['sigma']}
+        return fid_kid_from_features(acc.sorted_features(), real_features,
+                                     gen_stats=acc.statistics(), real_stats=real_stats,
+                                     kid_subset_size=kid_subset_size, bootstrap=bootstrap, ci=ci,
+                                     fid_bootstrap=fid_bootstrap)
+    except Exception as e:
+        print(f"計算 FID/KID 時出錯：{e}")
+        return None
+
+def calculate_fid_kid(gen_dir, real_dir, device='cuda', cache_dir=DEFAULT_CACHE_DIR,
+                      kid_subset_size=KID_SUBSET_SIZE, bootstrap=0, ci=95, fid_bootstrap=None):
     """計算 FID 和 KID 分數"""
     print(f"計算 FID/KID 分數...")
     print(f"生成圖片目錄：{gen_dir}")
     print(f"真實圖片目錄：{real_dir}")
     
     try:
-        metrics = calculate_metrics(
-            input1=gen_dir,
-            input2=real_dir,
-            fid=True,
-            kid=True,
-            verbose=True
-        )
+        real_features, real_stats = load_reference_features(real_dir, device, cache_dir)
         
-        return {
-            'fid': metrics['frechet_inception_distance'],
-            'kid': metrics['kernel_inception_distance_mean']
-        }
+        gen_files = list_fid_files(gen_dir)
+        if not gen_files:
+            raise ValueError(f"生成目錄中沒有圖片：{gen_dir}")
+        print(f"擷取生成圖片特徵（{len(gen_files)} 張）...")
+        gen_features = extract_inception_features(gen_files, device)
+        
+        return fid_kid_from_features(gen_features, real_features, real_stats=real_stats,
+                                     kid_subset_size=kid_subset_size, bootstrap=bootstrap, ci=ci,
+                                     fid_bootstrap=fid_bootstrap)
     except Exception as e:
         print(f"計算 FID/KID 時出錯：{e}")
         return None
 
+def masked_pixel_metrics(gen, real, mask):
+    """計算遮罩區域內的 PSNR 與 SSIM（輸入為 H×W×3 uint8 圖片與 H×W uint8 遮罩）"""
+    height, width = real.shape[:2]
+    if gen.shape[:2] != (height, width):
+        gen = cv2.resize(gen, (width, height))
+    if mask.shape != (height, width):
+        mask = cv2.resize(mask, (width, height), interpolation=cv2.INTER_NEAREST)
+    
+    region = mask > 127
+    if not region.any():
+        return float('nan'), float('nan')
+    
+    psnr = peak_signal_noise_ratio(real[region], gen[region], data_range=255)
+    _, ssim_map = structural_similarity(real, gen, channel_axis=2, data_range=255, full=True)
+    return float(psnr), float(ssim_map[region].mean())
+
+class AllMetricsDataset(Dataset):
+    """每張圖片只解碼一次，產生 Inception、Masked LPIPS 與像素指標所需的輸入"""
+    
+    def __init__(self, pairs):
+        self.pairs = pairs
+    
+    def __len__(self):
+        return len(self.pairs)
+    
+    def __getitem__(self, idx):
+        stem, gen_file, real_file, mask_file = self.pairs[idx]
+        try:
+            gen_img, gen_array = read_rgb(gen_file)
+            real_img, real_array = read_rgb(real_file)
+            mask = dataset_io.imread(mask_file, cv2.IMREAD_GRAYSCALE)
+            if mask is None:
+                raise ValueError(f"無法讀取遮罩 {mask_file}")
+            
+            lpips_mask = mask_to_lpips_tensor(mask)
+            mask_area = float(mask.mean()) / 255.0
+            psnr, ssim = masked_pixel_metrics(gen_array, real_array, mask)
+            return {
+                'stem': stem,
+                'inception': torch.from_numpy(gen_array).permute(2, 0, 1).contiguous(),
+                'gen_lpips': image_to_lpips_tensor(gen_img) * lpips_mask,
+                'real_lpips': image_to_lpips_tensor(real_img) * lpips_mask,
+                'psnr': psnr,
+                'ssim': ssim,
+                'mask_area': mask_area
+            }
+        except Exception as e:
+            return {'stem': stem, 'error': str(e)}
+
+def collate_all_metrics(samples):
+    """堆疊單次解碼的結果；Inception 輸入依圖片尺寸分組，並記錄每組在批次中的位置
+    
+    以位置而非主幹對應特徵：同一人物搭配不同衣服的圖片對主幹相同。
+    """
+    valid = [s for s in samples if 'error' not in s]
+    batch = {
+        'stems': [s['stem'] for s in valid],
+        'failures': [(s['stem'], s['error']) for s in samples if 'error' in s],
+        'psnr': [s['psnr'] for s in valid],
+        'ssim': [s['ssim'] for s in valid],
+        'mask_area': [s['mask_area'] for s in valid],
+        'inception': []
+    }
+    if valid:
+        batch['gen_lpips'] = torch.stack([s['gen_lpips'] for s in valid])
+        batch['real_lpips'] = torch.stack([s['real_lpips'] for s in valid])
+        groups = {}
+        for position, s in enumerate(valid):
+            positions, tensors = groups.setdefault(tuple(s['inception'].shape), ([], []))
+            positions.append(position)
+            tensors.append(s['inception'])
+        batch['inception'] = [(positions, torch.stack(tensors)) for positions, tensors in groups.values()]
+    return batch
+
+def iter_all_metrics(pairs, evaluator, inception, device='cuda', batch_size=1, num_workers=0,
+                     loader='process'):
+    """逐張產生綜合評估紀錄（LPIPS、PSNR、SSIM、遮罩面積與 Inception 特徵）
+    
+    失敗的圖片只帶有 stem 與 error 欄位。
+    """
+    batch_iter = make_loader(AllMetricsDataset(pairs), batch_size, num_workers,
+                             collate_all_metrics, device, loader)
+    
+    for batch in batch_iter:
+        for name, error in batch['failures']:
+            yield {'stem': name, 'error': error}
+        if not batch['stems']:
+            continue
+        
+        try:
+            with torch.no_grad():
+                scores = evaluator.lpips_fn(
+                    batch['gen_lpips'].to(device, non_blocking=True),
+                    batch['real_lpips'].to(device, non_blocking=True)
+                )
+                features = [None] * len(batch['stems'])
+                for positions, group in batch['inception']:
+                    group_features = inception(group.to(device, non_blocking=True))[0].cpu().numpy()
+                    for position, feature in zip(positions, group_features):
+                        features[position] = feature
+            scores = scores.flatten().tolist()
+        except Exception as e:
+            for name in batch['stems']:
+                yield {'stem': name, 'error': str(e)}
+            continue
+        
+        for stem, lpips_score, psnr, ssim, mask_area, feature in zip(
+                batch['stems'], scores, batch['psnr'], batch['ssim'], batch['mask_area'], features):
+            yield {'stem': stem, 'lpips': lpips_score, 'psnr': psnr, 'ssim': ssim,
+                   'mask_area': mask_area, 'feature': feature}
+
+class MetricsCollector:
+    """彙整逐張紀錄：串流寫出逐張分數、保留最差 k 張，最後計算整體指標
+    
+    紀錄為 iter_all_metrics 產生的字典；只有 feature 的紀錄（fid_kid 模式）
+    只參與 FID/KID，沒有 feature 的紀錄（masked_lpips 模式）只參與逐張指標。
+    """
+    
+    def __init__(self, per_image_out=None, fields=ALL_PER_IMAGE_FIELDS, worst_k=0):
+        self.per_image_out = per_image_out
+        self.writer = PerImageWriter(per_image_out, fields) if per_image_out else None
+        self.worst_k = worst_k
+        self.worst = []
+        self.lpips_scores = []
+        self.psnr_scores = []
+        self.ssim_scores = []
+        self.features = []
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+    
+    def write_report(self, report):
+        """寫出配對報告中的失敗紀錄"""
+        if self.writer:
+            for record in pairing_report_records(report):
+                self.writer.write(record)
+    
+    def add(self, record):
+        if 'error' in record:
+            print(f"處理檔案時出錯 {record['stem']}: {record['error']}")
+        else:
+            if record.get('lpips') is not None:
+                self.lpips_scores.append(record['lpips'])
+                push_worst(self.worst, self.worst_k, record['lpips'], record['stem'])
+            if record.get('psnr') is not None:
+                self.psnr_scores.append(record['psnr'])
+                self.ssim_scores.append(record['ssim'])
+            if record.get('feature') is not None:
+                self.features.append(record['feature'])
+        if self.writer:
+            self.writer.write(record)
+    
+    def close(self):
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+            print(f"逐張分數已寫入 {self.per_image_out}")
+    
+    def results(self, real_features=None, real_stats=None, kid_subset_size=KID_SUBSET_SIZE,
+                bootstrap=0, ci=95, fid_bootstrap=None):
+        """計算整體指標；有 Inception 特徵時需提供參考集特徵與統計量"""
+        if not self.lpips_scores and not self.features:
+            raise ValueError("沒有有效的圖片對")
+        print_worst(self.worst)
+        
+        results = {}
+        if self.features:
+            gen_features = torch.from_numpy(np.stack(self.features))
+            results.update(fid_kid_from_features(gen_features, real_features, real_stats=real_stats,
+                                                 kid_subset_size=kid_subset_size,
+                                                 bootstrap=bootstrap, ci=ci,
+                                                 fid_bootstrap=fid_bootstrap))
+        if self.lpips_scores:
+            # 依序累加，與 masked_lpips 模式的平均值一致
+            total_lpips = 0.0
+            for lpips_score in self.lpips_scores:
+                total_lpips += lpips_score
+            results['masked_lpips'] = total_lpips / len(self.lpips_scores)
+            if self.psnr_scores:
+                results['masked_psnr'] = float(np.nanmean(self.psnr_scores))
+                results['masked_ssim'] = float(np.nanmean(self.ssim_scores))
+            results['num_pairs'] = len(self.lpips_scores)
+            if bootstrap > 0:
+                results['masked_lpips_ci'] = bootstrap_lpips_interval(self.lpips_scores, bootstrap, ci)
+        return results
+
+def calculate_all_metrics(gen_dir, real_dir, mask_dir, device='cuda', batch_size=1, num_workers=0,
+                          pairs_file=None, cache_dir=DEFAULT_CACHE_DIR, kid_subset_size=KID_SUBSET_SIZE,
+                          loader='process', per_image_out=None, worst_k=0, bootstrap=0, ci=95,
+                          backend='torch', precision='fp32', quant_tolerance=QUANT_TOLERANCE,
+                          fid_bootstrap=None):
+    """單次解碼計算 FID/KID、Masked LPIPS 與 Masked PSNR/SSIM
+    
+    每張生成圖片與真實圖片只解碼一次；參考集的 Inception 特徵取自快取
+    （快取未命中時擷取一次），FID/KID 與 fid_kid 模式使用相同的參考集。
+    per_image_out 與 worst_k 的用法同 MaskedLPIPS.calculate_masked_lpips；
+    bootstrap 大於 0 時以已擷取的特徵與逐張分數計算信賴區間，不重新執行網路。
+    """
+    pairs, report = build_pair_index(gen_dir, real_dir, mask_dir, pairs_file)
+    print_pairing_report(report)
+    if not pairs:
+        raise ValueError("找不到可配對的圖片")
+    
+    real_features, real_stats = load_reference_features(real_dir, device, cache_dir)
+    
+    evaluator = MaskedLPIPS(device=device, backend=backend, cache_dir=cache_dir,
+                            precision=precision, quant_tolerance=quant_tolerance)
+    evaluator.apply_precision(pairs)
+    inception = create_inception(device)
+    
+    print(f"計算 {len(pairs)} 組圖片對的所有指標...")
+    with MetricsCollector(per_image_out, worst_k=worst_k) as collector:
+        collector.write_report(report)
+        for record in iter_all_metrics(pairs, evaluator, inception, device, batch_size,
+                                       num_workers, loader):
+            collector.add(record)
+    
+    return collector.results(real_features, real_stats, kid_subset_size=kid_subset_size,
+                             bootstrap=bootstrap, ci=ci, fid_bootstrap=fid_bootstrap)
+
+def print_results(results, ci=95):
+    """輸出評估結果中存在的指標"""
+    if 'num_pairs' in results:
+        print(f"\n結果（{results['num_pairs']} 組圖片對）：")
+    else:
+        print(f"\n結果：")
+    if 'fid' in results:
+        print(f"FID: {results['fid']:.4f}{format_interval(results, 'fid_ci', ci)}")
+        print(f"KID: {results['kid']:.4f}{format_interval(results, 'kid_ci', ci)}")
+    if 'masked_lpips' in results:
+        print(f"Masked LPIPS: {results['masked_lpips']:.4f}"
+              f"{format_interval(results, 'masked_lpips_ci', ci)}")
+    if 'masked_psnr' in results:
+        print(f"Masked PSNR: {results['masked_psnr']:.4f}")
+        print(f"Masked SSIM: {results['masked_ssim']:.4f}")
+
+def create_resize_cache(args):
+    """依命令列參數建立 masked_lpips 的縮放快取（<feature_cache_dir>/resize），停用時回傳 None"""
+    if args.no_resize_cache or not args.feature_cache_dir:
+        return None
+    return ResizeCache(os.path.join(args.feature_cache_dir, 'resize'),
+                       max_bytes=int(args.resize_cache_size * (1 << 30)))
+
+def parse_shard(value):
+    """解析 --shard 參數 i/N（i 從 0 開始）"""
+    try:
+        shard, num_shards = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"分片格式應為 i/N：{value}")
+    if num_shards <= 0 or not 0 <= shard < num_shards:
+        raise argparse.ArgumentTypeError(f"分片編號超出範圍：{value}")
+    return shard, num_shards
+
+# 各模式寫入分片結果的逐張欄位
+PARTIAL_FIELDS = {
+    'fid_kid': (),
+    'masked_lpips': ('lpips', 'mask_area'),
+    'all': ('lpips', 'psnr', 'ssim', 'mask_area')
+}
+
+def save_partial(path, mode, shard, num_shards, real_dir, indexed_records):
+    """寫出單一分片的部分結果
+    
+    indexed_records 為 (全域索引, 紀錄) 串列；索引為圖片對（或 fid_kid 模式下
+    生成圖片）在完整清單中的位置，merge 依索引排序，使合併結果與不分片時一致。
+    """
+    columns = {
+        key: np.array([record.get(key, np.nan) for _, record in indexed_records], dtype=np.float64)
+        for key in PARTIAL_FIELDS[mode]
+    }
+    feature_rows = [row for row, (_, record) in enumerate(indexed_records) if 'feature' in record]
+    features = [indexed_records[row][1]['feature'] for row in feature_rows]
+    
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = f"{path}.tmp.npz"
+    np.savez(
+        tmp_path,
+        mode=mode, shard=shard, num_shards=num_shards, real_dir=os.path.abspath(real_dir),
+        indices=np.array([index for index, _ in indexed_records], dtype=np.int64),
+        stems=np.array([record['stem'] for _, record in indexed_records], dtype=str),
+        errors=np.array([record.get('error', '') for _, record in indexed_records], dtype=str),
+        feature_rows=np.array(feature_rows, dtype=np.int64),
+        features=np.stack(features) if features else np.zeros((0, 0), dtype=np.float32),
+        **columns
+    )
+    os.replace(tmp_path, path)
+
+def load_partials(paths):
+    """讀取並合併分片結果，回傳 (模式, 參考集目錄, 依全域索引排序的紀錄)"""
+    indexed_records = []
+    modes = set()
+    real_dirs = set()
+    shards = set()
+    num_shards = set()
+    for path in paths:
+        with np.load(path) as npz:
+            data = {key: npz[key] for key in npz.files}
+        mode = str(data['mode'])
+        modes.add(mode)
+        real_dirs.add(str(data['real_dir']))
+        shards.add(int(data['shard']))
+        num_shards.add(int(data['num_shards']))
+        features = dict(zip(data['feature_rows'].tolist(), data['features']))
+        for row, index in enumerate(data['indices'].tolist()):
+            record = {'stem': str(data['stems'][row])}
+            if data['errors'][row]:
+                record['error'] = str(data['errors'][row])
+            else:
+                for key in PARTIAL_FIELDS[mode]:
+                    record[key] = float(data[key][row])
+            if row in features:
+                record['feature'] = features[row]
+            indexed_records.append((index, record))
+    
+    if len(modes) != 1 or len(real_dirs) != 1 or len(num_shards) != 1:
+        raise ValueError("分片結果的模式、參考集或分片數不一致")
+    missing = sorted(set(range(num_shards.pop())) - shards)
+    if missing:
+        raise ValueError(f"缺少分片：{', '.join(str(shard) for shard in missing)}")
+    
+    indexed_records.sort(key=lambda item: item[0])
+    return modes.pop(), real_dirs.pop(), [record for _, record in indexed_records]
+
+def run_shard(args):
+    """計算 --shard 指定的分片並寫出部分結果"""
+    shard, num_shards = args.shard
+    indexed_records = []
+    
+    if args.mode == 'fid_kid':
+        files = list_fid_files(args.gen_dir)
+        selected = list(range(shard, len(files), num_shards))
+        print(f"分片 {shard}/{num_shards}：擷取 {len(selected)} 張生成圖片的特徵...")
+        if selected:
+            features = extract_inception_features([files[i] for i in selected], args.device,
+                                                  num_workers=args.num_workers)
+            for index, feature in zip(selected, features.numpy()):
+                indexed_records.append((index, {'stem': os.path.basename(files[index]),
+                                                'feature': feature}))
+    else:
+        pairs, report = build_pair_index(args.gen_dir, args.real_dir, args.mask_dir, args.pairs_file)
+        if shard == 0:
+            # 配對報告的失敗紀錄放在第 0 個分片，以負索引排在所有圖片對之前
+            print_pairing_report(report)
+            failures = list(pairing_report_records(report))
+            for offset, record in enumerate(failures):
+                indexed_records.append((offset - len(failures), record))
+        selected = list(range(shard, len(pairs), num_shards))
+        # 以配對索引取代主幹傳入評估：同一人物搭配不同衣服的圖片對主幹相同
+        shard_pairs = [(i,) + pairs[i][1:] for i in selected]
+        print(f"分片 {shard}/{num_shards}：計算 {len(shard_pairs)} 組圖片對...")
+        
+        evaluator = MaskedLPIPS(device=args.device, backend=args.backend,
+                                cache_dir=None if args.no_feature_cache else args.feature_cache_dir,
+                                precision=args.precision, quant_tolerance=args.quant_tolerance,
+                                resize_cache=create_resize_cache(args))
+        # 每個分片都以完整清單的前幾組圖片對校正，量化模型在各分片間一致
+        if args.mode == 'masked_lpips':
+            evaluator.apply_precision(pairs, args.crop_padding if args.crop_bbox else None,
+                                      args.reduced_decode)
+            records = (
+                {'stem': stem, 'error': error} if error is not None
+                else {'stem': stem, 'lpips': score, 'mask_area': mask_area}
+                for stem, score, mask_area, error in evaluator.iter_masked_lpips(
+                    shard_pairs, args.batch_size, args.num_workers,
+                    crop_padding=args.crop_padding if args.crop_bbox else None,
+                    reduced_decode=args.reduced_decode, loader=args.loader
+                )
+            )
+        else:
+            evaluator.apply_precision(pairs)
+            records = iter_all_metrics(shard_pairs, evaluator, create_inception(args.device),
+                                       args.device, args.batch_size, args.num_workers, args.loader)
+        for record in records:
+            index = record['stem']
+            record['stem'] = pairs[index][0]
+            indexed_records.append((index, record))
+    
+    save_partial(args.partial_out, args.mode, shard, num_shards, args.real_dir, indexed_records)
+    print(f"分片結果已寫入 {args.partial_out}")
+
+def merge_partials(paths, args):
+    """合併分片結果並計算最終指標；有 Inception 特徵時自快取載入參考集特徵"""
+    mode, real_dir, records = load_partials(paths)
+    print(f"合併 {len(paths)} 個分片（{mode} 模式，共 {len(records)} 筆紀錄）")
+    
+    fields = PER_IMAGE_FIELDS if mode == 'masked_lpips' else ALL_PER_IMAGE_FIELDS
+    with MetricsCollector(args.per_image_out, fields, worst_k=args.worst_k) as collector:
+        for record in records:
+            collector.add(record)
+    
+    real_features = real_stats = None
+    if collector.features:
+        real_features, real_stats = load_reference_features(
+            args.real_dir or real_dir, args.device,
+            None if args.no_feature_cache else args.feature_cache_dir
+        )
+    return collector.results(real_features, real_stats, kid_subset_size=args.kid_subset_size,
+                             bootstrap=args.bootstrap, ci=args.ci, fid_bootstrap=args.fid_bootstrap)
+
+def write_results_json(results, path):
+    """將評估結果寫入 JSON 檔（path 為 None 時不寫出）"""
+    if path:
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"結果已寫入 {path}")
+
+# 只由啟動器處理的參數（合併時使用），不傳給子程序
+LAUNCHER_ONLY_ARGS = ('--launch', '--partial_dir', '--threads_per_shard', '--output_json',
+                      '--per_image_out', '--worst_k', '--bootstrap', '--fid_bootstrap', '--ci')
+
+def child_argv(argv):
+    """移除啟動器專用參數，回傳傳給子程序的參數"""
+    result = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+            continue
+        name = arg.split('=', 1)[0]
+        if name in LAUNCHER_ONLY_ARGS:
+            # 這些參數都帶一個值；--name=value 形式不需略過下一個參數
+            skip = '=' not in arg
+            continue
+        result.append(arg)
+    return result
+
+def launch_shards(args, argv):
+    """在本機以 args.launch 個子程序平行計算分片，並合併結果
+    
+    每個子程序限制 torch/OpenMP/MKL 的執行緒數，並在支援時綁定到不重疊的 CPU，
+    避免多個程序的執行緒互相搶占核心。
+    """
+    import subprocess
+    
+    num_shards = args.launch
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else \
+        list(range(os.cpu_count() or 1))
+    threads = args.threads_per_shard or max(1, len(cpus) // num_shards)
+    partial_dir = Path(args.partial_dir or os.path.join(args.gen_dir, '.eval_shards'))
+    partial_dir.mkdir(parents=True, exist_ok=True)
+    
+    base_argv = child_argv(argv)
+    env = dict(os.environ, OMP_NUM_THREADS=str(threads), MKL_NUM_THREADS=str(threads))
+    processes = []
+    paths = []
+    for shard in range(num_shards):
+        path = partial_dir / f"shard_{shard:03d}_of_{num_shards:03d}.npz"
+        command = [sys.executable, os.path.abspath(__file__), *base_argv,
+                   '--shard', f"{shard}/{num_shards}", '--partial_out', str(path),
+                   '--num_threads', str(threads)]
+        shard_cpus = cpus[shard * threads:(shard + 1) * threads]
+        if len(shard_cpus) == threads:
+            command += ['--cpu_affinity', ','.join(str(cpu) for cpu in shard_cpus)]
+        processes.append(subprocess.Popen(command, env=env))
+        paths.append(str(path))
+    
+    print(f"啟動 {num_shards} 個分片程序（每個 {threads} 個執行緒）")
+    failed = [shard for shard, process in enumerate(processes) if process.wait() != 0]
+    if failed:
+        raise RuntimeError(f"分片執行失敗：{', '.join(str(shard) for shard in failed)}")
+    return merge_partials(paths, args)
+
+# inotify 事件：寫入後關閉、移入目錄（inference 以暫存檔改名時）
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+
+class DirectoryWatcher:
+    """回報目錄中寫入完成的圖片檔名
+    
+    Linux 上以 inotify 監看 IN_CLOSE_WRITE / IN_MOVED_TO；無法使用時改為輪詢，
+    檔案大小與修改時間在連續兩次掃描間不變才視為寫入完成。
+    啟動時已存在的檔案在第一次 poll（輪詢時為第二次）時回報。
+    目錄尚未建立時視為沒有檔案並持續輪詢，目錄出現後才建立 inotify 監看。
+    """
+    
+    def __init__(self, directory, poll_interval=1.0, use_inotify=True):
+        self.directory = str(directory)
+        self.poll_interval = poll_interval
+        self.fd = self.open_inotify() if use_inotify else None
+        # 目錄不存在時 inotify 無法監看，目錄建立後再試一次
+        self.retry_inotify = use_inotify and self.fd is None and not os.path.isdir(self.directory)
+        self.initial = True
+        self.stats = {}
+        self.reported = {}
+    
+    def open_inotify(self):
+        """建立 inotify 監看，失敗時回傳 None 改用輪詢"""
+        if not sys.platform.startswith('linux'):
+            return None
+        try:
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                return None
+            if libc.inotify_add_watch(fd, os.fsencode(self.directory),
+                                      IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+                os.close(fd)
+                return None
+            return fd
+        except (OSError, AttributeError):
+            return None
+    
+    @property
+    def mode(self):
+        return 'inotify' if self.fd is not None else 'polling'
+    
+    def scan(self):
+        """掃描目錄，回傳 {檔名: (大小, 修改時間)}"""
+        stats = {}
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if os.path.splitext(entry.name)[1] in IMAGE_EXTS and entry.is_file():
+                        stat = entry.stat()
+                        stats[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        except FileNotFoundError:
+            pass  # 推論尚未建立輸出目錄
+        return stats
+    
+    def poll(self, timeout=None):
+        """等待最多 timeout 秒（預設 poll_interval），回傳新寫入完成的檔名列表"""
+        timeout = self.poll_interval if timeout is None else timeout
+        if self.retry_inotify and os.path.isdir(self.directory):
+            # 目錄建立後改用 inotify，並先回報目前已有的檔案
+            self.retry_inotify = False
+            self.fd = self.open_inotify()
+            if self.fd is not None:
+                self.initial = True
+                self.stats = {}
+        if self.fd is not None:
+            if self.initial:
+                self.initial = False
+                return sorted(self.scan())
+            return self.read_events(timeout)
+        
+        if not self.initial:
+            time.sleep(timeout)
+        self.initial = False
+        stats = self.scan()
+        completed = []
+        for name, stat in sorted(stats.items()):
+            if stat[0] > 0 and self.stats.get(name) == stat and self.reported.get(name) != stat:
+                self.reported[name] = stat
+                completed.append(name)
+        self.stats = stats
+        return completed
+    
+    def read_events(self, timeout):
+        """讀取 inotify 事件（struct inotify_event：wd, mask, cookie, len, name）"""
+        import select
+        
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        names = []
+        data = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset + 16 <= len(data):
+            _, _, _, length = struct.unpack_from('iIII', data, offset)
+            name = os.fsdecode(data[offset + 16:offset + 16 + length].split(b'\0', 1)[0])
+            offset += 16 + length
+            if os.path.splitext(name)[1] in IMAGE_EXTS and name not in names:
+                names.append(name)
+        return names
+    
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+def watch_metrics(args):
+    """監看生成目錄，圖片寫入完成後即以微批次評估，預期的圖片全部出現後輸出結果
+    
+    預期的圖片由 --pairs_file 決定；讀取失敗的圖片在再次寫入時重新評估。
+    最終結果依配對檔順序彙整，與評估完成後的目錄得到相同的數值。
+    --precision 為 bf16/int8 時，出現的圖片對足以提供校正集與保留集
+    （2 × QUANT_CALIBRATION_SIZE 組）之前先以 fp32 評估，之後才改用量化模型，
+    因此結果會混合兩種精度；需要與目錄評估一致時請使用 fp32。
+    """
+    real_index = scan_image_stems(args.real_dir)
+    mask_index = scan_image_stems(args.mask_dir)
+    
+    # 生成圖片主幹 -> (配對順序, 人物主幹, 真實圖片, 遮罩)
+    expected = {}
+    report = {'missing_gen': [], 'missing_real': [], 'missing_mask': [], 'unused_gen': []}
+    for order, (person, cloth) in enumerate(read_pairs_file(args.pairs_file)):
+        real_file = real_index.get(person)
+        _, mask_file = lookup_stem(mask_index, [person + suffix for suffix in MASK_SUFFIXES])
+        if real_file is None:
+            report['missing_real'].append(person)
+        elif mask_file is None:
+            report['missing_mask'].append(person)
+        else:
+            for pattern in GEN_NAME_PATTERNS:
+                expected.setdefault(pattern.format(person=person, cloth=cloth),
+                                    (order, person, real_file, mask_file))
+    total = len({entry[0] for entry in expected.values()})
+    print_pairing_report(report)
+    if total == 0:
+        raise ValueError("配對檔中沒有可評估的圖片對")
+    
+    cache_dir = None if args.no_feature_cache else args.feature_cache_dir
+    real_features = real_stats = inception = None
+    if args.mode == 'all':
+        real_features, real_stats = load_reference_features(args.real_dir, args.device, cache_dir)
+        inception = create_inception(args.device)
+    evaluator = MaskedLPIPS(device=args.device, backend=args.backend, cache_dir=cache_dir,
+                            precision=args.precision, quant_tolerance=args.quant_tolerance,
+                            resize_cache=create_resize_cache(args))
+    crop_padding = args.crop_padding if args.crop_bbox and args.mode == 'masked_lpips' else None
+    
+    records = {}
+    pending = []
+    seen_pairs = {}
+    total_lpips = 0.0
+    valid_count = 0
+    watcher = DirectoryWatcher(args.gen_dir, args.watch_interval)
+    print(f"監看 {args.gen_dir}（{watcher.mode}），等待 {total} 張生成圖片...")
+    if not os.path.isdir(args.gen_dir):
+        print(f"  {args.gen_dir} 尚未建立，等待推論建立輸出目錄")
+    
+    def score(batch):
+        nonlocal total_lpips, valid_count
+        # 量化模型需要校正集與保留集，累積到足夠的圖片對之前先以 fp32 評估
+        seen_pairs.update(batch)
+        evaluator.apply_precision(list(seen_pairs.values()), crop_padding, args.reduced_decode,
+                                  defer=True)
+        person_of = {order: pair[0] for order, pair in batch}
+        # 以配對順序取代主幹傳入評估：同一人物搭配不同衣服的圖片對主幹相同
+        pairs = [(order,) + pair[1:] for order, pair in batch]
+        if args.mode == 'masked_lpips':
+            results = (
+                {'stem': stem, 'error': error} if error is not None
+                else {'stem': stem, 'lpips': lpips_score, 'mask_area': mask_area}
+                for stem, lpips_score, mask_area, error in evaluator.iter_masked_lpips(
+                    pairs, args.batch_size, args.num_workers, crop_padding,
+                    args.reduced_decode, loader='thread'
+                )
+            )
+        else:
+            results = iter_all_metrics(pairs, evaluator, inception, args.device, args.batch_size,
+                                       args.num_workers, loader='thread')
+        for record in results:
+            order = record['stem']
+            record['stem'] = person_of[order]
+            records[order] = record
+            if 'error' not in record:
+                total_lpips += record['lpips']
+                valid_count += 1
+        if valid_count:
+            print(f"已評估 {len(records)}/{total}，Masked LPIPS 累計平均 {total_lpips / valid_count:.4f}")
+    
+    idle_since = time.monotonic()
+    try:
+        while len(records) < total:
+            names = watcher.poll()
+            for name in names:
+                entry = expected.get(os.path.splitext(name)[0])
+                if entry is None:
+                    continue
+                order, person, real_file, mask_file = entry
+                if order in records and 'error' not in records[order]:
+                    continue
+                if any(queued == order for queued, _ in pending):
+                    continue
+                pending.append((order, (person, Path(args.gen_dir) / name, real_file, mask_file)))
+            
+            # 累積滿一批，或暫時沒有新檔案時，評估目前的微批次
+            if pending and (len(pending) >= args.batch_size or not names):
+                score(pending)
+                pending = []
+            
+            if names:
+                idle_since = time.monotonic()
+            elif args.watch_timeout and time.monotonic() - idle_since > args.watch_timeout:
+                print(f"超過 {args.watch_timeout} 秒沒有新圖片，以已評估的圖片計算結果")
+                break
+    finally:
+        watcher.close()
+    
+    missing = total - len(records)
+    if missing:
+        print(f"未出現的生成圖片：{missing} 張")
+    
+    with MetricsCollector(args.per_image_out,
+                          PER_IMAGE_FIELDS if args.mode == 'masked_lpips' else ALL_PER_IMAGE_FIELDS,
+                          worst_k=args.worst_k) as collector:
+        collector.write_report(report)
+        for order in sorted(records):
+            collector.add(records[order])
+    return collector.results(real_features, real_stats, kid_subset_size=args.kid_subset_size,
+                             bootstrap=args.bootstrap, ci=args.ci, fid_bootstrap=args.fid_bootstrap)
+
 def main():
-    parser = argparse.ArgumentParser(description='評估腳本')
-    parser.add_argument('--mode', choices=['fid_kid', 'masked_lpips'], required=True,
-                       help='評估模式')
-    parser.add_argument('--gen_dir', required=True, help='生成圖片目錄')
-    parser.add_argument('--real_dir', required=True, help='真實圖片目錄')
-    parser.add_argument('--mask_dir', help='遮罩目錄（僅用於 masked_lpips 模式）')
+    parser = argparse.ArgumentParser(description='評估腳本',
+                                     epilog='目錄參數也可以是 zip 內的目錄，例如 viton_hd_test.zip/test/image')
+    parser.add_argument('--mode', choices=['fid_kid', 'masked_lpips', 'all', 'merge'], required=True,
+                       help='評估模式（all：單次解碼計算所有指標；merge：合併分片結果）')
+    parser.add_argument('--gen_dir', help='生成圖片目錄')
+    parser.add_argument('--real_dir', help='真實圖片目錄（merge 模式預設使用分片記錄的目錄）')
+    parser.add_argument('--mask_dir', help='遮罩目錄（用於 masked_lpips 與 all 模式）')
     parser.add_argument('--device', default='cuda', help='計算裝置')
+    parser.add_argument('--feature_cache_dir', default=DEFAULT_CACHE_DIR,
+                       help='參考集 Inception 特徵快取目錄')
+    parser.add_argument('--no_feature_cache', action='store_true', help='不使用參考集特徵快取')
+    parser.add_argument('--no_resize_cache', action='store_true',
+                       help='不使用 masked_lpips 的 256×256 縮放快取（<feature_cache_dir>/resize）')
+    parser.add_argument('--resize_cache_size', type=float, default=DEFAULT_MAX_BYTES / (1 << 30),
+                       help='縮放快取的大小上限（GB），超過時刪除最久未使用的檔案')
+    parser.add_argument('--kid_subset_size', type=int, default=KID_SUBSET_SIZE,
+                       help='KID 每個子集的樣本數')
+    parser.add_argument('--incremental', action='store_true',
+                       help='FID/KID 增量模式：只處理上次評估後新增的生成圖片')
+    parser.add_argument('--state_file', help=f'增量模式的狀態檔（預設為 <gen_dir>/{FID_STATE_NAME}）')
+    parser.add_argument('--pairs_file', help='配對檔（test_pairs.txt / test_unpairs.txt），用於以人物主幹配對生成圖片')
+    parser.add_argument('--crop_bbox', action='store_true',
+                       help='Masked LPIPS 只評估遮罩邊界框內的區域')
+    parser.add_argument('--crop_padding', type=int, default=16,
+                       help='遮罩邊界框外擴的像素數（僅用於 --crop_bbox）')
+    parser.add_argument('--batch_size', type=int, default=1,
+                       help='Masked LPIPS 每批圖片對數量')
+    parser.add_argument('--num_workers', type=int, default=0,
+                       help='背景解碼圖片的 DataLoader worker 數量')
+    parser.add_argument('--loader', choices=['process', 'thread'], default='process',
+                       help='解碼方式：DataLoader 多程序 worker 或執行緒池')
+    parser.add_argument('--reduced_decode', action='store_true',
+                       help='Masked LPIPS 以縮小比例解碼 JPEG 與遮罩（分數會有些微差異）')
+    parser.add_argument('--output_json', help='將評估結果寫入 JSON 檔')
+    parser.add_argument('--per_image_out',
+                       help='逐張寫出分數與失敗原因（.csv 或 .parquet），用於 masked_lpips 與 all 模式')
+    parser.add_argument('--worst_k', type=int, default=0, help='列出 LPIPS 最差的 k 張圖片')
+    parser.add_argument('--bootstrap', type=int, default=0,
+                       help='自助法重抽樣次數（0 表示不計算信賴區間）')
+    parser.add_argument('--fid_bootstrap', type=int, default=None,
+                       help=f'FID 的重抽樣次數（預設 min(--bootstrap, {DEFAULT_FID_BOOTSTRAP})）；'
+                            f'每次需一次特徵值分解，n=2000 時 CPU 上約 0.2–0.5 秒')
+    parser.add_argument('--ci', type=float, default=95, help='信賴區間百分比')
+    parser.add_argument('--shard', type=parse_shard,
+                       help='只計算第 i 個分片（格式 i/N，i 從 0 開始），結果寫入 --partial_out')
+    parser.add_argument('--partial_out', help='分片結果輸出檔（.npz）')
+    parser.add_argument('--partials', nargs='+', help='merge 模式要合併的分片結果檔')
+    parser.add_argument('--launch', type=int, default=0,
+                       help='在本機啟動 N 個分片程序並自動合併結果')
+    parser.add_argument('--partial_dir', help='--launch 的分片結果目錄（預設為 <gen_dir>/.eval_shards）')
+    parser.add_argument('--threads_per_shard', type=int, default=0,
+                       help='--launch 每個分片程序的執行緒數（預設平均分配可用 CPU）')
+    parser.add_argument('--num_threads', type=int, default=0,
+                       help='torch 計算執行緒數（0 表示使用預設值）')
+    parser.add_argument('--cpu_affinity', help='將程序綁定到指定的 CPU 編號（以逗號分隔）')
+    parser.add_argument('--backend', choices=['torch', 'onnx'], default='torch',
+                       help='LPIPS 推論後端（onnx：匯出並快取 ONNX 模型，以 onnxruntime 執行）')
+    parser.add_argument('--precision', choices=['fp32', 'bf16', 'int8'], default='fp32',
+                       help='LPIPS 特徵擷取網路的精度（bf16/int8 僅用於 CPU 快速檢查）')
+    parser.add_argument('--quant_tolerance', type=float, default=QUANT_TOLERANCE,
+                       help='bf16/int8 與 fp32 LPIPS 在校正子集上的平均絕對差上限')
+    parser.add_argument('--watch', action='store_true',
+                       help='監看 --gen_dir，生成圖片寫入後即評估，配對檔中的圖片全部出現後輸出結果')
+    parser.add_argument('--watch_interval', type=float, default=1.0,
+                       help='監看模式的輪詢間隔秒數（無法使用 inotify 時）')
+    parser.add_argument('--watch_timeout', type=float, default=0,
+                       help='監看模式超過幾秒沒有新圖片即結束（0 表示一直等待）')
+    parser.add_argument('--check_backend', action='store_true',
+                       help='比對 --backend 與 torch 後端的 LPIPS 分數並量測吞吐量後結束')
     
     args = parser.parse_args()
     
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    if args.cpu_affinity and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, {int(cpu) for cpu in args.cpu_affinity.split(',')})
+    
+    if args.check_backend:
+        try:
+            report = check_lpips_backend(
+                args.device, args.backend, batch_size=args.batch_size,
+                cache_dir=None if args.no_feature_cache else args.feature_cache_dir
+            )
+        except Exception as e:
+            print(f"後端檢查失敗：{e}")
+            sys.exit(1)
+        print(f"\nLPIPS 最大絕對差：{report['max_abs_diff']:.2e}（平均 {report['mean_abs_diff']:.2e}）")
+        print(f"torch 吞吐量：{report['torch_pairs_per_sec']:.1f} 組/秒")
+        print(f"{args.backend} 吞吐量：{report[args.backend + '_pairs_per_sec']:.1f} 組/秒")
+        return
+    
+    if args.mode != 'merge' and not (args.gen_dir and args.real_dir):
+        print(f"錯誤：{args.mode} 模式需要 --gen_dir 與 --real_dir 參數")
+        sys.exit(1)
+    if args.mode in ('masked_lpips', 'all') and not args.mask_dir:
+        print(f"錯誤：{args.mode} 模式需要 --mask_dir 參數")
+        sys.exit(1)
+    if (args.shard or args.launch > 0) and (args.mode == 'merge' or args.incremental):
+        print("錯誤：--shard 與 --launch 不支援 merge 模式與 --incremental")
+        sys.exit(1)
+    
+    if args.shard:
+        if not args.partial_out:
+            print("錯誤：--shard 需要 --partial_out 參數")
+            sys.exit(1)
+        try:
+            run_shard(args)
+        except Exception as e:
+            print(f"分片評估失敗：{e}")
+            sys.exit(1)
+        return
+    
+    if args.watch:
+        if args.mode not in ('masked_lpips', 'all') or not args.pairs_file:
+            print("錯誤：--watch 只支援 masked_lpips 與 all 模式，並需要 --pairs_file 參數")
+            sys.exit(1)
+        
+        print("=" * 50)
+        print("監看模式評估")
+        print("=" * 50)
+        
+        try:
+            results = watch_metrics(args)
+        except Exception as e:
+            print(f"評估失敗：{e}")
+            sys.exit(1)
+        
+        print_results(results, args.ci)
+        write_results_json(results, args.output_json)
+        return
+    
+    if args.mode == 'merge' or args.launch > 0:
+        print("=" * 50)
+        print("分片評估")
+        print("=" * 50)
+        
+        try:
+            if args.launch > 0:
+                results = launch_shards(args, sys.argv[1:])
+            elif args.partials:
+                results = merge_partials(args.partials, args)
+            else:
+                print("錯誤：merge 模式需要 --partials 參數")
+                sys.exit(1)
+        except Exception as e:
+            print(f"評估失敗：{e}")
+            sys.exit(1)
+        
+        print_results(results, args.ci)
+        write_results_json(results, args.output_json)
+        return
+    
     if args.mode == 'fid_kid':
         print("=" * 50)
         print("FID/KID 評估")
         print("=" * 50)
         
-        results = calculate_fid_kid(args.gen_dir, args.real_dir)
+        cache_dir = None if args.no_feature_cache else args.feature_cache_dir
+        if args.incremental:
+            results = calculate_fid_kid_incremental(
+                args.gen_dir, args.real_dir, device=args.device, cache_dir=cache_dir,
+                kid_subset_size=args.kid_subset_size, state_file=args.state_file,
+                bootstrap=args.bootstrap, ci=args.ci, fid_bootstrap=args.fid_bootstrap
+            )
+        else:
+            results = calculate_fid_kid(args.gen_dir, args.real_dir, device=args.device,
+                                        cache_dir=cache_dir, kid_subset_size=args.kid_subset_size,
+                                        bootstrap=args.bootstrap, ci=args.ci,
+                                        fid_bootstrap=args.fid_bootstrap)
         if results:
-            print(f"\n結果：")
-            print(f"FID: {results['fid']:.4f}")
-            print(f"KID: {results['kid']:.4f}")
+            print_results(results, args.ci)
+            write_results_json(results, args.output_json)
         else:
             print("評估失敗")
             sys.exit(1)
     
     elif args.mode == 'masked_lpips':
-        if not args.mask_dir:
-            print("錯誤：masked_lpips 模式需要 --mask_dir 參數")
-            sys.exit(1)
-        
         print("=" * 50)
         print("Masked LPIPS 評估")
         print("=" * 50)
         
         try:
-            evaluator = MaskedLPIPS(device=args.device)
+            evaluator = MaskedLPIPS(device=args.device, backend=args.backend,
+                                    cache_dir=None if args.no_feature_cache else args.feature_cache_dir,
+                                    precision=args.precision, quant_tolerance=args.quant_tolerance,
+                                    resize_cache=create_resize_cache(args))
             lpips_score = evaluator.calculate_masked_lpips(
-                args.gen_dir, args.real_dir, args.mask_dir
+                args.gen_dir, args.real_dir, args.mask_dir,
+                batch_size=args.batch_size, num_workers=args.num_workers,
+                pairs_file=args.pairs_file,
+                crop_padding=args.crop_padding if args.crop_bbox else None,
+                reduced_decode=args.reduced_decode, loader=args.loader,
+                per_image_out=args.per_image_out, worst_k=args.worst_k
             )
-            print(f"\nMasked LPIPS: {lpips_score:.4f}")
+            results = {'masked_lpips': lpips_score, 'num_pairs': len(evaluator.last_scores)}
+            if args.bootstrap > 0:
+                results['masked_lpips_ci'] = bootstrap_lpips_interval(
+                    evaluator.last_scores, args.bootstrap, args.ci
+                )
+            print(f"\nMasked LPIPS: {lpips_score:.4f}{format_interval(results, 'masked_lpips_ci', args.ci)}")
         except Exception as e:
             print(f"評估失敗：{e}")
             sys.exit(1)
+        write_results_json(results, args.output_json)
+    
+    elif args.mode == 'all':
+        print("=" * 50)
+        print("單次解碼綜合評估")
+        print("=" * 50)
+        
+        try:
+            results = calculate_all_metrics(
+                args.gen_dir, args.real_dir, args.mask_dir, device=args.device,
+                batch_size=args.batch_size, num_workers=args.num_workers,
+                pairs_file=args.pairs_file,
+                cache_dir=None if args.no_feature_cache else args.feature_cache_dir,
+                kid_subset_size=args.kid_subset_size, loader=args.loader,
+                per_image_out=args.per_image_out, worst_k=args.worst_k,
+                bootstrap=args.bootstrap, ci=args.ci, backend=args.backend,
+                precision=args.precision, quant_tolerance=args.quant_tolerance,
+                fid_bootstrap=args.fid_bootstrap
+            )
+        except Exception as e:
+            print(f"評估失敗：{e}")
+            sys.exit(1)
+        
+        print_results(results, args.ci)
+        write_results_json(results, args.output_json)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+打包資料集：將一個目錄的圖片解碼後存成可記憶體映射的 uint8 陣列
+
+numpy 只在讀寫陣列時才匯入，dataset_io 判斷打包路徑時不需要 numpy。
+
+打包後的目錄（<名稱>.pack/）包含 index.json 與多個 shard-<編號>.npy：
+- rgb：H×W×3 的 RGB 陣列
+- gray：H×W 的灰階陣列
+- mask：二值遮罩以 np.packbits 逐位元打包，佔用空間為灰階的 1/8
+同一個打包目錄中的所有圖片必須有相同的解析度。
+
+tools/eval.py 與 dataset_io 可以把打包目錄當成一般目錄使用，成員名稱與原始檔名相同，
+讀取時直接取得記憶體映射的視圖，不需要重新解碼。
+
+範例：
+    python tools/packed_store.py pack DATA/zalando-hd-resized/test_fine/image packed/image.pack
+    python tools/packed_store.py pack DATA/zalando-hd-resized/test_fine/agnostic-mask \\
+        packed/agnostic-mask.pack --kind mask
+"""
+
+import os
+import sys
+import argparse
+import json
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+# 打包目錄的副檔名與索引檔
+PACK_SUFFIX = '.pack'
+PACK_INDEX_NAME = 'index.json'
+PACK_VERSION = 1
+
+# 每個 shard 的圖片數
+DEFAULT_SHARD_SIZE = 1024
+
+# 各種類的通道數
+PACK_KINDS = {'rgb': 3, 'gray': 1, 'mask': 1}
+
+# 會被打包的圖片副檔名
+PACK_EXTS = ('.png', '.jpg', '.jpeg')
+
+def shard_name(shard):
+    return f"shard-{shard:05d}.npy"
+
+def is_pack(path):
+    """path 是否為打包目錄（以 .pack 結尾且含有 index.json）"""
+    path = os.fspath(path)
+    return path.endswith(PACK_SUFFIX) and os.path.isfile(os.path.join(path, PACK_INDEX_NAME))
+
+def split_pack_path(path):
+    """將路徑拆成 (打包目錄, 成員名稱)；不在打包目錄內時回傳 None，打包目錄本身的成員名稱為 ''"""
+    path = os.fspath(path)
+    if is_pack(path):
+        return path, ''
+    parent, name = os.path.split(path)
+    if is_pack(parent):
+        return parent, name
+    return None
+
+class PackedStore:
+    """唯讀的打包目錄，shard 以 copy-on-write 模式記憶體映射，可直接交給 torch.from_numpy"""
+
+    def __init__(self, root):
+        self.root = os.fspath(root)
+        with open(os.path.join(self.root, PACK_INDEX_NAME), 'r') as f:
+            index = json.load(f)
+        if index.get('version') != PACK_VERSION:
+            raise ValueError(f"不支援的打包格式版本：{self.root}")
+        self.kind = index['kind']
+        self.width = index['width']
+        self.height = index['height']
+        self.shard_size = index['shard_size']
+        self.names = index['names']
+        self.positions = {name: i for i, name in enumerate(self.names)}
+        self.mtime_ns = os.stat(os.path.join(self.root, PACK_INDEX_NAME)).st_mtime_ns
+        self.shards = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.positions
+
+    def shard(self, shard):
+        import numpy as np
+
+        if shard not in self.shards:
+            self.shards[shard] = np.load(os.path.join(self.root, shard_name(shard)), mmap_mode='c')
+        return self.shards[shard]
+
+    def raw(self, name):
+        """回傳成員在 shard 中的原始陣列視圖（mask 為打包後的位元組）"""
+        position = self.positions.get(name)
+        if position is None:
+            raise FileNotFoundError(f"{self.root} 中沒有 {name}")
+        return self.shard(position // self.shard_size)[position % self.shard_size]
+
+    def array(self, name):
+        """回傳 H×W×3（rgb）或 H×W（gray、mask）的 uint8 陣列
+
+        rgb 與 gray 是記憶體映射的視圖（不複製）；mask 需要解開位元，回傳 0/255 的新陣列。
+        """
+        import numpy as np
+
+        data = self.raw(name)
+        if self.kind == 'mask':
+            return np.unpackbits(data, axis=-1, count=self.width) * np.uint8(255)
+        return data
+
+@lru_cache(maxsize=None)
+def open_store(root):
+    return PackedStore(root)
+
+def load_source(path, kind):
+    """解碼來源圖片為要打包的陣列（mask 種類檢查是否為二值圖並打包位元）"""
+    import cv2
+    import numpy as np
+    import dataset_io
+
+    if kind == 'rgb':
+        with dataset_io.open_image(path) as img:
+            return np.array(img.convert('RGB'))
+    array = dataset_io.imread(path, cv2.IMREAD_GRAYSCALE)
+    if array is None:
+        raise ValueError(f"無法讀取圖片 {path}")
+    if kind == 'mask':
+        if np.count_nonzero((array != 0) & (array != 255)):
+            raise ValueError(f"{path} 不是二值遮罩（只能有 0 與 255），請改用 --kind gray")
+        return np.packbits(array == 255, axis=-1)
+    return array
+
+def pack_shard(task):
+    """解碼一個 shard 的圖片並寫入 .npy"""
+    import numpy as np
+
+    files, output, kind, shape = task
+    tmp_path = f"{output}.{os.getpid()}.tmp"
+    shard = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(len(files),) + shape)
+    try:
+        for i, file_path in enumerate(files):
+            array = load_source(file_path, kind)
+            if array.shape != shape:
+                raise ValueError(f"{file_path} 的尺寸 {array.shape} 與打包解析度 {shape} 不同")
+            shard[i] = array
+        shard.flush()
+    except BaseException:
+        del shard
+        os.remove(tmp_path)
+        raise
+    del shard
+    os.replace(tmp_path, output)
+
+def pack_directory(source, output, kind='rgb', shard_size=DEFAULT_SHARD_SIZE, workers=None):
+    """將 source 目錄（可為 zip 內的目錄）中的圖片打包到 output，回傳打包的圖片數
+
+    所有圖片必須與第一張圖片的解析度相同；index.json 最後寫入，中斷的打包不會被當成有效的打包目錄。
+    """
+    import dataset_io
+
+    if not os.fspath(output).endswith(PACK_SUFFIX):
+        raise ValueError(f"打包目錄必須以 {PACK_SUFFIX} 結尾：{output}")
+    files = sorted((name, path) for name, path in dataset_io.list_files(source)
+                   if os.path.splitext(name)[1].lower() in PACK_EXTS)
+    if not files:
+        raise ValueError(f"來源目錄中沒有圖片：{source}")
+
+    with dataset_io.open_image(files[0][1]) as img:
+        width, height = img.size  # 只讀取檔頭
+    if kind == 'rgb':
+        shape = (height, width, 3)
+    elif kind == 'mask':
+        shape = (height, (width + 7) // 8)
+    else:
+        shape = (height, width)
+
+    if os.path.exists(output):
+        shutil.rmtree(output)
+    os.makedirs(output)
+
+    paths = [path for _, path in files]
+    tasks = [(paths[start:start + shard_size], os.path.join(output, shard_name(shard)), kind, shape)
+             for shard, start in enumerate(range(0, len(paths), shard_size))]
+    if workers == 1 or len(tasks) == 1:
+        for task in tasks:
+            pack_shard(task)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(pack_shard, tasks))
+
+    index = {
+        'version': PACK_VERSION,
+        'kind': kind,
+        'width': width,
+        'height': height,
+        'shard_size': shard_size,
+        'source': os.fspath(source),
+        'names': [name for name, _ in files]
+    }
+    tmp_path = os.path.join(output, f"{PACK_INDEX_NAME}.{os.getpid()}.tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, os.path.join(output, PACK_INDEX_NAME))
+    return len(files)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='將圖片目錄打包為可記憶體映射的 uint8 陣列',
+        epilog='範例：python tools/packed_store.py pack DATA/zalando-hd-resized/test_fine/image image.pack'
+    )
+    parser.add_argument('command', choices=['pack'], help='要執行的命令')
+    parser.add_argument('source', help='來源圖片目錄（也可以是 zip 內的目錄）')
+    parser.add_argument('output', help=f'輸出的打包目錄（以 {PACK_SUFFIX} 結尾，已存在時覆寫）')
+    parser.add_argument('--kind', choices=list(PACK_KINDS), default='rgb',
+                       help='rgb：彩色圖片；mask：二值遮罩（逐位元打包）；gray：灰階圖片')
+    parser.add_argument('--shard_size', type=int, default=DEFAULT_SHARD_SIZE, help='每個 shard 的圖片數')
+    parser.add_argument('--workers', type=int, default=None, help='解碼的程序數（預設為 CPU 核心數）')
+
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    try:
+        count = pack_directory(args.source, args.output, args.kind, args.shard_size, args.workers)
+    except (ValueError, OSError) as e:
+        print(f"❌ 打包失敗：{e}")
+        sys.exit(1)
+    print(f"✅ 已打包 {count} 張圖片到 {args.output}（{time.perf_counter() - start:.1f} 秒）")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+縮放後圖片的磁碟快取
+
+以 (來源路徑, 大小, 修改時間, 目標尺寸, 縮放方式) 為鍵，將縮放後的 uint8 陣列存為
+<root>/<鍵前兩碼>/<鍵>.npy。第一次讀取時才縮放並寫入；寫入先寫暫存檔再 os.replace，
+多個程序同時寫入同一個鍵也不會產生不完整的檔案；寫入失敗（磁碟已滿、唯讀）時
+刪除暫存檔並照常回傳縮放結果。命中時更新修改時間，總大小超過上限時
+依修改時間刪除最久未使用的檔案（LRU）。
+"""
+
+import os
+import hashlib
+import threading
+
+import numpy as np
+
+import dataset_io
+
+# 預設快取大小上限（bytes）
+DEFAULT_MAX_BYTES = 2 << 30
+
+# 每寫入上限的這個比例後檢查一次總大小
+PRUNE_FRACTION = 0.05
+
+class ResizeCache:
+    """縮放結果快取，可傳給 DataLoader worker（各程序各自計算寫入量並清理）"""
+
+    def __init__(self, root, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = os.fspath(root)
+        self.max_bytes = max_bytes
+        self.written = 0
+
+    def key(self, file_path, tag):
+        """來源指紋與縮放設定的雜湊；來源檔案改變（大小或修改時間）時鍵也會改變"""
+        size, mtime_ns = dataset_io.file_stat(file_path)
+        source = os.path.abspath(os.fspath(file_path))
+        return hashlib.sha1(f"{source}\0{size}\0{mtime_ns}\0{tag}".encode()).hexdigest()
+
+    def get(self, file_path, tag, create):
+        """回傳 file_path 以 tag 描述的方式縮放後的陣列，未命中時呼叫 create() 並寫入快取"""
+        key = self.key(file_path, tag)
+        cache_file = os.path.join(self.root, key[:2], f"{key}.npy")
+        try:
+            array = np.load(cache_file)
+        except (OSError, ValueError, EOFError):
+            pass
+        else:
+            try:
+                os.utime(cache_file)  # 更新 LRU 順序；唯讀時照常使用快取
+            except OSError:
+                pass
+            return array
+
+        array = np.ascontiguousarray(create())
+        tmp_path = f"{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                np.save(f, array)
+            os.replace(tmp_path, cache_file)
+        except OSError:
+            # 快取只是加速：磁碟已滿或唯讀時直接回傳縮放結果，不影響評估
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return array
+
+        self.written += array.nbytes
+        if self.written >= self.max_bytes * PRUNE_FRACTION:
+            self.written = 0
+            self.prune()
+        return array
+
+    def prune(self):
+        """刪除最久未使用的檔案，直到總大小不超過上限；回傳刪除的檔案數"""
+        entries = []
+        total = 0
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                if not name.endswith('.npy'):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue  # 其他程序已刪除
+                entries.append((stat.st_mtime_ns, stat.st_size, path))
+                total += stat.st_size
+
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+        return removed
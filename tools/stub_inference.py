@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+測試用推論腳本
+
+接受與 PromptDresser/inference.py 相同的主要參數，不載入模型，只為 [s_idx, e_idx)
+中的每個索引寫出 outputs/<save_name>/paired/<人物主幹>.jpg（小型純色圖片）與
+outputs/<save_name>/stub/<索引>.json（記錄程序與 CUDA_VISIBLE_DEVICES），
+可在只有 CPU 的環境測試 kaggle_inference.py 的分段排程與 --resume：
+
+    python kaggle_inference.py --full --workers 4 --devices cpu \
+        --inference_script tools/stub_inference.py --skip_model_check --delay 0.05
+"""
+
+import os
+import sys
+import argparse
+import json
+import time
+from pathlib import Path
+
+def create_stub_pipeline(data_root='data/zalando-hd-resized/test', delay=0):
+    """inference_worker.py 的測試用 pipeline：回傳人物圖片的複本，不載入模型
+    
+    person/cloth 為 <data_root>/image/ 與 <data_root>/cloth/ 中的檔名；delay 模擬每張圖片的推論時間。
+    """
+    from PIL import Image
+    
+    delay = float(delay)
+    
+    def pipeline(person, cloth, steps, seed):
+        cloth_path = os.path.join(data_root, 'cloth', cloth)
+        if not os.path.exists(cloth_path):
+            raise FileNotFoundError(f"衣服圖片不存在：{cloth_path}")
+        time.sleep(delay)
+        with Image.open(os.path.join(data_root, 'image', person)) as img:
+            return img.convert('RGB')
+    
+    return pipeline
+
+def main():
+    parser = argparse.ArgumentParser(description='測試用推論腳本（不載入模型）')
+    parser.add_argument('--config_p', help='推論配置檔（忽略）')
+    parser.add_argument('--save_name', default='stub', help='輸出名稱')
+    parser.add_argument('--num_inference_steps', type=int, default=28, help='擴散步數（忽略）')
+    parser.add_argument('--s_idx', type=int, required=True, help='起始配對索引')
+    parser.add_argument('--e_idx', type=int, required=True, help='結束配對索引（不含）')
+    parser.add_argument('--output_dir', default='outputs', help='輸出根目錄')
+    parser.add_argument('--pairs_file', default='data/zalando-hd-resized/test_pairs.txt',
+                       help='配對檔（決定輸出檔名；test_unpairs.txt 輸出到 unpaired/）')
+    parser.add_argument('--delay', type=float, default=0.0, help='每個索引等待的秒數（模擬推論時間）')
+    parser.add_argument('--fail_idx', type=int, nargs='*', default=[],
+                       help='處理到這些索引時以結束碼 1 失敗（模擬推論錯誤）')
+    
+    args = parser.parse_args()
+    
+    from PIL import Image
+    
+    with open(args.pairs_file, 'r') as f:
+        persons = [os.path.splitext(line.split()[0])[0] for line in f if line.strip()]
+    subdir = 'unpaired' if 'unpair' in Path(args.pairs_file).name else 'paired'
+    image_dir = Path(args.output_dir) / args.save_name / subdir
+    output_dir = Path(args.output_dir) / args.save_name / 'stub'
+    image_dir.mkdir(parents=True, exist_ok=True)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for idx in range(args.s_idx, args.e_idx):
+        if idx in args.fail_idx:
+            print(f"索引 {idx} 模擬失敗")
+            sys.exit(1)
+        time.sleep(args.delay)
+        record = {
+            'idx': idx,
+            'pid': os.getpid(),
+            'cuda_visible_devices': os.environ.get('CUDA_VISIBLE_DEVICES'),
+            'omp_num_threads': os.environ.get('OMP_NUM_THREADS')
+        }
+        with open(output_dir / f"{idx:05d}.json", 'w') as f:
+            json.dump(record, f)
+        Image.new('RGB', (8, 8), (idx % 256, 0, 0)).save(image_dir / f"{persons[idx]}.jpg")
+        print(f"完成索引 {idx}")
+
+if __name__ == "__main__":
+    main()